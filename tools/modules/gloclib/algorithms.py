@@ -52,8 +52,8 @@ def hulls(Points):
 
     @version: 1.0
 
-    @param Points: Points to find convex hull of
-    @type Points: Points
+    @param Points: Points to find convex hull of, or a structured numpy array with latitude and longitude columns
+    @type Points: Points or numpy.ndarray
 
     @return: Upper and lower convex hulls
     @rtype: tupple of lists
@@ -62,7 +62,10 @@ def hulls(Points):
 
     U = []
     L = []
-    Points.sort()
+    if hasattr(Points, 'dtype'):
+        Points = sorted_positions(Points)
+    else:
+        Points.sort()
     for p in Points:
         while len(U) > 1 and orientation(U[-2],U[-1],p) <= 0: U.pop()
         while len(L) > 1 and orientation(L[-2],L[-1],p) >= 0: L.pop()
@@ -73,4 +76,29 @@ def hulls(Points):
     U += L
 
     return U
-    
+
+def sorted_positions(positions):
+    """ 
+    Sort the positions in a structured numpy array and return them as a list
+    of (latitude, longitude) points, skipping positions that are not set.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+
+    @version: 1.0
+
+    @param positions: positions with latitude and longitude columns (eg. result of L{GlocDB.columns})
+    @type positions: numpy.ndarray
+
+    @return: sorted points
+    @rtype: list of tupples
+    """
+
+    import numpy
+    lat = positions['latitude']
+    lon = positions['longitude']
+    keep = ~(numpy.isnan(lat) | numpy.isnan(lon))
+    lat = lat[keep]
+    lon = lon[keep]
+    order = numpy.lexsort((lon, lat))
+    return zip(lat[order].tolist(), lon[order].tolist())
@@ -24,7 +24,6 @@
 
 import os
 import re
-from time import time
 
 def check_dir(strPath, strSubPath=None):
     """ 
@@ -69,25 +68,3 @@ def del_file(filename):
         os.remove(filename)
     except:
         pass
-
-def delete_old(filename, intSeconds=86400):
-    """ 
-    Remove file if is older than given time 
-
-    @author: Unknown
-
-    @version: 1.0
-
-    @param filename: file to be removed
-    @type filename: str
-    @param intSeconds: remove file only if older than intSeconds. Defaults to 24h
-    @type intSeconds: int
-    """
-
-    if os.path.isfile(filename):
-        if (int(time() - os.path.getmtime(filename)) > intSeconds):
-            try:
-                os.remove(filename)
-                return True
-            except:
-                pass
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+ In-memory index of the gathered GSM and WLAN fingerprints, used to find
+ the closest matching fingerprint without a database round trip.
+
+ @author: Brendan Johan Lee
+ @contact: brendajl@simula.no
+ @version: 1.0
+"""
+## GNU General Public Licence (GPL)
+
+## This program is free software; you can redistribute it and / or modify it under
+## the terms of the GNU General Public License as published by the Free Software
+## Foundation; either version 2 of the License,  or (at your option) any later
+## version.
+## This program is distributed in the hope that it will be useful,  but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+## FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+## details.
+## You should have received a copy of the GNU General Public License along with
+## this program; if not,  write to the Free Software Foundation,  Inc.,  59 Temple
+## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
+
+from bisect import bisect_left
+
+class FingerprintRow(list):
+    """
+    A row found in the index. Like the DictRows the closest match methods of
+    L{GlocDB} return, its columns are read both by position and by name.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, columns, values):
+        """
+        Initialize FingerprintRow.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param columns: column names, in the order of values
+        @type columns: list of str
+        @param values: column values
+        @type values: list
+        """
+
+        list.__init__(self, values)
+        self.columns = dict([(name, i) for i, name in enumerate(columns)])
+        self.names = list(columns)
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, long, slice)):
+            key = self.columns[key]
+        return list.__getitem__(self, key)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def get(self, name, default=None):
+        if name in self.columns:
+            return self[name]
+        return default
+
+    def keys(self):
+        return list(self.names)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self.names, self)
+
+    has_key = __contains__
+
+def withdiff(row, diff):
+    """
+    Return a copy of a database row with the rxlev difference added as the
+    last column, the same way the SQL closest match queries add a diff
+    column. The columns are those of row.keys(), which for the DictRows of
+    psycopg2 are in the order of the query.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+
+    @param row: database row
+    @type row: DictRow or dict
+    @param diff: absolute difference between the rxlev of the row and the one searched for, None if the row has no rxlev
+    @type diff: int
+
+    @return: copy of row with diff set
+    @rtype: L{FingerprintRow}
+    """
+
+    columns = [name for name in row.keys() if name != 'diff']
+    return FingerprintRow(columns + ['diff'], [row[name] for name in columns] + [diff])
+
+def closest(entry, rxlev):
+    """
+    Binary search for the row with the rxlev closest to the given one. As
+    the SQL versions sort a NULL diff last, rows without an rxlev are only
+    returned, with a diff of None, if there are no others.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+
+    @param entry: sorted rxlevs, the rows they belong to and the rows without rxlev
+    @type entry: tupple of lists
+    @param rxlev: receive level to search for
+    @type rxlev: int
+
+    @return: closest matching row with diff set, in a list like the SQL versions
+    @rtype: list
+    """
+
+    rxlevs, rows, unlevelled = entry
+    if not rxlevs:
+        return [withdiff(row, None) for row in unlevelled[:1]]
+    i = bisect_left(rxlevs, rxlev)
+    if i == len(rxlevs) or (i > 0 and rxlev - rxlevs[i-1] <= rxlevs[i] - rxlev):
+        i -= 1
+    return [withdiff(rows[i], abs(rxlevs[i] - rxlev))]
+
+class FingerprintIndex:
+    """
+    Index of the fingerprints in the gatheredcellobservations and
+    gatheredwlanobservations views. Observations are grouped per cell (cid)
+    and per WLAN (bssid) and kept sorted by rxlev, so the closest match is
+    found by binary search. Answers the same questions as the closest match
+    methods of L{GlocDB}.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, db):
+        """
+        Initialize FingerprintIndex. The index is empty until L{load} is called.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param db: database to load the fingerprints from
+        @type db: L{GlocDB}
+        """
+
+        self.db = db
+        self.cells = {}
+        self.gsm = {}
+        self.wlan = {}
+
+    def load(self):
+        """
+        (Re)load all cells and fingerprints from the database.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        self.cells = {}
+        for cell in self.db.sql("SELECT cid,mcc,mnc,la,cellid FROM gatheredcells"):
+            self.cells[(int(cell['mcc']),int(cell['mnc']),int(cell['la']),int(cell['cellid']))] = cell['cid']
+        self.gsm = self.__group__(self.db.sql("SELECT * FROM gatheredcellobservations ORDER BY cid, rxlev"), 'cid')
+        self.wlan = self.__group__(self.db.sql("SELECT * FROM gatheredwlanobservations ORDER BY bssid, rxlev"), 'bssid')
+
+    def refresh(self, cids=None, bssids=None):
+        """
+        Reload the fingerprints of the given cells and WLANs only, for instance
+        after new observations of them have been gathered. Cells or WLANs that
+        no longer have any observations are dropped from the index.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param cids: cids of cells to reload
+        @type cids: list of int
+        @param bssids: bssids of WLANs to reload
+        @type bssids: list of str
+        """
+
+        if cids:
+            cids = tuple([int(cid) for cid in cids])
+            for cell in self.db.sql("SELECT cid,mcc,mnc,la,cellid FROM gatheredcells WHERE cid IN %s",(cids,)):
+                self.cells[(int(cell['mcc']),int(cell['mnc']),int(cell['la']),int(cell['cellid']))] = cell['cid']
+            for cid in cids:
+                self.gsm.pop(cid, None)
+            self.gsm.update(self.__group__(self.db.sql(
+                "SELECT * FROM gatheredcellobservations WHERE cid IN %s ORDER BY cid, rxlev",(cids,)), 'cid'))
+        if bssids:
+            bssids = tuple(bssids)
+            for bssid in bssids:
+                self.wlan.pop(bssid, None)
+            self.wlan.update(self.__group__(self.db.sql(
+                "SELECT * FROM gatheredwlanobservations WHERE bssid IN %s ORDER BY bssid, rxlev",(bssids,)), 'bssid'))
+
+    def getCid(self,mcc,mnc,la,cellid):
+        """
+        Get a GSM-cells cid based on its mcc, mnc, la and cellid.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param mcc: Mobile Country Code
+        @type mcc: int
+        @param mnc: Mobile Network Code
+        @type mnc: int
+        @param la: Location Area
+        @type la: int
+        @param cellid: Cell Identification
+        @type cellid: int
+
+        @return: cid of given cell or False
+        @rtype: int or bool
+        """
+
+        return self.cells.get((int(mcc),int(mnc),int(la),int(cellid)), False)
+
+    def getClosestGSMmatch(self,mcc,mnc,la,cellid,rxlev):
+        """
+        Selects the closest matching fingerprint in the index to the
+        supplied cell and rxlev. See L{GlocDB.getClosestGSMmatch}.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param mcc: Mobile Country Code
+        @type mcc: int
+        @param mnc: Mobile Network Code
+        @type mnc: int
+        @param la: Location Area
+        @type la: int
+        @param cellid: Cell Identification
+        @type cellid: int
+        @param rxlev: Radio Receive Level
+        @type rxlev: int
+
+        @return: closest matching fingerprint or False if the cell is unknown
+        @rtype: list
+        """
+
+        cid = self.getCid(mcc,mnc,la,cellid)
+        if not cid:
+            return False
+        return closest(self.gsm.get(cid, ([],[],[])), int(rxlev))
+
+    def getClosestWLANmatch(self,bssid,rxlev):
+        """
+        Selects the closest matching fingerprint in the index to the
+        supplied bssid and rxlev. See L{GlocDB.getClosestWLANmatch}.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param bssid: bssid of WLAN
+        @type bssid: str
+        @param rxlev: receivelevel of WLAN
+        @type rxlev: int
+
+        @return: closest matching fingerprint
+        @rtype: list
+        """
+
+        return closest(self.wlan.get(bssid, ([],[],[])), int(rxlev))
+
+    def __group__(self, rows, key):
+        """
+        Group rows sorted by key and rxlev into per key lists of rxlevs and
+        rows, and of the rows without rxlev.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param rows: rows ordered by key and rxlev
+        @type rows: list
+        @param key: column to group by
+        @type key: str
+
+        @return: rxlevs, rows and rows without rxlev per key
+        @rtype: dict
+        """
+
+        groups = {}
+        for row in rows:
+            rxlevs, grouped, unlevelled = groups.setdefault(row[key], ([],[],[]))
+            if row['rxlev'] is None:
+                unlevelled.append(row)
+                continue
+            rxlevs.append(int(row['rxlev']))
+            grouped.append(row)
+        return groups
+
+if __name__ == "__main__":
+    # Check against the database: fingerprintindex.py [count] compares the
+    # closest matches of the index with those of GlocDB for count gathered
+    # observations, and times both
+    import sys, time
+    from gloclib.glocdb import GlocDB
+    from map.mapConf import MapConf
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    db = GlocDB(MapConf())
+    index = FingerprintIndex(db)
+    start = time.time()
+    index.load()
+    print "loaded in %.3fs" % (time.time()-start)
+    gsm = [(r['mcc'],r['mnc'],r['la'],r['cellid'],r['rxlev']+r['shift']) for r in db.sql(
+        "SELECT c.mcc,c.mnc,c.la,c.cellid,o.rxlev,(random()*10-5)::int AS shift "
+        "FROM gatheredcellobservations AS o JOIN gatheredcells AS c ON o.cid=c.cid "
+        "WHERE o.rxlev IS NOT NULL ORDER BY random() LIMIT %s",(count,))]
+    wlan = [(r['bssid'],r['rxlev']+r['shift']) for r in db.sql(
+        "SELECT bssid,rxlev,(random()*10-5)::int AS shift FROM gatheredwlanobservations "
+        "WHERE rxlev IS NOT NULL ORDER BY random() LIMIT %s",(count,))]
+    for name, queries, sqlmatch, indexmatch in (
+            ('gsm', gsm, db.getClosestGSMmatch, index.getClosestGSMmatch),
+            ('wlan', wlan, db.getClosestWLANmatch, index.getClosestWLANmatch)):
+        start = time.time()
+        expected = [sqlmatch(*q) for q in queries]
+        sqltime = time.time()-start
+        start = time.time()
+        found = [indexmatch(*q) for q in queries]
+        indextime = time.time()-start
+        mismatches = 0
+        ties = 0
+        for e, f in zip(expected, found):
+            if not e or not f:
+                mismatches += bool(e) != bool(f)
+                continue
+            e, f = e[0], f[0]
+            if e['diff'] != f['diff'] or list(e.keys()) != list(f.keys()) or len(e) != len(f) \
+                    or e[len(e)-1] != f[len(f)-1]:
+                mismatches += 1
+            elif list(e) != list(f):
+                # as close, the SQL versions pick any of them
+                ties += 1
+        print "%s sql:   %.3fms per call" % (name, 1000*sqltime/max(len(queries),1))
+        print "%s index: %.3fms per call" % (name, 1000*indextime/max(len(queries),1))
+        print "%s mismatches: %i, other rows as close: %i" % (name, mismatches, ties)
@@ -21,9 +21,38 @@
 ## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
 
 import psycopg2, psycopg2.extras
+import struct
+from threading import Condition
+from StringIO import StringIO
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 rxlevlimits = ["rxlev > 90","rxlev < 90 AND rxlev > 80","rxlev < 80"]
 
+BATCH_SIZE = 1000
+ITERSIZE = 2000
+
+# Columns needed to place rows on a map, see GlocDB.columns
+POSITION_FIELDS = [('latitude','f8'),('longitude','f8')]
+# Columns of observations used by analytics
+OBSERVATION_FIELDS = POSITION_FIELDS + [('rxlev','i4'),('cid','i4'),('imei','i8')]
+
+# Database type and value used for NULL of the numpy types supported by GlocDB.columns
+COLUMN_TYPES = {'f8': ('float8',"'NaN'"), 'i4': ('int4','-1'), 'i8': ('int8','-1')}
+COPY_SIGNATURE = 'PGCOPY\n\377\r\n\0'
+
+# Hot lookups kept as server side prepared statements, see GlocDB.prepared
+PREPARED = {
+    'getcid': "SELECT cid FROM gatheredcells WHERE mcc=$1 AND mnc=$2 AND la=$3 AND cellid=$4",
+    'closestgsm': "SELECT gatheredcellobservations.*,ABS(rxlev - $2) AS diff FROM gatheredcellobservations WHERE cid=$1 ORDER BY diff ASC LIMIT 1",
+    'closestwlan': "SELECT gatheredwlanobservations.*,ABS(rxlev - $2) AS diff FROM gatheredwlanobservations WHERE bssid=$1 ORDER BY diff ASC LIMIT 1",
+    'getmncs': "SELECT * FROM mnc WHERE mcc=$1",
+    'getlas': "SELECT * FROM la WHERE mcc=$1 AND mnc=$2",
+    'getcids': "SELECT * FROM cells WHERE mcc=$1 AND mnc=$2 AND la=$3",
+    }
+
 class GlocDB:
     """
     Class used to interface with the gloc database
@@ -47,7 +76,13 @@ class GlocDB:
         @type conf: L{ServerConf}
         """
         self.conf = conf
-        self.cur = self.__getdbcursor__()
+        self.pool = None
+        self.cur = None
+        self.streams = 0
+        if getattr(conf, 'db_poolsize', 0) > 0:
+            self.pool = ConnectionPool(self.__getdsn__(), conf.db_poolsize)
+        else:
+            self.cur = self.__getdbcursor__()
 
     def getStrongestGSM(self,mcc,mnc,la,cellid):
         """
@@ -72,7 +107,7 @@ class GlocDB:
 
         @todo: Needs errorchecking
         """
-        return self.sql("SELECT * FROM gatheredcells WHERE mcc=%s AND mnc=%s AND la=%s AND cellid=%s"%(mcc,mnc,la,cellid))
+        return self.sql("SELECT * FROM gatheredcells WHERE mcc=%s AND mnc=%s AND la=%s AND cellid=%s",(mcc,mnc,la,cellid))
 
     def getCid(self,mcc,mnc,la,cellid):
         """
@@ -98,7 +133,7 @@ class GlocDB:
         @todo: Error checking
         """
 
-        cellid = self.sql("SELECT cid FROM gatheredcells WHERE mcc=%s AND mnc=%s AND la=%s AND cellid=%s"%(mcc,mnc,la,cellid))
+        cellid = self.prepared('getcid',(mcc,mnc,la,cellid))
         if len(cellid)<1:
             return False
         return cellid[0][0]
@@ -132,7 +167,43 @@ class GlocDB:
         cid = self.getCid(mcc,mnc,la,cellid)
         if not cid:
             return False
-        return self.sql("SELECT gatheredcellobservations.*,ABS(rxlev - %s) AS diff FROM gatheredcellobservations WHERE cid=%s ORDER BY diff ASC LIMIT 1"%(rxlev,cid))
+        return self.prepared('closestgsm',(cid,rxlev))
+
+    def getClosestGSMmatches(self,observations,batchsize=BATCH_SIZE):
+        """
+        Batch version of L{getClosestGSMmatch}. Resolves the closest matching
+        fingerprint for many observations using one set based query per
+        batch instead of two queries per observation. The observations are
+        joined against the database as a VALUES list, and DISTINCT ON picks
+        the closest fingerprint for each of them.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param observations: observations to localise
+        @type observations: list of (mcc, mnc, la, cellid, rxlev) tupples
+        @param batchsize: maximum number of observations sent in one query
+        @type batchsize: int
+
+        @return: closest matching fingerprint for each observation in input order, None where the cell is unknown or has no observations
+        @rtype: list
+        """
+
+        result = [None]*len(observations)
+        for start in xrange(0,len(observations),batchsize):
+            batch = observations[start:start+batchsize]
+            params = []
+            for i,o in enumerate(batch):
+                params.extend((start+i,int(o[0]),int(o[1]),int(o[2]),int(o[3]),int(o[4])))
+            rows = self.sql("SELECT DISTINCT ON (q.idx) q.idx AS idx,o.*,ABS(o.rxlev - q.rxlev) AS diff "
+                            "FROM (VALUES %s) AS q(idx,mcc,mnc,la,cellid,rxlev) "
+                            "JOIN gatheredcells AS c ON c.mcc=q.mcc AND c.mnc=q.mnc AND c.la=q.la AND c.cellid=q.cellid "
+                            "JOIN gatheredcellobservations AS o ON o.cid=c.cid "
+                            "ORDER BY q.idx, diff ASC"%','.join(["(%s,%s,%s,%s,%s,%s)"]*len(batch)),params)
+            for row in rows:
+                result[row['idx']] = row
+        return result
 
     def getClosestWLANmatch(self,bssid,rxlev):
         """
@@ -153,9 +224,9 @@ class GlocDB:
 
         @todo: error checking
         """
-        return self.sql("SELECT gatheredwlanobservations.*,ABS(rxlev - %s) AS diff FROM gatheredwlanobservations WHERE bssid='%s' ORDER BY diff ASC LIMIT 1"%(rxlev,bssid))
+        return self.prepared('closestwlan',(bssid,rxlev))
 
-    def getcellobservations(cid,type=None):
+    def getcellobservations(self,cid,type=None):
         """ 
         Returns a database cursor containing all observations of a given cell.
         If the optional 
@@ -177,7 +248,7 @@ class GlocDB:
         @rtype: list of tupples
         """
 
-        return self.sql("SELECT * FROM gatheredcellobservations WHERE cid=%i %s"%(int(cid),"AND %s"%rxlevlimits[int(type)] if type else ""))
+        return self.sql("SELECT * FROM gatheredcellobservations WHERE cid=%%s %s"%("AND %s"%rxlevlimits[int(type)] if type else ""),(int(cid),))
 
     def getstats(self):
         """ 
@@ -303,7 +374,7 @@ class GlocDB:
         @rtype: list
         """
 
-        return self.sql("SELECT * FROM mnc WHERE mcc=%s"%mcc)
+        return self.prepared('getmncs',(mcc,))
 
     def getcids(self, mcc,mnc,la):
         """ 
@@ -326,7 +397,7 @@ class GlocDB:
         @rtype: list
         """
 
-        return self.sql("SELECT * FROM cells WHERE mcc=%s AND mnc=%s AND la=%s"%(mcc,mnc,la))
+        return self.prepared('getcids',(mcc,mnc,la))
 
     def getlas(self, mcc,mnc):
         """ 
@@ -346,7 +417,7 @@ class GlocDB:
         @rtype: list
         """
 
-        return self.sql("SELECT * FROM la WHERE mcc=%s AND mnc=%s"%(mcc,mnc))
+        return self.prepared('getlas',(mcc,mnc))
 
     def getcells(self, mcc=None,mnc=None,la=None):
         """ 
@@ -370,15 +441,14 @@ class GlocDB:
         @rtype: tupple of string and list of tupples
         """
 
-        sql = ""
-        if mcc:
-            sql += "%s mcc=%i "%("WHERE" if first else "AND",int(mcc))
-        if mnc:
-            sql += "%s mnc=%i "%("WHERE" if first else "AND",int(mnc))
-        if la:
-            sql += "%s la=%i "%("WHERE" if first else "AND",int(la))
+        limits = []
+        params = []
+        for column,value in (('mcc',mcc),('mnc',mnc),('la',la)):
+            if value:
+                limits.append("%s=%%s"%column)
+                params.append(int(value))
 
-        return self.sql("SELECT * FROM gatheredcells %s"%(sql))
+        return self.sql("SELECT * FROM gatheredcells %s"%("WHERE %s"%' AND '.join(limits) if limits else ""),params)
 
     def getnorwegian(self):
         """ 
@@ -395,9 +465,11 @@ class GlocDB:
 
         return self.sql("SELECT * FROM norwegiancells.sites;")
     
-    def sql(self, sql):
+    def sql(self, sql, params=None):
         """
-        Run a SQL-query against the database and return the result.
+        Run a SQL-query against the database and return the result. Values
+        should be passed in params and referred to as %s in the query, so
+        they are quoted by the database driver.
 
         @author: Brendan Johan Lee
         @contact: brendajl@simula.no
@@ -406,12 +478,257 @@ class GlocDB:
 
         @param sql: SQL-query to be run
         @type sql: str
+        @param params: values of the query parameters
+        @type params: tupple or list
+
+        @return: result of query
+        @rtype: list
+        """
+
+        def query(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+        return self.withcursor(query)
+
+    def prepared(self, name, params):
+        """
+        Run one of the statements in L{PREPARED} and return the result. The
+        statement is prepared on the server the first time it is used on a
+        connection, after that only its parameters are sent, and the server
+        reuses the plan.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @param name: name of statement in L{PREPARED}
+        @type name: str
+        @param params: values of the statement parameters
+        @type params: tupple or list
 
         @return: result of query
         @rtype: list
         """
-        self.cur.execute(sql)
-        return self.cur.fetchall()
+
+        def query(cur):
+            done = getattr(cur.connection, 'glocprepared', None)
+            if done is None:
+                done = cur.connection.glocprepared = set()
+            if name not in done:
+                cur.execute("PREPARE %s AS %s"%(name, PREPARED[name]))
+                done.add(name)
+            cur.execute("EXECUTE %s (%s)"%(name, ','.join(['%s']*len(params))), params)
+            return cur.fetchall()
+        return self.withcursor(query)
+
+    def stream(self, sql, params=None, itersize=None):
+        """
+        Run a SQL-query against the database and yield the resulting rows one
+        at a time. The query runs in a server side (named) cursor, so rows
+        are fetched in chunks of itersize instead of all at once, and the
+        full result never has to fit in memory.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @param sql: SQL-query to be run
+        @type sql: str
+        @param params: values of the query parameters, see L{sql}
+        @type params: tupple or list
+        @param itersize: number of rows fetched from the server at a time, defaults to the configured itersize
+        @type itersize: int
+
+        @return: rows of the result
+        @rtype: generator
+        """
+
+        itersize = itersize or getattr(self.conf, 'db_itersize', ITERSIZE)
+        if self.pool:
+            conn = self.pool.getconn()
+        else:
+            conn = self.cur.connection
+        self.streams += 1
+        cur = conn.cursor('glocstream%i'%self.streams)
+        broken = False
+        try:
+            cur.itersize = itersize
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = bool(conn.closed)
+            raise
+        finally:
+            if not conn.closed:
+                try:
+                    cur.close()
+                except psycopg2.Error:
+                    pass
+            if self.pool:
+                self.pool.putconn(conn, broken)
+            elif not conn.closed:
+                conn.rollback()
+
+    def columns(self, sql, fields, params=None):
+        """
+        Run a SQL-query and return the given columns of the result as a
+        structured numpy array instead of a list of rows. The result is
+        transferred with COPY TO STDOUT in binary format and read straight
+        into the array. NULL values become NaN in float columns and -1 in
+        integer columns.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @param sql: SQL-query to be run
+        @type sql: str
+        @param fields: names and numpy types ('f8', 'i4' or 'i8') of the columns to return, eg. L{POSITION_FIELDS}
+        @type fields: list of tupples
+        @param params: values of the query parameters, see L{sql}
+        @type params: tupple or list
+
+        @return: one record per row of the result
+        @rtype: numpy.ndarray
+        """
+
+        if numpy is None:
+            raise RuntimeError, ("numpy is needed for columnar results",)
+        def query(cur):
+            select = ','.join(["COALESCE((%s)::%s,%s)"%(name,COLUMN_TYPES[type][0],COLUMN_TYPES[type][1])
+                               for name,type in fields])
+            buf = StringIO()
+            cur.copy_expert("COPY (SELECT %s FROM (%s) AS q) TO STDOUT WITH BINARY"%(
+                    select, cur.mogrify(sql, params)), buf)
+            return buf.getvalue()
+        data = self.withcursor(query)
+
+        if data[:len(COPY_SIGNATURE)] != COPY_SIGNATURE:
+            raise RuntimeError, ("Unexpected COPY format",)
+        start = len(COPY_SIGNATURE)+8+struct.unpack('>i', data[len(COPY_SIGNATURE)+4:len(COPY_SIGNATURE)+8])[0]
+        # every tuple is a field count followed by length and value of each field
+        layout = [('count','>i2')]
+        for name,type in fields:
+            layout += [('length_'+name,'>i4'), (name,'>'+type)]
+        rows = numpy.frombuffer(data, numpy.dtype(layout), (len(data)-start-2)//numpy.dtype(layout).itemsize, start)
+        result = numpy.empty(len(rows), numpy.dtype([(name,type) for name,type in fields]))
+        for name,type in fields:
+            result[name] = rows[name]
+        return result
+
+    def extent(self, sql, params=None):
+        """
+        Return the bounding box of the positions of the rows of a SQL-query,
+        which must select latitude and longitude columns. The box is computed
+        by the database, the rows are never transferred.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @param sql: SQL-query selecting the rows
+        @type sql: str
+        @param params: values of the query parameters
+        @type params: tupple or list
+
+        @return: minimum latitude, minimum longitude, maximum latitude and
+                 maximum longitude, or None if no row has a position
+        @rtype: tupple
+        """
+
+        result = self.sql("SELECT min(latitude),min(longitude),max(latitude),max(longitude) "
+                          "FROM (%s) AS extent WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+                          % sql, params)
+        if not result or result[0][0] is None:
+            return None
+        return tuple([float(value) for value in result[0]])
+
+    def withcursor(self, operation):
+        """
+        Call operation with a database cursor and return its result. In pooled
+        mode the cursor belongs to a connection borrowed from the pool for the
+        duration of the call, so several threads can query at the same time.
+        Otherwise the shared cursor is used. If the connection turns out to be
+        broken it is replaced and the operation is retried once.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @param operation: function taking a cursor as its only argument
+        @type operation: function
+
+        @return: return value of operation
+        @rtype: any type
+        """
+
+        if not self.pool:
+            try:
+                return operation(self.cur)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if not self.cur.connection.closed:
+                    raise
+                self.cur = self.__getdbcursor__()
+                return operation(self.cur)
+
+        for attempt in (0, 1):
+            conn = self.pool.getconn()
+            try:
+                result = operation(conn.cursor())
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = bool(conn.closed)
+                self.pool.putconn(conn, broken)
+                if not broken or attempt:
+                    raise
+                continue
+            except:
+                self.pool.putconn(conn)
+                raise
+            self.pool.putconn(conn)
+            return result
+
+    def poolstats(self):
+        """
+        Return usage statistics of the connection pool, see L{ConnectionPool.stats}.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @return: pool statistics, or None when not running in pooled mode
+        @rtype: dict
+        """
+
+        if self.pool:
+            return self.pool.stats()
+        return None
+
+    def __getdsn__(self):
+        """
+        Return the connection string of the GLoc database.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @return: connection string
+        @rtype: str
+        """
+
+        return "dbname='%s' user='%s' password='%s' host='%s' port='%s'"%(
+                self.conf.db_name,self.conf.db_username,self.conf.db_password,self.conf.db_host,self.conf.db_port)
 
     def __getdbcursor__(self):
         """
@@ -425,6 +742,205 @@ class GlocDB:
         @return: Connetion to database
         @rtype: psycopg2.extras.DictConnection
         """
-        conn = psycopg2.extras.DictConnection("dbname='%s' user='%s' password='%s' host='%s' port='%s'"%(
-                self.conf.db_name,self.conf.db_username,self.conf.db_password,self.conf.db_host,self.conf.db_port))
+        conn = psycopg2.extras.DictConnection(self.__getdsn__())
         return conn.cursor()
+
+class ConnectionPool:
+    """
+    Thread safe pool of connections to the GLoc database. Connections are
+    opened when needed, up to the size of the pool. When all of them are in
+    use, callers wait until one is handed back.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+
+    @version: 1.0
+    """
+
+    def __init__(self, dsn, size):
+        """
+        Initialize ConnectionPool
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @param dsn: connection string of database
+        @type dsn: str
+        @param size: maximum number of open connections
+        @type size: int
+        """
+
+        self.dsn = dsn
+        self.size = size
+        self.free = []
+        self.condition = Condition()
+        self.opened = 0
+        self.inuse = 0
+        self.peak = 0
+        self.waits = 0
+        self.broken = 0
+
+    def getconn(self):
+        """
+        Borrow a connection from the pool, waiting if all are in use. Must be
+        handed back with L{putconn}.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @return: connection to database
+        @rtype: psycopg2.extras.DictConnection
+        """
+
+        self.condition.acquire()
+        try:
+            if not self.free and self.opened >= self.size:
+                self.waits += 1
+                while not self.free and self.opened >= self.size:
+                    self.condition.wait()
+            if self.free:
+                conn = self.free.pop()
+            else:
+                conn = None
+                self.opened += 1
+            self.inuse += 1
+            self.peak = max(self.peak, self.inuse)
+        finally:
+            self.condition.release()
+
+        if conn is None:
+            try:
+                conn = psycopg2.extras.DictConnection(self.dsn)
+            except:
+                self.putconn(None)
+                raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        """
+        Hand a connection back to the pool. Broken connections are closed and
+        replaced by a new one the next time a connection is needed.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @param conn: connection borrowed with L{getconn}
+        @type conn: psycopg2.extras.DictConnection
+        @param broken: True if the connection should not be reused
+        @type broken: bool
+        """
+
+        if conn is not None and not broken:
+            try:
+                conn.rollback() # end the transaction started by the borrower
+            except psycopg2.Error:
+                broken = True
+        if conn is not None and broken:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+            conn = None
+
+        self.condition.acquire()
+        try:
+            self.inuse -= 1
+            if broken:
+                self.broken += 1
+            if conn is None:
+                self.opened -= 1
+            else:
+                self.free.append(conn)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def stats(self):
+        """
+        Return usage statistics of the pool: its size, the number of open
+        connections, connections currently in use, the highest number in
+        use at once, how many times a caller had to wait for a connection
+        and how many broken connections were thrown away.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+
+        @return: statistics
+        @rtype: dict
+        """
+
+        self.condition.acquire()
+        try:
+            return {'size': self.size, 'opened': self.opened, 'inuse': self.inuse,
+                    'peak': self.peak, 'waits': self.waits, 'broken': self.broken}
+        finally:
+            self.condition.release()
+
+    def closeall(self):
+        """
+        Close all connections not currently in use.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+
+        @version: 1.0
+        """
+
+        self.condition.acquire()
+        try:
+            for conn in self.free:
+                conn.close()
+            self.opened -= len(self.free)
+            self.free = []
+        finally:
+            self.condition.release()
+
+if __name__ == "__main__":
+    # Benchmarks, run against observations already in the database:
+    #   glocdb.py batch [count]    - batched fingerprint lookup vs. the per call path
+    #   glocdb.py prepared [count] - prepared statements vs. plain parameterized queries
+    import sys, time
+    from map.mapConf import MapConf
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'batch'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    db = GlocDB(MapConf())
+    observations = [(r['mcc'],r['mnc'],r['la'],r['cellid'],r['rxlev']) for r in db.sql(
+        "SELECT c.mcc,c.mnc,c.la,c.cellid,o.rxlev FROM gatheredcellobservations AS o "
+        "JOIN gatheredcells AS c ON o.cid=c.cid ORDER BY random() LIMIT %s",(count,))]
+    print "%i observations" % len(observations)
+    if mode == 'prepared':
+        import re
+        arguments = {'getcid': [o[:4] for o in observations],
+                     'closestgsm': [(db.getCid(*o[:4]),o[4]) for o in observations]}
+        for name in ('getcid','closestgsm'):
+            plain = re.sub(r'\$(\d)', r'%(p\1)s', PREPARED[name])
+            start = time.time()
+            for args in arguments[name]:
+                db.sql(plain, dict([('p%i'%(i+1),a) for i,a in enumerate(args)]))
+            plaintime = time.time()-start
+            start = time.time()
+            for args in arguments[name]:
+                db.prepared(name, args)
+            preparedtime = time.time()-start
+            print "%s plain:    %.3fms per call" % (name, 1000*plaintime/max(len(observations),1))
+            print "%s prepared: %.3fms per call" % (name, 1000*preparedtime/max(len(observations),1))
+            print "%s planning saved: %.3fms per call" % (name, 1000*(plaintime-preparedtime)/max(len(observations),1))
+    else:
+        start = time.time()
+        single = [db.getClosestGSMmatch(*o) for o in observations]
+        singletime = time.time()-start
+        start = time.time()
+        batched = db.getClosestGSMmatches(observations)
+        batchtime = time.time()-start
+        print "per call: %.3fs (%.3fms per observation)" % (singletime, 1000*singletime/max(len(observations),1))
+        print "batched:  %.3fs (%.3fms per observation)" % (batchtime, 1000*batchtime/max(len(observations),1))
+        print "diff mismatches: %i" % len([1 for s,b in zip(single,batched)
+                                           if (s and s[0]['diff']) != (b and b['diff'])])
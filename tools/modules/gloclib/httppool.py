@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+"""
+ Pool of persistent HTTP connections, used to download map tiles without
+ setting up a new TCP connection for every tile.
+
+ Also provides a stand-in tile server, to test and benchmark tile
+ downloading without a map service.
+
+ @author: Brendan Johan Lee
+ @contact: brendajl@simula.no
+ @version: 1.0
+"""
+## GNU General Public Licence (GPL)
+
+## This program is free software; you can redistribute it and / or modify it under
+## the terms of the GNU General Public License as published by the Free Software
+## Foundation; either version 2 of the License,  or (at your option) any later
+## version.
+## This program is distributed in the hope that it will be useful,  but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+## FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+## details.
+## You should have received a copy of the GNU General Public License along with
+## this program; if not,  write to the Free Software Foundation,  Inc.,  59 Temple
+## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
+
+import gzip
+import time
+import hashlib
+import socket
+import httplib
+import urlparse
+import threading
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from openanything import USER_AGENT
+
+# seconds to wait for a tile server
+TIMEOUT = 30
+# redirects followed before giving up
+MAX_REDIRECTS = 5
+
+class HTTPPool:
+    """
+    Persistent HTTP connections, one per thread and host. Every thread
+    downloading tiles reuses its connections to the hosts it has talked to,
+    which saves a TCP handshake (and slow start) per tile. Connections the
+    server has closed are replaced transparently.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, timeout=TIMEOUT, agent=USER_AGENT):
+        """
+        Initialize HTTPPool
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param timeout: seconds to wait for a server
+        @type timeout: float
+        @param agent: User-Agent header sent with requests
+        @type agent: str
+        """
+
+        self.timeout = timeout
+        self.agent = agent
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # every connection opened, so they can be closed from any thread
+        self.connections = []
+        self.opened = 0
+        self.requests = 0
+        self.reused = 0
+
+    def fetch(self, url, etag=None, lastmodified=None):
+        """
+        Fetch a URL over a pooled connection. Returns the same dict as
+        L{openanything.fetch}: data, status, etag, lastmodified and url.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param url: http URL to fetch
+        @type url: str
+        @param etag: ETag of a cached copy, sent as If-None-Match
+        @type etag: str
+        @param lastmodified: Last-Modified of a cached copy, sent as If-Modified-Since
+        @type lastmodified: str
+
+        @return: data and metadata of the response
+        @rtype: dict
+        """
+
+        for redirect in xrange(MAX_REDIRECTS + 1):
+            response, data = self.__request__(url, etag, lastmodified)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            break
+        result = {'data': data,
+                  'status': response.status,
+                  'etag': response.getheader('etag'),
+                  'lastmodified': response.getheader('last-modified'),
+                  'url': url}
+        if response.getheader('content-encoding') == 'gzip':
+            # data came back gzip-compressed, decompress it
+            result['data'] = gzip.GzipFile(fileobj=StringIO(data)).read()
+        return result
+
+    def close(self):
+        """
+        Close the connections of the calling thread.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        for key in self.__connections__().keys():
+            self.__drop__(key)
+
+    def closeall(self):
+        """
+        Close the connections of all threads.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        self.lock.acquire()
+        try:
+            connections = self.connections
+            self.connections = []
+        finally:
+            self.lock.release()
+        for conn in connections:
+            conn.close()
+
+    def stats(self):
+        """
+        Return usage statistics of the pool: requests made, connections
+        opened and requests sent over a connection that was already open.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: statistics
+        @rtype: dict
+        """
+
+        self.lock.acquire()
+        try:
+            return {'requests': self.requests,
+                    'opened': self.opened,
+                    'reused': self.reused}
+        finally:
+            self.lock.release()
+
+    def __connections__(self):
+        """
+        Return the connections of the calling thread by (scheme, host).
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: connections
+        @rtype: dict
+        """
+
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        return connections
+
+    def __drop__(self, key):
+        """
+        Close and forget a connection of the calling thread.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param key: scheme and host of connection
+        @type key: tupple
+        """
+
+        conn = self.__connections__().pop(key, None)
+        if conn is not None:
+            conn.close()
+            self.lock.acquire()
+            try:
+                if conn in self.connections:
+                    self.connections.remove(conn)
+            finally:
+                self.lock.release()
+
+    def __request__(self, url, etag, lastmodified):
+        """
+        Send a GET request over the connection of the calling thread to the
+        host of the URL, opening one if needed. A kept connection the server
+        has closed in the mean time is replaced and the request sent again.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param url: http URL to fetch
+        @type url: str
+        @param etag: ETag of a cached copy
+        @type etag: str
+        @param lastmodified: Last-Modified of a cached copy
+        @type lastmodified: str
+
+        @return: response and its body
+        @rtype: tupple
+        """
+
+        scheme, host, path, params, query, fragment = urlparse.urlparse(url)
+        selector = path or '/'
+        if params:
+            selector += ';' + params
+        if query:
+            selector += '?' + query
+        headers = {'User-Agent': self.agent, 'Accept-encoding': 'gzip'}
+        if etag:
+            headers['If-None-Match'] = etag
+        if lastmodified:
+            headers['If-Modified-Since'] = lastmodified
+
+        key = (scheme, host)
+        connections = self.__connections__()
+        while True:
+            conn = connections.get(key)
+            fresh = conn is None
+            if fresh:
+                if scheme == 'https':
+                    conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+                else:
+                    conn = httplib.HTTPConnection(host, timeout=self.timeout)
+                connections[key] = conn
+                self.lock.acquire()
+                try:
+                    self.connections.append(conn)
+                    self.opened += 1
+                finally:
+                    self.lock.release()
+            try:
+                conn.request('GET', selector, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.__drop__(key)
+                if fresh:
+                    raise
+                # the server closed the kept connection, try a new one
+                continue
+            self.lock.acquire()
+            try:
+                self.requests += 1
+                if not fresh:
+                    self.reused += 1
+            finally:
+                self.lock.release()
+            if response.will_close:
+                self.__drop__(key)
+            return response, data
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET with the tile of the server, after its latency, or
+    with 304 Not Modified if the request has the ETag of the tile.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # buffer the response and send it at once, a response written line by
+    # line stalls on delayed acknowledgements over a kept connection
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """
+        Send the tile.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.headers.get('if-none-match') == self.server.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.server.tile)))
+        self.end_headers()
+        self.wfile.write(self.server.tile)
+
+    def log_message(self, format, *args):
+        pass
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    """
+    Stand-in tile server on localhost, for testing and benchmarking tile
+    downloads. Serves the same tile for every URL, optionally after an
+    artificial latency.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # room for the many simultaneous connects of the async downloader
+    request_queue_size = 1024
+
+    def __init__(self, port=0, latency=0.0, tile='\x89PNG\r\n\x1a\n' + '\0' * 20000):
+        """
+        Initialize TileServer and start serving in a thread of its own.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param port: port to listen on, 0 picks a free one
+        @type port: int
+        @param latency: seconds to wait before answering a request
+        @type latency: float
+        @param tile: data served as tile
+        @type tile: str
+        """
+
+        HTTPServer.__init__(self, ('127.0.0.1', port), TileRequestHandler)
+        self.latency = latency
+        self.tile = tile
+        self.etag = '"%s"' % hashlib.md5(tile).hexdigest()
+        self.port = self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def url(self, path='/'):
+        """
+        Return the URL of a path on the server.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param path: path on the server
+        @type path: str
+
+        @return: URL
+        @rtype: str
+        """
+
+        return 'http://127.0.0.1:%i%s' % (self.port, path)
+
+    def close(self):
+        """
+        Stop serving and close the listening socket.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    # Benchmark against stand-in tile servers, one per mt0..mt3 shard host:
+    #   httppool.py [tiles] [threads] [latency]
+    import sys
+    import openanything
+    tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    servers = [TileServer(latency=latency) for i in range(4)]
+
+    def run(fetch):
+        def work(n):
+            for i in xrange(n):
+                # rotate through the shards like MapServ.get_url_from_coord
+                result = fetch(servers[i % len(servers)].url('/vt?x=%i&y=%i&z=5' % (i, n)))
+                assert result['status'] == 200
+        workers = [threading.Thread(target=work, args=(tiles // threads,)) for i in range(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return (tiles // threads) * threads / (time.time() - start)
+
+    pool = HTTPPool()
+    print "%i tiles, %i threads, %.3fs latency" % (tiles, threads, latency)
+    print "openanything: %8.1f tiles/s" % run(openanything.fetch)
+    print "httppool:     %8.1f tiles/s" % run(pool.fetch)
+    print "httppool stats:", pool.stats()
+    pool.closeall()
+    for server in servers:
+        server.close()
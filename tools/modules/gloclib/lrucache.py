@@ -29,14 +29,21 @@ discarded. [1]_
 
 .. [1]: 'Discarded' here means 'removed from the cache'.
 
+`LRUCache` keeps its records in a dictionary and a doubly linked list
+ordered by access, so lookups, insertions and evictions are O(1).
+`ThreadSafeLRUCache` is the same cache guarded by a lock, for caches
+shared between threads. The original heap based implementation, where
+every access re-heapifies the cache, is kept as `HeapLRUCache`.
+
 """
 
 from __future__ import generators
 import time
+import threading
 from heapq import heappush, heappop, heapify
 
-__version__ = "0.2"
-__all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE']
+__version__ = "0.3"
+__all__ = ['CacheKeyError', 'LRUCache', 'ThreadSafeLRUCache', 'HeapLRUCache', 'DEFAULT_SIZE']
 __docformat__ = 'reStructuredText en'
 
 DEFAULT_SIZE = 16
@@ -88,6 +95,242 @@ class LRUCache(object):
 
     for j in cache:   # iterate (in LRU order)
         print j, cache[j] # iterator produces keys, not values
+
+    Records are kept in a dictionary and in a circular doubly linked list in
+    order of access, most recently used last, so every operation is O(1).
+
+    By default every record counts as one towards the size of the cache.
+    Given a 'sizeof' function, records count as what it returns for their
+    value instead, for instance to bound a cache by bytes::
+
+    cache = LRUCache(64 << 20, sizeof=len) # at most 64 MB of strings
+    """
+
+    class __Node(object):
+        """Record of a cached value. Not for public consumption."""
+
+        __slots__ = ('prev', 'next', 'key', 'obj', 'mtime', 'weight')
+
+        def __init__(self, key=None, obj=None, timestamp=None, weight=0):
+            object.__init__(self)
+            self.prev = self
+            self.next = self
+            self.key = key
+            self.obj = obj
+            self.mtime = timestamp
+            self.weight = weight
+
+        def __repr__(self):
+            return "<%s %s => %s (%s)>" % \
+                   (self.__class__, self.key, self.obj, \
+                    time.asctime(time.localtime(self.mtime)))
+
+    def __init__(self, size=DEFAULT_SIZE, sizeof=None):
+        # Check arguments
+        if size <= 0:
+            raise ValueError, size
+        elif type(size) is not type(0) and type(size) is not type(0L):
+            raise TypeError, size
+        object.__init__(self)
+        self.__dict = {}
+        # sentinel of the list, next is the least recently used record
+        self.__root = self.__Node()
+        self.sizeof = sizeof
+        """Function returning the size of a value, None counts records."""
+        self.used = 0
+        """Total size of the records in the cache."""
+        self.evictions = 0
+        """Number of records discarded to make room for others."""
+        self.size = size
+        """Maximum size of the cache.
+        If more than 'size' elements are added to the cache,
+        the least-recently-used ones will be discarded."""
+
+    def __len__(self):
+        return len(self.__dict)
+
+    def __contains__(self, key):
+        return key in self.__dict
+
+    def __setitem__(self, key, obj):
+        if self.sizeof is None:
+            weight = 1
+        else:
+            weight = self.sizeof(obj)
+        node = self.__dict.get(key)
+        if node is not None:
+            node.obj = obj
+            node.mtime = time.time()
+            self.used += weight - node.weight
+            node.weight = weight
+            self.__touch(node)
+            while self.used > self.size and self.__root.next is not node:
+                self.__discard()
+        else:
+            # size may have been reset, so we loop
+            while self.__dict and self.used + weight > self.size:
+                self.__discard()
+            node = self.__Node(key, obj, time.time(), weight)
+            self.__dict[key] = node
+            self.__append(node)
+            self.used += weight
+
+    def __getitem__(self, key):
+        node = self.__dict.get(key)
+        if node is None:
+            raise CacheKeyError(key)
+        self.__touch(node)
+        return node.obj
+
+    def __delitem__(self, key):
+        node = self.__dict.pop(key, None)
+        if node is None:
+            raise CacheKeyError(key)
+        self.__unlink(node)
+        self.used -= node.weight
+        return node.obj
+
+    def __iter__(self):
+        # iterate over a copy, looking records up while iterating reorders them
+        keys = []
+        root = self.__root
+        node = root.next
+        while node is not root:
+            keys.append(node.key)
+            node = node.next
+        return iter(keys)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # automagically shrink cache on resize
+        if name == 'size':
+            while self.used > value:
+                self.__discard()
+
+    def __repr__(self):
+        return "<%s (%d elements)>" % (str(self.__class__), len(self.__dict))
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if it is not cached.
+        Unlike a membership test followed by a lookup, this is a single
+        operation, which matters for caches shared between threads."""
+        node = self.__dict.get(key)
+        if node is None:
+            return default
+        self.__touch(node)
+        return node.obj
+
+    def mtime(self, key):
+        """Return the last modification time for the cache record with key.
+        May be useful for cache instances where the stored values can get
+        'stale', such as caching file or network resource contents."""
+        node = self.__dict.get(key)
+        if node is None:
+            raise CacheKeyError(key)
+        return node.mtime
+
+    def __append(self, node):
+        root = self.__root
+        last = root.prev
+        node.prev = last
+        node.next = root
+        last.next = node
+        root.prev = node
+
+    def __unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def __touch(self, node):
+        if node.next is not self.__root:
+            self.__unlink(node)
+            self.__append(node)
+
+    def __discard(self):
+        lru = self.__root.next
+        self.__unlink(lru)
+        del self.__dict[lru.key]
+        self.used -= lru.weight
+        self.evictions += 1
+
+class ThreadSafeLRUCache(LRUCache):
+    """`LRUCache` that can be shared between threads. Every operation holds
+    a lock; use `get` rather than a membership test followed by a lookup,
+    as another thread may discard the record in between."""
+
+    def __init__(self, size=DEFAULT_SIZE, sizeof=None):
+        object.__setattr__(self, '_ThreadSafeLRUCache__lock', threading.RLock())
+        LRUCache.__init__(self, size, sizeof)
+
+    def __len__(self):
+        self.__lock.acquire()
+        try:
+            return LRUCache.__len__(self)
+        finally:
+            self.__lock.release()
+
+    def __contains__(self, key):
+        self.__lock.acquire()
+        try:
+            return LRUCache.__contains__(self, key)
+        finally:
+            self.__lock.release()
+
+    def __setitem__(self, key, obj):
+        self.__lock.acquire()
+        try:
+            LRUCache.__setitem__(self, key, obj)
+        finally:
+            self.__lock.release()
+
+    def __getitem__(self, key):
+        self.__lock.acquire()
+        try:
+            return LRUCache.__getitem__(self, key)
+        finally:
+            self.__lock.release()
+
+    def __delitem__(self, key):
+        self.__lock.acquire()
+        try:
+            return LRUCache.__delitem__(self, key)
+        finally:
+            self.__lock.release()
+
+    def __iter__(self):
+        self.__lock.acquire()
+        try:
+            return LRUCache.__iter__(self)
+        finally:
+            self.__lock.release()
+
+    def __setattr__(self, name, value):
+        self.__lock.acquire()
+        try:
+            LRUCache.__setattr__(self, name, value)
+        finally:
+            self.__lock.release()
+
+    def get(self, key, default=None):
+        self.__lock.acquire()
+        try:
+            return LRUCache.get(self, key, default)
+        finally:
+            self.__lock.release()
+
+    def mtime(self, key):
+        self.__lock.acquire()
+        try:
+            return LRUCache.mtime(self, key)
+        finally:
+            self.__lock.release()
+
+class HeapLRUCache(object):
+    """Least-Recently-Used (LRU) cache, the original implementation.
+
+    Keeps its records in a heap ordered by access time, which is
+    re-heapified on every access, making lookups O(n). Kept for comparison
+    with `LRUCache`, which has the same interface.
     """
 
     class __Node(object):
@@ -191,7 +434,40 @@ class LRUCache(object):
             node = self.__dict[key]
             return node.mtime
 
+def benchmark(cls, size, ops=1000):
+    """Return the mean hit and miss latency in microseconds of a full cache
+    of the given class and size. A miss is a failed lookup followed by
+    inserting the record, which discards the least recently used one."""
+    import random
+    cache = cls(size)
+    for i in xrange(size):
+        cache[i] = i
+    keys = [random.randrange(size) for i in xrange(ops)]
+    start = time.time()
+    for key in keys:
+        cache[key]
+    hit = (time.time()-start)/ops*1e6
+    start = time.time()
+    for key in xrange(size, size+ops):
+        if key not in cache:
+            cache[key] = key
+    miss = (time.time()-start)/ops*1e6
+    return hit, miss
+
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        print "%8s %-18s %12s %12s" % ('entries', 'cache', 'hit (us)', 'miss (us)')
+        for size in (1000, 10000, 100000):
+            for cls in (HeapLRUCache, LRUCache, ThreadSafeLRUCache):
+                # heap lookups are O(n), keep its run time down on big caches
+                ops = 1000
+                if cls is HeapLRUCache:
+                    ops = min(ops, 10000000/size)
+                hit, miss = benchmark(cls, size, ops)
+                print "%8i %-18s %12.2f %12.2f" % (size, cls.__name__, hit, miss)
+        sys.exit(0)
+
     cache = LRUCache(25)
     print cache
     for i in range(50):
@@ -0,0 +1,802 @@
+"""
+ Event driven map tile downloader for the glocalizer (gloc map GUI) project.
+ One thread multiplexes many kept HTTP/1.1 connections with asyncore, so
+ hundreds of tile requests can be in flight without a thread for each.
+
+ @author: Brendan Johan Lee
+ @contact: brendajl@simula.no
+ @version: 1.0
+"""
+## GNU General Public Licence (GPL)
+
+## This program is free software; you can redistribute it and / or modify it under
+## the terms of the GNU General Public License as published by the Free Software
+## Foundation; either version 2 of the License,  or (at your option) any later
+## version.
+## This program is distributed in the hope that it will be useful,  but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+## FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+## details.
+## You should have received a copy of the GNU General Public License along with
+## this program; if not,  write to the Free Software Foundation,  Inc.,  59 Temple
+## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
+
+import os
+import sys
+import time
+import socket
+import asyncore
+import asynchat
+import urlparse
+from threading import Thread
+from Queue import Empty
+from collections import deque
+from traceback import print_exc
+
+from map.mapDownloader import MapDownloader, TileQueue
+from map.mapConst import *
+from gloclib.httppool import TIMEOUT, MAX_REDIRECTS
+from gloclib.openanything import USER_AGENT
+
+# longest the event loop sleeps before checking for timed out requests
+LOOP_TIMEOUT = 1.0
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Pipe waking up the event loop when another thread queues a task.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, socket_map):
+        """
+        Initialize Trigger
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param socket_map: channels of the event loop
+        @type socket_map: dict
+        """
+
+        r, self.w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, socket_map)
+        # file_dispatcher keeps a duplicate of the descriptor
+        os.close(r)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(512)
+
+    def pull(self):
+        """
+        Wake up the event loop, may be called from any thread.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        try:
+            os.write(self.w, 'x')
+        except OSError:
+            pass
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.w)
+
+class TileConnection(asynchat.async_chat):
+    """
+    Kept HTTP/1.1 connection to one tile server, sending one request at a
+    time. Responses are handed back to the AsyncMapDownloader.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, engine, host, address):
+        """
+        Initialize TileConnection and start connecting.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param engine: downloader the connection belongs to
+        @type engine: AsyncMapDownloader
+        @param host: host and port as in the URLs of the server
+        @type host: str
+        @param address: socket address of the server
+        @type address: tupple
+        """
+
+        asynchat.async_chat.__init__(self, map=engine.socket_map)
+        self.engine = engine
+        self.host = host
+        self.request = None
+        # requests answered over this connection
+        self.used = 0
+        self.received = 0
+        self.keep = True
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect(address)
+
+    def send_request(self, request):
+        """
+        Send a GET request over the connection.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param request: task, URL, redirects followed and whether it is a retry
+        @type request: tupple
+        """
+
+        self.request = request
+        self.deadline = time.time() + self.engine.timeout
+        self.received = 0
+        self.buffer = []
+        self.state = 'headers'
+        self.set_terminator('\r\n\r\n')
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(request[1])
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+        conditions = ''
+        meta = request[0].meta
+        if meta is not None:
+            # revalidating a stored tile, see MapServ.store_response()
+            if meta.get('etag'):
+                conditions += 'If-None-Match: %s\r\n' % meta['etag']
+            if meta.get('lastmodified'):
+                conditions += 'If-Modified-Since: %s\r\n' % meta['lastmodified']
+        self.push('GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\n%s\r\n'
+                  % (selector, netloc, USER_AGENT, conditions))
+
+    def handle_connect(self):
+        pass
+
+    def collect_incoming_data(self, data):
+        self.received += len(data)
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        """
+        Parse the part of the response read up to the terminator.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        data = ''.join(self.buffer)
+        self.buffer = []
+        if self.request is None:
+            # nothing was asked, the server is misbehaving
+            raise IOError, ("unexpected data from %s" % self.host,)
+        if self.state == 'headers':
+            self.__headers__(data)
+        elif self.state == 'body':
+            self.body.append(data)
+            self.__finish__()
+        elif self.state == 'size':
+            size = int(data.split(';')[0].strip(), 16)
+            if size:
+                # chunk data followed by its CRLF
+                self.state = 'chunk'
+                self.set_terminator(size + 2)
+            else:
+                self.state = 'trailer'
+                self.set_terminator('\r\n')
+        elif self.state == 'chunk':
+            self.body.append(data[:-2])
+            self.state = 'size'
+            self.set_terminator('\r\n')
+        elif self.state == 'trailer':
+            if not data:
+                self.__finish__()
+
+    def handle_close(self):
+        if self.request is not None and self.state == 'close':
+            # the body lasts until the server closes the connection
+            self.body.append(''.join(self.buffer))
+            self.__finish__()
+        else:
+            self.__lost__('connection closed')
+
+    def handle_error(self):
+        self.__lost__(str(sys.exc_info()[1]))
+
+    def expire(self, now):
+        """
+        Give up the request if it has been waiting too long.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param now: current time
+        @type now: float
+        """
+
+        if self.request is not None and self.deadline < now:
+            self.__lost__('timed out')
+
+    def __headers__(self, data):
+        """
+        Parse the status line and headers, and decide how to read the body.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param data: status line and headers
+        @type data: str
+        """
+
+        lines = data.split('\r\n')
+        version, status = lines[0].split(None, 2)[:2]
+        self.status = int(status)
+        self.headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        connection = self.headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep = connection != 'close'
+        else:
+            self.keep = connection == 'keep-alive'
+        self.body = []
+
+        if 100 <= self.status < 200:
+            # interim response, the real one follows
+            self.set_terminator('\r\n\r\n')
+        elif self.status in (204, 304):
+            self.__finish__()
+        elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self.state = 'size'
+            self.set_terminator('\r\n')
+        elif 'content-length' in self.headers:
+            length = int(self.headers['content-length'])
+            if length:
+                self.state = 'body'
+                self.set_terminator(length)
+            else:
+                self.__finish__()
+        else:
+            self.state = 'close'
+            self.keep = False
+            self.set_terminator(None)
+
+    def __finish__(self):
+        """
+        Hand the complete response to the downloader.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        request = self.request
+        self.request = None
+        self.used += 1
+        self.set_terminator(None)
+        if not self.keep:
+            self.close()
+        self.engine.__response__(self, request, self.status, self.headers, ''.join(self.body))
+
+    def __lost__(self, reason):
+        """
+        Close the connection after an error and tell the downloader.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param reason: what went wrong
+        @type reason: str
+        """
+
+        request = self.request
+        self.request = None
+        self.keep = False
+        self.close()
+        # a kept connection the server closed before answering may be retried
+        stale = self.used > 0 and self.received == 0
+        self.engine.__lost__(self, request, reason, stale)
+
+class AsyncMapDownloader(MapDownloader):
+    """
+    MapDownloader downloading with one event driven thread instead of a
+    pool of threads. Requests are spread over kept connections, at most
+    host_connections per tile server and connections in total, and queued
+    per server beyond that.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, ctx_map, connections=ASYNC_CONNECTIONS,
+                 host_connections=ASYNC_HOST_CONNECTIONS, timeout=TIMEOUT,
+                 prefetch_limit=PREFETCH_QUEUE):
+        """
+        Initialize AsyncMapDownloader and start its event loop.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param ctx_map: mapserver
+        @type ctx_map: MapServ
+        @param connections: most connections open at a time
+        @type connections: int
+        @param host_connections: most connections open to one tile server
+        @type host_connections: int
+        @param timeout: seconds to wait for a tile server
+        @type timeout: float
+        @param prefetch_limit: most prefetch tasks queued or downloading at a time
+        @type prefetch_limit: int
+        """
+
+        self.ctx_map = ctx_map
+        self.connections = max(1, connections)
+        self.host_connections = max(1, host_connections)
+        self.timeout = timeout
+        self.taskq = TileQueue(0)
+        self.init_inflight(prefetch_limit)
+        self.socket_map = {}
+        # requests waiting for a connection, by host
+        self.pending = {}
+        # open and idle connections, by host
+        self.open = {}
+        self.idle = {}
+        self.total = 0
+        # socket addresses by host
+        self.addresses = {}
+        self.counters = {'requests': 0, 'opened': 0, 'reused': 0, 'failed': 0, 'peak': 0}
+        self.running = True
+        self.trigger = Trigger(self.socket_map)
+        self.thread = Thread(target=self.__loop__)
+        self.thread.setDaemon(True)
+        self.threads = [self.thread]
+        self.thread.start()
+
+    def put_task(self, task):
+        """
+        Hand a task to the event loop.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: task to perform
+        @type task: DownloadTask
+        """
+
+        self.taskq.put(task)
+        self.trigger.pull()
+
+    def stop_all(self):
+        """
+        Stop all downloads, dropping the requests in flight.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        if not self.threads:
+            return
+        while not self.taskq.empty():
+            self.taskq.get_nowait() # clear the queue
+        self.inflight.clear()
+        self.running = False
+        self.trigger.pull()
+        print ".",
+        self.thread.join(5)
+        self.threads = []
+
+    def qsize(self):
+        """
+        Return the approximate number of tasks not yet finished.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        return self.taskq.unfinished_tasks
+
+    def stats(self):
+        """
+        Return the counters of the downloader: those of MapDownloader.stats(),
+        requests answered, connections opened, requests sent over a kept
+        connection, requests failed and the most requests in flight at a time.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: counters
+        @rtype: dict
+        """
+
+        stats = MapDownloader.stats(self)
+        stats.update(self.counters)
+        return stats
+
+    def __loop__(self):
+        """
+        Event loop, runs in the thread of the downloader.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        while self.running:
+            self.__take__()
+            asyncore.loop(LOOP_TIMEOUT, False, self.socket_map, 1)
+            now = time.time()
+            for conns in self.open.values():
+                for conn in conns[:]:
+                    conn.expire(now)
+        for channel in self.socket_map.values():
+            channel.close()
+
+    def __take__(self):
+        """
+        Start the tasks queued by other threads. Only as many tasks are taken
+        as there may be connections, the others stay in the TileQueue so the
+        most urgent are taken next.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        # tasks taken and not yet done
+        while self.running and self.taskq.unfinished_tasks - self.taskq.qsize() < self.connections:
+            try:
+                task = self.taskq.get_nowait()
+            except Empty:
+                return
+            try:
+                self.__start__(task)
+            except:
+                print_exc() # but don't die
+                self.__done__(task)
+
+    def __start__(self, task):
+        """
+        Finish a task whose tile is already stored, otherwise queue the
+        download of the tile. A forced update of a stale tile queues its
+        revalidation.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: task to perform
+        @type task: DownloadTask
+        """
+
+        if self.ctx_map.is_read_only():
+            self.__done__(task)
+            return
+        if self.ctx_map.get_file(task.coord, task.layer, False, False,
+                                 task.mapServ, task.styleID):
+            meta = self.ctx_map.get_tile_meta(task.coord, task.layer, task.mapServ)
+            if not (task.force_update and self.ctx_map.is_stale(meta)):
+                self.__done__(task)
+                return
+            task.meta = meta
+        url = self.ctx_map.get_url_from_coord(task.coord, task.layer, task.mapServ, task.styleID)
+        if not url:
+            self.__done__(task)
+            return
+        print 'downloading:', url
+        self.__queue__((task, url, 0, False))
+
+    def __queue__(self, request, first=False):
+        """
+        Queue a request for a connection to its host.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param request: task, URL, redirects followed and whether it is a retry
+        @type request: tupple
+        @param first: put the request in front of the others
+        @type first: bool
+        """
+
+        scheme, host = urlparse.urlsplit(request[1])[:2]
+        if scheme != 'http':
+            self.__fail__(request[0], 'unsupported URL %s' % request[1])
+            return
+        queue = self.pending.setdefault(host.lower(), deque())
+        if first:
+            queue.appendleft(request)
+        else:
+            queue.append(request)
+        self.__dispatch__(host.lower())
+
+    def __dispatch__(self, host):
+        """
+        Send the queued requests of a host over idle or new connections,
+        as far as the connection limits allow.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param host: host and port of the tile server
+        @type host: str
+        """
+
+        queue = self.pending.get(host)
+        while queue:
+            idle = self.idle.get(host)
+            if idle:
+                conn = idle.pop()
+                self.counters['reused'] += 1
+                conn.send_request(queue.popleft())
+            elif len(self.open.get(host, ())) < self.host_connections and self.__room__():
+                request = queue.popleft()
+                try:
+                    conn = TileConnection(self, host, self.__address__(host))
+                except (socket.error, ValueError), e:
+                    self.__fail__(request[0], str(e))
+                    continue
+                self.open.setdefault(host, []).append(conn)
+                self.total += 1
+                self.counters['opened'] += 1
+                conn.send_request(request)
+            else:
+                break
+        if not queue:
+            self.pending.pop(host, None)
+        inflight = self.total - sum([len(idle) for idle in self.idle.values()])
+        self.counters['peak'] = max(self.counters['peak'], inflight)
+
+    def __room__(self):
+        """
+        Returns true if another connection may be opened, closing an idle
+        connection to another host if needed.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: whether a connection may be opened
+        @rtype: bool
+        """
+
+        if self.total < self.connections:
+            return True
+        for idle in self.idle.values():
+            if idle:
+                conn = idle.pop()
+                conn.close()
+                self.__forget__(conn)
+                return True
+        return False
+
+    def __address__(self, host):
+        """
+        Returns the socket address of a host, resolving it only once.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param host: host and port of the tile server
+        @type host: str
+
+        @return: address and port
+        @rtype: tupple
+        """
+
+        address = self.addresses.get(host)
+        if address is None:
+            hostname, sep, port = host.partition(':')
+            address = (socket.gethostbyname(hostname), int(port or 80))
+            self.addresses[host] = address
+        return address
+
+    def __forget__(self, conn):
+        """
+        Remove a closed connection from the bookkeeping.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param conn: the closed connection
+        @type conn: TileConnection
+        """
+
+        conns = self.open.get(conn.host, [])
+        if conn in conns:
+            conns.remove(conn)
+            self.total -= 1
+        idle = self.idle.get(conn.host, [])
+        if conn in idle:
+            idle.remove(conn)
+
+    def __release__(self, conn):
+        """
+        Give a connection whose request is answered the next request
+        of its host, or keep it idle.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param conn: the connection
+        @type conn: TileConnection
+        """
+
+        queue = self.pending.get(conn.host)
+        if queue:
+            self.counters['reused'] += 1
+            conn.send_request(queue.popleft())
+            if not queue:
+                del self.pending[conn.host]
+        else:
+            self.idle.setdefault(conn.host, []).append(conn)
+
+    def __response__(self, conn, request, status, headers, data):
+        """
+        Handle a response: follow a redirect, or store the tile, or mark
+        the stored tile as fresh if it has not changed.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        task, url, redirects, retried = request
+        self.counters['requests'] += 1
+        location = headers.get('location')
+        if status in (301, 302, 303, 307) and location and redirects < MAX_REDIRECTS:
+            self.__queue__((task, urlparse.urljoin(url, location), redirects + 1, retried))
+        elif status == 200 or (status == 304 and task.meta is not None):
+            try:
+                self.ctx_map.store_response(task.coord, task.layer, task.mapServ, status, data,
+                                            headers.get('etag'), headers.get('last-modified'),
+                                            task.meta)
+            except:
+                print_exc()
+            self.__done__(task)
+        else:
+            self.__fail__(task, "HTTP Reponse is: %i" % status)
+        if conn.keep:
+            self.__release__(conn)
+        else:
+            self.__forget__(conn)
+            self.__dispatch_all__()
+
+    def __lost__(self, conn, request, reason, stale):
+        """
+        Handle a connection closed by an error. A request sent over a kept
+        connection the server had closed is sent once more.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        self.__forget__(conn)
+        if request is not None:
+            if stale and not request[3]:
+                self.__queue__(request[:3] + (True,), True)
+            else:
+                self.__fail__(request[0], reason)
+        self.__dispatch_all__()
+
+    def __dispatch_all__(self):
+        for host in self.pending.keys():
+            self.__dispatch__(host)
+
+    def __fail__(self, task, reason):
+        print '\tdownload failed -', reason
+        self.counters['failed'] += 1
+        self.__done__(task)
+
+    def __done__(self, task):
+        """
+        Trigger the callbacks of a finished task.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: the finished task
+        @type task: DownloadTask
+        """
+
+        try:
+            self.finish_task(task)
+        except:
+            print_exc()
+        self.taskq.task_done()
+
+if __name__ == "__main__":
+    # Benchmark against stand-in tile servers, one per mt0..mt3 shard host:
+    #   python -m map.asyncDownloader [tiles] [latency] [threads] [host_connections]
+    import threading
+    from gloclib import httppool
+    tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else DOWNLOAD_THREADS
+    host_connections = int(sys.argv[4]) if len(sys.argv) > 4 else ASYNC_HOST_CONNECTIONS
+    servers = [httppool.TileServer(latency=latency) for i in range(NR_MTS)]
+
+    class BenchMap:
+        """ Stand-in for MapServ downloading from the stand-in servers """
+
+        def __init__(self):
+            self.http = httppool.HTTPPool()
+            self.lock = threading.Lock()
+            self.stored = 0
+
+        def is_read_only(self):
+            return False
+
+        def get_url_from_coord(self, coord, layer, mapServ, styleID):
+            return servers[coord[0] % NR_MTS].url('/vt?x=%i&y=%i&z=%i' % coord)
+
+        def store_response(self, coord, layer, mapServ, status, data,
+                           etag, lastmodified, meta=None):
+            self.lock.acquire()
+            self.stored += 1
+            self.lock.release()
+
+        def get_file(self, coord, layer, online, force_update, mapServ='Google', styleID=1):
+            if not online:
+                return None
+            url = self.get_url_from_coord(coord, layer, mapServ, styleID)
+            oa = self.http.fetch(url)
+            self.store_response(coord, layer, mapServ, oa['status'], oa['data'],
+                                oa['etag'], oa['lastmodified'])
+            return url
+
+    side = int(tiles ** 0.5)
+    def run(downloader):
+        ctx_map = downloader.ctx_map
+        start = time.time()
+        downloader.query_region(0, side - 1, 0, side - 1, 5, LAYER_MAP, None)
+        downloader.wait_all()
+        elapsed = time.time() - start
+        downloader.stop_all()
+        assert ctx_map.stored == side * side
+        return side * side / elapsed
+
+    print "%i tiles, %.3fs latency" % (side * side, latency)
+    # silence the per tile messages
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    threaded = run(MapDownloader(BenchMap(), threads))
+    engine = AsyncMapDownloader(BenchMap(), host_connections=host_connections)
+    evented = run(engine)
+    sys.stdout = stdout
+    print "threads (%i):        %8.1f tiles/s" % (threads, threaded)
+    print "async (%i per host): %8.1f tiles/s" % (host_connections, evented)
+    print "async stats:", engine.stats()
+    for server in servers:
+        server.close()
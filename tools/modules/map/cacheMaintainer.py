@@ -0,0 +1,360 @@
+"""
+ Maintains the tile cache in the background: keeps it within its disk
+ quota, revalidates the tiles of often viewed regions before they expire,
+ and reports how much of the cache each map service, layer and zoom level
+ takes.
+
+ @author: Brendan Johan Lee
+ @contact: brendajl@simula.no
+ @version: 1.0
+"""
+## GNU General Public Licence (GPL)
+
+## This program is free software; you can redistribute it and / or modify it under
+## the terms of the GNU General Public License as published by the Free Software
+## Foundation; either version 2 of the License,  or (at your option) any later
+## version.
+## This program is distributed in the hope that it will be useful,  but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+## FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+## details.
+## You should have received a copy of the GNU General Public License along with
+## this program; if not,  write to the Free Software Foundation,  Inc.,  59 Temple
+## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
+
+import time
+import heapq
+import threading
+from traceback import print_exc
+
+from map import mapUtils
+from map.mapConst import *
+
+class CacheMaintainer(threading.Thread):
+    """
+    Worker thread sweeping the tile repository of a MapServ every interval
+    seconds. The GUI only tells it what is in view, all disk access and
+    downloads happen in this thread.
+
+    A sweep walks the stored tiles once to measure them. If they take more
+    than the quota, a second walk picks the least recently used, keeping
+    only as many as must go, and removes them until the tiles take less
+    than QUOTA_LOW_WATER of it. Then the tiles in view in at least
+    refresh_views views which expire within refresh_ahead seconds are
+    revalidated, one at
+    a time, at most refresh_rate a second and only while the downloader
+    has nothing queued, so they never hold up tiles the user waits for.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, ctx_map, downloader, quota=CACHE_QUOTA, interval=MAINTAIN_INTERVAL,
+                 refresh_views=REFRESH_VIEWS, refresh_ahead=REFRESH_AHEAD,
+                 refresh_rate=REFRESH_RATE):
+        """
+        Initialize CacheMaintainer, start() starts the sweeps.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param ctx_map: mapserver whose tile repository is maintained
+        @type ctx_map: MapServ
+        @param downloader: downloader whose queue must be empty before refreshing
+        @type downloader: MapDownloader
+        @param quota: bytes the stored tiles may take, 0 for no limit
+        @type quota: int
+        @param interval: seconds between sweeps
+        @type interval: float
+        @param refresh_views: views of a tile before it is refreshed
+        @type refresh_views: int
+        @param refresh_ahead: seconds before expiry that a tile is refreshed
+        @type refresh_ahead: float
+        @param refresh_rate: tiles refreshed per second at most
+        @type refresh_rate: float
+        """
+
+        threading.Thread.__init__(self, name='CacheMaintainer')
+        self.setDaemon(True)
+        self.ctx_map = ctx_map
+        self.downloader = downloader
+        self.quota = quota
+        self.interval = interval
+        self.refresh_views = refresh_views
+        self.refresh_ahead = refresh_ahead
+        self.refresh_rate = refresh_rate
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        # views by (coord, layer, mapServ): views, time of last view and styleID,
+        # forgotten after VIEW_WINDOW seconds
+        self.views = {}
+        # view shown now: (region, zoom, layer, mapServ), since when, styleID
+        # and whether it is counted yet
+        self.viewing = None
+        # tiles and bytes by (mapServ, layer, zoom) after the last sweep
+        self.sizes = {}
+        self.counters = {'sweeps': 0, 'tiles': 0, 'bytes': 0, 'evicted': 0,
+                         'evicted_bytes': 0, 'refreshed': 0, 'sweep_seconds': 0.0}
+
+    def viewed(self, center, size, zoom, layer, mapServ, styleID=1):
+        """
+        Tell the maintainer the view has changed. Called from the GUI.
+        The tiles in view get a view each once they have stayed in view
+        VIEW_SETTLE seconds, so dragging the map across a region counts no
+        views of it.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param center: map center
+        @type center: list
+        @param size: size of the visible map
+        @type size: list
+        @param zoom: zoom level of map
+        @type zoom: int
+        @param layer: map layer
+        @type layer: int
+        @param mapServ: name of mapserver
+        @type mapServ: str
+        @param styleID: map style to use
+        @type styleID: int
+        """
+
+        region = self.downloader.get_region_around_point(center, size, zoom)
+        shown = (region, zoom, layer, mapServ)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.__settle__(now)
+            if self.viewing is None or self.viewing[0] != shown:
+                self.viewing = [shown, now, styleID, False]
+        finally:
+            self.lock.release()
+
+    def __settle__(self, now):
+        """
+        Count a view of the tiles in view, once, if they have been in view
+        VIEW_SETTLE seconds. Called with the lock held.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param now: current time
+        @type now: float
+        """
+
+        if self.viewing is None:
+            return
+        (region, zoom, layer, mapServ), since, styleID, counted = self.viewing
+        if counted or now - since < VIEW_SETTLE:
+            return
+        self.viewing[3] = True
+        world_tiles = mapUtils.tiles_on_level(zoom)
+        for x in xrange(region[0], region[1] + 1):
+            for y in xrange(region[2], region[3] + 1):
+                key = ((mapUtils.mod(x, world_tiles), mapUtils.mod(y, world_tiles), zoom),
+                       layer, mapServ)
+                views = self.views.get(key)
+                self.views[key] = ((views and views[0] or 0) + 1, now, styleID)
+
+    def run(self):
+        """
+        Sweep every interval seconds until stop() is called.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        while not self.stopping.isSet():
+            try:
+                self.sweep()
+            except:
+                print_exc() # but don't die
+            self.stopping.wait(self.interval)
+
+    def stop(self):
+        """
+        Stop sweeping, and wait for the sweep in progress to give up.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        self.stopping.set()
+        if self.isAlive():
+            self.join()
+
+    def sweep(self):
+        """
+        Measure the stored tiles, evict the least recently used ones if
+        they exceed the quota, and refresh often viewed tiles about to
+        expire.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        start = time.time()
+        self.lock.acquire()
+        try:
+            self.__settle__(start)
+            for key, (count, last, styleID) in self.views.items():
+                if start - last > VIEW_WINDOW:
+                    del self.views[key]
+            views = self.views.copy()
+        finally:
+            self.lock.release()
+
+        sizes = {}
+        total = 0
+        for mapServ, layer, coord, size, used in self.ctx_map.stored_tiles():
+            if self.stopping.isSet():
+                return
+            counts = sizes.setdefault((mapServ, layer, coord[2]), [0, 0])
+            counts[0] += 1
+            counts[1] += size
+            total += size
+
+        if self.quota and total > self.quota:
+            evict = self.__oldest__(views, total - self.quota * QUOTA_LOW_WATER)
+            if evict is None:
+                return
+            for used, size, key in evict:
+                if self.stopping.isSet():
+                    break
+                coord, layer, mapServ = key
+                self.ctx_map.remove_tile(coord, layer, mapServ)
+                counts = sizes[(mapServ, layer, coord[2])]
+                counts[0] -= 1
+                counts[1] -= size
+                total -= size
+                self.counters['evicted'] += 1
+                self.counters['evicted_bytes'] += size
+                views.pop(key, None)
+                self.lock.acquire()
+                try:
+                    self.views.pop(key, None)
+                finally:
+                    self.lock.release()
+
+        self.sizes = sizes
+        self.counters['sweeps'] += 1
+        self.counters['tiles'] = sum([counts[0] for counts in sizes.values()])
+        self.counters['bytes'] = total
+        self.counters['sweep_seconds'] = time.time() - start
+        self.refresh(views)
+
+    def __oldest__(self, views, excess):
+        """
+        Walk the stored tiles and return the least recently used ones that
+        together take at least excess bytes, oldest first. Keeps only those
+        in memory, in a heap with the most recently used on top.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param views: views by tile, see viewed()
+        @type views: dict
+        @param excess: bytes to free
+        @type excess: float
+
+        @return: (time of last use, size, key) by time of last use, None if stopped
+        @rtype: list
+        """
+
+        heap = []
+        taken = 0
+        for mapServ, layer, coord, size, used in self.ctx_map.stored_tiles():
+            if self.stopping.isSet():
+                return None
+            key = (coord, layer, mapServ)
+            if key in views:
+                # tiles drawn from memory are not read from the disk
+                used = max(used, views[key][1])
+            heapq.heappush(heap, (-used, size, key))
+            taken += size
+            # drop the most recently used while the others free enough
+            while taken - heap[0][1] >= excess:
+                taken -= heapq.heappop(heap)[1]
+        return sorted([(-used, size, key) for used, size, key in heap])
+
+    def refresh(self, views):
+        """
+        Revalidate the often viewed tiles that expire soon, most viewed
+        first, whenever the downloader is idle.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param views: views by tile, see viewed()
+        @type views: dict
+        """
+
+        now = time.time()
+        due = []
+        for key, (count, last, styleID) in views.iteritems():
+            if count < self.refresh_views:
+                continue
+            coord, layer, mapServ = key
+            # tiles without metadata are not stored, or left to tileseed -r
+            meta = self.ctx_map.get_tile_meta(coord, layer, mapServ)
+            if meta is None or now - meta['fetched'] < self.ctx_map.max_age - self.refresh_ahead:
+                continue
+            due.append((-count, key, styleID, meta))
+        due.sort()
+
+        for count, (coord, layer, mapServ), styleID, meta in due:
+            while self.downloader.qsize() and not self.stopping.isSet():
+                self.stopping.wait(1.0)
+            if self.stopping.isSet():
+                return
+            try:
+                self.ctx_map.download_tile(coord, layer, mapServ, styleID, meta)
+                self.counters['refreshed'] += 1
+            except Exception, e:
+                print '\trefresh failed -', e
+            self.stopping.wait(1.0 / self.refresh_rate)
+
+    def stats(self):
+        """
+        Return the counters of the maintainer: the tiles and bytes stored
+        at the last sweep, the tiles and bytes evicted and the tiles
+        refreshed so far.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: statistics
+        @rtype: dict
+        """
+
+        stats = self.counters.copy()
+        stats['viewed'] = len(self.views)
+        return stats
+
+    def report(self):
+        """
+        Return the size of the cache per map service, layer and zoom level,
+        as of the last sweep.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: one line per map service, layer and zoom level
+        @rtype: list of str
+        """
+
+        return ["%s %s zoom %i: %i tiles, %.1f MB" % (mapServ, LAYER_NAMES[layer], zoom,
+                                                      counts[0], counts[1] / 1048576.0)
+                for (mapServ, layer, zoom), counts in sorted(self.sizes.items())]
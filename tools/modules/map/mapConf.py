@@ -83,6 +83,9 @@ class MapConf():
         config = ConfigParser.RawConfigParser()
         config.add_section(SECTION_INIT)
         config.add_section(SECTION_DATABASE)
+        config.add_section(SECTION_OVERLAYS)
+        config.add_section(SECTION_CACHE)
+        config.add_section(SECTION_DOWNLOADER)
         if self.init_path:
             config.set(SECTION_INIT, 'path', self.init_path)
         config.set(SECTION_INIT, 'width', self.init_width)
@@ -91,11 +94,33 @@ class MapConf():
         config.set(SECTION_INIT, 'center', self.init_center)
         config.set(SECTION_INIT, 'map_service', self.map_service)
         config.set(SECTION_INIT, 'cloudmade_styleid', self.cloudMade_styleID)
+        config.set(SECTION_INIT, 'repository', self.repository)
+        config.set(SECTION_INIT, 'archive', self.archive)
         config.set(SECTION_DATABASE, 'host', self.db_host)
         config.set(SECTION_DATABASE, 'port', self.db_port)
         config.set(SECTION_DATABASE, 'name', self.db_name)
         config.set(SECTION_DATABASE, 'username', self.db_username)
         config.set(SECTION_DATABASE, 'password', self.db_password)
+        config.set(SECTION_DATABASE, 'poolsize', self.db_poolsize)
+        config.set(SECTION_DATABASE, 'itersize', self.db_itersize)
+        config.set(SECTION_OVERLAYS, 'tiled', self.overlay_tiled)
+        config.set(SECTION_OVERLAYS, 'tile_cache', self.overlay_tile_cache)
+        for layer in range(len(LAYER_NAMES)):
+            config.set(SECTION_CACHE, '%s_mb' % LAYER_NAMES[layer].lower(), self.cache_budgets[layer] >> 20)
+        config.set(SECTION_CACHE, 'decode_threads', self.decode_threads)
+        config.set(SECTION_CACHE, 'quota_mb', self.cache_quota >> 20)
+        config.set(SECTION_CACHE, 'maintain_interval', self.maintain_interval)
+        config.set(SECTION_CACHE, 'refresh_views', self.refresh_views)
+        config.set(SECTION_CACHE, 'refresh_ahead', self.refresh_ahead)
+        config.set(SECTION_CACHE, 'refresh_rate', self.refresh_rate)
+        config.set(SECTION_DOWNLOADER, 'engine', self.downloader)
+        config.set(SECTION_DOWNLOADER, 'threads', self.downloader_threads)
+        config.set(SECTION_DOWNLOADER, 'connections', self.downloader_connections)
+        config.set(SECTION_DOWNLOADER, 'host_connections', self.downloader_host_connections)
+        config.set(SECTION_DOWNLOADER, 'prefetch', self.prefetch)
+        config.set(SECTION_DOWNLOADER, 'prefetch_rate', self.prefetch_rate)
+        config.set(SECTION_DOWNLOADER, 'prefetch_queue', self.prefetch_queue)
+        config.set(SECTION_DOWNLOADER, 'max_age', self.max_age)
 
         configfile = open(configpath, 'wb')
         config.write(configfile)
@@ -156,12 +181,63 @@ class MapConf():
 
         self.map_service = read_config(SECTION_INIT,'map_service', MAP_SERVERS[GOOGLE], str)
         self.cloudMade_styleID = read_config(SECTION_INIT,'cloudmade_styleid', 1, int)
+        # files keeps a png per tile, sqlite a MBTiles file per map service and layer,
+        # archive reads tiles from a read-only tile archive (see tilestore pack)
+        self.repository = read_config(SECTION_INIT,'repository', REPOSITORY_FILES, str)
+        if self.repository not in REPOSITORIES:
+            self.repository = REPOSITORY_FILES
+        self.archive = os.path.expanduser(read_config(SECTION_INIT,'archive',
+                                          os.path.join(self.init_path, ARCHIVE_NAME), str))
 
         self.db_host = read_config(SECTION_DATABASE,'host','localhost',str)
         self.db_port = read_config(SECTION_DATABASE,'port',5432,int)
         self.db_name = read_config(SECTION_DATABASE,'name','gloc',str)
         self.db_username = read_config(SECTION_DATABASE,'username','gloc',str)
         self.db_password = read_config(SECTION_DATABASE,'password','99ab97a',str)
+        # 0 shares one connection, more gives a pool of that many connections
+        self.db_poolsize = read_config(SECTION_DATABASE,'poolsize',0,int)
+        # rows fetched at a time when streaming large query results
+        self.db_itersize = read_config(SECTION_DATABASE,'itersize',2000,int)
+
+        # 1 renders overlays a tile at a time instead of on one big buffer image
+        self.overlay_tiled = read_config(SECTION_OVERLAYS,'tiled',0,int)
+        # number of overlay tiles kept in tiled mode
+        self.overlay_tile_cache = read_config(SECTION_OVERLAYS,'tile_cache',OVERLAY_TILE_CACHE,int)
+
+        # megabytes of decoded tiles kept in memory per layer, as map_mb etc.
+        self.cache_budgets = [read_config(SECTION_CACHE,'%s_mb' % LAYER_NAMES[layer].lower(),
+                                          PIXBUF_CACHE_BUDGETS[layer] >> 20,int) << 20
+                              for layer in range(len(LAYER_NAMES))]
+        # threads decoding received tiles, so the GUI thread only draws them
+        self.decode_threads = read_config(SECTION_CACHE,'decode_threads',DECODE_THREADS,int)
+        # megabytes of tiles kept on disk, the least recently used are evicted, 0 keeps all.
+        # The eviction does not spare the tiles seeded with tileseed
+        self.cache_quota = read_config(SECTION_CACHE,'quota_mb',CACHE_QUOTA >> 20,int) << 20
+        # seconds between sweeps of the cache maintainer, 0 disables it
+        self.maintain_interval = read_config(SECTION_CACHE,'maintain_interval',MAINTAIN_INTERVAL,int)
+        # tiles viewed refresh_views times are revalidated refresh_ahead seconds
+        # before they expire (see max_age), at most refresh_rate a second
+        self.refresh_views = read_config(SECTION_CACHE,'refresh_views',REFRESH_VIEWS,int)
+        self.refresh_ahead = read_config(SECTION_CACHE,'refresh_ahead',REFRESH_AHEAD,int)
+        self.refresh_rate = read_config(SECTION_CACHE,'refresh_rate',REFRESH_RATE,float)
+
+        # threads downloads with a pool of threads, async with one thread
+        # keeping many requests in flight
+        self.downloader = read_config(SECTION_DOWNLOADER,'engine',DOWNLOADER_THREADS,str)
+        if self.downloader not in DOWNLOADERS:
+            self.downloader = DOWNLOADER_THREADS
+        self.downloader_threads = read_config(SECTION_DOWNLOADER,'threads',DOWNLOAD_THREADS,int)
+        # connections of the async engine, in total and per tile server
+        self.downloader_connections = read_config(SECTION_DOWNLOADER,'connections',ASYNC_CONNECTIONS,int)
+        self.downloader_host_connections = read_config(SECTION_DOWNLOADER,'host_connections',
+                                                       ASYNC_HOST_CONNECTIONS,int)
+        # 1 prefetches the tiles ahead of a pan and of the neighbouring zoom levels,
+        # at most prefetch_rate a second and prefetch_queue at a time
+        self.prefetch = read_config(SECTION_DOWNLOADER,'prefetch',1,int)
+        self.prefetch_rate = read_config(SECTION_DOWNLOADER,'prefetch_rate',PREFETCH_RATE,float)
+        self.prefetch_queue = read_config(SECTION_DOWNLOADER,'prefetch_queue',PREFETCH_QUEUE,int)
+        # seconds after which a forced update (tileseed -r) revalidates a cached tile
+        self.max_age = read_config(SECTION_DOWNLOADER,'max_age',TILE_MAX_AGE,int)
 
     def save(self):
         """ 
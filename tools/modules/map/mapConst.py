@@ -36,6 +36,9 @@ LAYER_DIRS = ["tiles", "sat_tiles", "ter_tiles"]
 
 SECTION_INIT  = 'init'
 SECTION_DATABASE  = 'database'
+SECTION_OVERLAYS  = 'overlays'
+SECTION_CACHE  = 'cache'
+SECTION_DOWNLOADER  = 'downloader'
 R_EARTH = 6371.
 USER_PATH = "~"
 TILES_PATH = ".glocalizer"
@@ -49,6 +52,65 @@ TYPES = ["Points", "Polygon", "Filled Polygon",  "Path"]
 
 
 LAYER_BUFFER_TILES = 20
+OVERLAY_PROJECTION_ZOOMS = 4
+OVERLAY_TILE_CACHE = 128
+
+# bytes of decoded tiles kept in memory per layer
+PIXBUF_CACHE_BUDGETS = [128 << 20, 128 << 20, 64 << 20]
+# threads decoding received tiles for the GUI, see tileDecoder.py
+DECODE_THREADS = 2
+
+# where downloaded tiles are kept, see the tilesRepo modules
+REPOSITORY_FILES = 'files'
+REPOSITORY_SQLITE = 'sqlite'
+REPOSITORY_ARCHIVE = 'archive'
+REPOSITORIES = [REPOSITORY_FILES, REPOSITORY_SQLITE, REPOSITORY_ARCHIVE]
+ARCHIVE_NAME = 'tiles.pack'
+# tiles inserted into a MBTiles file at a time, and the longest a tile waits
+# to be inserted (see mbtiles.py)
+SQLITE_BATCH_SIZE = 64
+SQLITE_FLUSH_SECONDS = 5
+# seconds after which a forced update revalidates a cached tile with the server
+TILE_MAX_AGE = 86400
+
+# how tiles are downloaded, a pool of threads (see mapDownloader.py)
+# or one thread multiplexing many connections (see asyncDownloader.py)
+DOWNLOADER_THREADS = 'threads'
+DOWNLOADER_ASYNC = 'async'
+DOWNLOADERS = [DOWNLOADER_THREADS, DOWNLOADER_ASYNC]
+DOWNLOAD_THREADS = 4
+# connections the async downloader keeps open, in total and per tile server
+ASYNC_CONNECTIONS = 256
+ASYNC_HOST_CONNECTIONS = 16
+# prefetch tasks queued or downloading at most, and queued per second at most
+PREFETCH_QUEUE = 32
+PREFETCH_RATE = 8
+# seconds of panning the prefetcher looks ahead, and of motion it looks back at
+PREFETCH_LOOKAHEAD = 1.0
+PREFETCH_WINDOW = 0.3
+# tiles the prefetcher remembers having queued or found offline
+PREFETCH_REMEMBER = 1024
+
+# disk space the tile cache may take, 0 for no limit, and seconds between
+# sweeps of the cache maintainer (see cacheMaintainer.py), 0 disables it.
+# No limit by default, a quota would evict tiles seeded with tileseed
+CACHE_QUOTA = 0
+MAINTAIN_INTERVAL = 600
+# a sweep over the quota evicts tiles until the cache is below this part of it
+QUOTA_LOW_WATER = 0.9
+# tiles in view in at least REFRESH_VIEWS views are revalidated REFRESH_AHEAD
+# seconds before they expire, at most REFRESH_RATE a second
+REFRESH_VIEWS = 3
+REFRESH_AHEAD = 3600
+REFRESH_RATE = 2.0
+# a view counts once the map has stayed put VIEW_SETTLE seconds, and views
+# older than VIEW_WINDOW seconds are forgotten
+VIEW_SETTLE = 1.0
+VIEW_WINDOW = 7 * 86400
+
+# image written by the export, and threads decoding its tiles
+EXPORT_NAME = 'map.png'
+EXPORT_THREADS = 4
 
 FOUNDATION_CELLS = 0
 FOUNDATION_OBSERVATIONS = 1
@@ -25,7 +25,10 @@
 
 from __future__ import division
 from mapConst import TILES_HEIGHT
-from threading import Thread
+import time
+import heapq
+from itertools import count
+from threading import Thread, Lock
 from Queue import Queue
 from traceback import print_exc
 
@@ -33,6 +36,20 @@ from map import mapUtils
 from mapConst import *
 from math import floor,ceil
 
+# order in which tasks are handed out, see TileView.priority()
+PRIORITY_SENTINEL = -1
+PRIORITY_VISIBLE = 0
+PRIORITY_MARGIN = 1
+PRIORITY_PREFETCH = 2
+PRIORITY_OTHER = 3
+
+# what query_tile() did with a tile
+QUERY_OFFLINE = 0
+QUERY_QUEUED = 1
+# a task for the tile was in flight already, see attach_task()
+QUERY_ATTACHED = 2
+QUERY_DROPPED = 3
+
 
 class DownloadTask:
     """ 
@@ -42,7 +59,8 @@ class DownloadTask:
     @contact: brendajl@simula.no
     @version: 1.0
     """
-    def __init__(self, coord, layer, callback=None, force_update=False, mapServ=MAP_SERVERS[GOOGLE], styleID=1):
+    def __init__(self, coord, layer, callback=None, force_update=False, mapServ=MAP_SERVERS[GOOGLE], styleID=1,
+                 prefetch=False):
         """ 
         Initialize DownloadTask
 
@@ -62,13 +80,36 @@ class DownloadTask:
         @type mapServ: str
         @param styleID: id of mapstyle to use (map, satellite,  etc)
         @type styleID: int
+        @param prefetch: the tile is not in view yet, but may soon be
+        @type prefetch: bool
         """
         self.coord = coord
         self.layer = layer
-        self.callback = callback
+        # callbacks of this task and of the duplicates attached to it
+        self.callbacks = []
+        if callback:
+            self.callbacks.append(callback)
         self.force_update = force_update
         self.mapServ = mapServ
         self.styleID = styleID
+        self.prefetch = prefetch
+        # metadata of the stored copy of a tile being revalidated
+        self.meta = None
+
+    def key(self):
+        """ 
+        Return what identifies the tile of the task, tasks with the same
+        key download the same tile.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: coordinates, layer and map server of the tile
+        @rtype: tupple
+        """
+
+        return (self.coord, self.layer, self.mapServ)
 
     def __str__(self):
         """ 
@@ -85,6 +126,221 @@ class DownloadTask:
         return "DownloadTask(%s,%s,%s,%s)" % \
                 (self.coord, self.layer, self.mapServ, self.styleID)
 
+class TileView:
+    """ 
+    The part of the map being looked at, used to order and cancel tasks.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, center, visible, zoom, layer, mapServ):
+        """ 
+        Initialize TileView
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param center: map center, tile and offset within it
+        @type center: tupple
+        @param visible: horizontal minimum, maximum, vertical minimum, maximum of visible tiles
+        @type visible: list
+        @param zoom: zoom level of map
+        @type zoom: int
+        @param layer: map layer
+        @type layer: int
+        @param mapServ: name of mapserver
+        @type mapServ: str
+        """
+
+        self.x = center[0][0] + center[1][0] / TILES_WIDTH
+        self.y = center[0][1] + center[1][1] / TILES_HEIGHT
+        self.visible = visible
+        self.zoom = zoom
+        self.layer = layer
+        self.mapServ = mapServ
+        self.world_tiles = mapUtils.tiles_on_level(zoom)
+
+    def matches(self, task):
+        """ 
+        Return true if the tile of a task belongs to the zoom level,
+        layer and map server of the view.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: task to check
+        @type task: DownloadTask
+
+        @rtype: bool
+        """
+
+        return (task.coord[2] == self.zoom and task.layer == self.layer and
+                task.mapServ == self.mapServ)
+
+    def wanted(self, task):
+        """ 
+        Return true if a task is still of use for the view: it matches the
+        view, or prefetches a tile of the zoom level above or below.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: task to check
+        @type task: DownloadTask
+
+        @rtype: bool
+        """
+
+        if task.prefetch:
+            return (abs(task.coord[2] - self.zoom) <= 1 and task.layer == self.layer and
+                    task.mapServ == self.mapServ)
+        return self.matches(task)
+
+    def is_visible(self, task):
+        """ 
+        Return true if the tile of a task is in view.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: task to check
+        @type task: DownloadTask
+
+        @rtype: bool
+        """
+
+        xmin, xmax, ymin, ymax = self.visible
+        # tile coordinates wrap around the world
+        return (self.matches(task) and
+                (task.coord[0] - xmin) % self.world_tiles <= xmax - xmin and
+                (task.coord[1] - ymin) % self.world_tiles <= ymax - ymin)
+
+    def priority(self, task):
+        """ 
+        Return the priority of a task, lowest first: visible tiles, then the
+        tiles of the margin around the view, then prefetched tiles, then other
+        tiles, each by their distance to the center of the view.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: task to order
+        @type task: DownloadTask
+
+        @return: priority class and squared distance in tiles
+        @rtype: tupple
+        """
+
+        if task is None:
+            return (PRIORITY_SENTINEL, 0)
+        if not self.matches(task):
+            if task.prefetch:
+                return (PRIORITY_PREFETCH, 0)
+            return (PRIORITY_OTHER, 0)
+        dx = abs(task.coord[0] + 0.5 - self.x) % self.world_tiles
+        dy = abs(task.coord[1] + 0.5 - self.y) % self.world_tiles
+        dx = min(dx, self.world_tiles - dx)
+        dy = min(dy, self.world_tiles - dy)
+        if task.prefetch:
+            return (PRIORITY_PREFETCH, dx*dx + dy*dy)
+        if self.is_visible(task):
+            return (PRIORITY_VISIBLE, dx*dx + dy*dy)
+        return (PRIORITY_MARGIN, dx*dx + dy*dy)
+
+class TileQueue(Queue):
+    """ 
+    Queue handing out the DownloadTasks most urgent for the current
+    TileView first. Tasks queued before any view is set are handed out
+    in order.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.view = None
+        # keeps tasks of equal priority in order
+        self.counter = count()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, task):
+        heapq.heappush(self.queue, (self.__priority__(task), self.counter.next(), task))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+    def set_view(self, view):
+        """ 
+        Order the queued tasks for a new view, and cancel those that are
+        no longer wanted, see TileView.wanted().
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param view: the new view
+        @type view: TileView
+
+        @return: the cancelled tasks
+        @rtype: list
+        """
+
+        self.mutex.acquire()
+        try:
+            self.view = view
+            cancelled = []
+            queue = []
+            for priority, serial, task in self.queue:
+                if task is None or view.wanted(task):
+                    queue.append((self.__priority__(task), serial, task))
+                else:
+                    cancelled.append(task)
+            heapq.heapify(queue)
+            self.queue = queue
+            # cancelled tasks will never be processed, see Queue.task_done
+            if cancelled:
+                self.unfinished_tasks -= len(cancelled)
+                if not self.unfinished_tasks:
+                    self.all_tasks_done.notify_all()
+            return cancelled
+        finally:
+            self.mutex.release()
+
+    def reprioritize(self):
+        """ 
+        Order the queued tasks again, after the priority of one changed.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        self.mutex.acquire()
+        try:
+            self.queue = [(self.__priority__(task), serial, task)
+                          for priority, serial, task in self.queue]
+            heapq.heapify(self.queue)
+        finally:
+            self.mutex.release()
+
+    def __priority__(self, task):
+        if self.view is None:
+            if task is None:
+                return (PRIORITY_SENTINEL, 0)
+            return (PRIORITY_VISIBLE, 0)
+        return self.view.priority(task)
+
 class DownloaderThread(Thread):
     """ 
     Thread that downloads tiles from the web.
@@ -94,7 +350,7 @@ class DownloaderThread(Thread):
     @version: 1.0
     """
 
-    def __init__(self, ctx_map, inq):
+    def __init__(self, ctx_map, inq, finish):
         """ 
         Initialize DownloaderThread
 
@@ -106,11 +362,14 @@ class DownloaderThread(Thread):
         @type ctx_map: MapServ
         @param inq: task queue
         @type inq: Queue
+        @param finish: called with each processed task, see MapDownloader.finish_task
+        @type finish: function
         """
         
         Thread.__init__(self)
         self.ctx_map = ctx_map
         self.inq = inq
+        self.finish = finish
 
     def run(self):
         """ 
@@ -133,7 +392,7 @@ class DownloaderThread(Thread):
 
     def process_task(self, task):
         """ 
-        Process a task, and trigger callback if specified when done
+        Process a task, and trigger its callbacks when done
 
         @author: Brendan Johan Lee
         @contact: brendajl@simula.no
@@ -142,12 +401,14 @@ class DownloaderThread(Thread):
         @param task: task to perform
         @type task: instance
         """
-        filename = self.ctx_map.get_file(
-            task.coord, task.layer, True,
-            task.force_update, task.mapServ, task.styleID
-        )
-        if task.callback:
-            task.callback(False, task.coord, task.layer, task.mapServ)
+        try:
+            self.ctx_map.get_file(
+                task.coord, task.layer, True,
+                task.force_update, task.mapServ, task.styleID
+            )
+        finally:
+            # a task that failed must not stay in flight, nor its callbacks wait
+            self.finish(task)
 
 class MapDownloader:
     """ 
@@ -158,7 +419,7 @@ class MapDownloader:
     @version: 1.0
     """
 
-    def __init__(self, ctx_map, numthreads=4):
+    def __init__(self, ctx_map, numthreads=DOWNLOAD_THREADS, prefetch_limit=PREFETCH_QUEUE):
         """ 
         Initialize MapDownloader.
 
@@ -170,13 +431,16 @@ class MapDownloader:
         @type ctx_map: MapServ
         @param numthreads: number of threads to use (for simultaneous downloading)
         @type numthreads: int
+        @param prefetch_limit: most prefetch tasks queued or downloading at a time
+        @type prefetch_limit: int
         """
 
         self.ctx_map=ctx_map
         self.threads=[]
-        self.taskq=Queue(0)
+        self.taskq=TileQueue(0)
+        self.init_inflight(prefetch_limit)
         for i in xrange(numthreads):
-            t=DownloaderThread(self.ctx_map,self.taskq)
+            t=DownloaderThread(self.ctx_map,self.taskq,self.finish_task)
             self.threads.append(t)
             t.start()
 
@@ -213,6 +477,7 @@ class MapDownloader:
 
         while not self.taskq.empty():
             self.taskq.get_nowait() # clear the queue
+        self.inflight.clear()
         for i in xrange(len(self.threads)):
             self.taskq.put(None) # put sentinels for threads
         for t in self.threads:
@@ -231,10 +496,12 @@ class MapDownloader:
 
         return self.taskq.qsize()
 
-    def query_tile(self, coord, layer, callback, online=True, force_update=False, mapServ=MAP_SERVERS[GOOGLE], styleID=1):
+    def query_tile(self, coord, layer, callback, online=True, force_update=False, mapServ=MAP_SERVERS[GOOGLE], styleID=1,
+                   prefetch=False):
         """ 
         Tell the MapDownloader to retrieve a map tile. Tile will be retrieved from
-        cache if the tile resides there and has not expired, else from web.
+        cache if the tile resides there and has not expired, else from web. An
+        expired tile is revalidated with a conditional request.
 
         @author: Brendan Johan Lee
         @contact: brendajl@simula.no
@@ -248,12 +515,19 @@ class MapDownloader:
         @type callback: function
         @param online: indicates if the system is online, in other words has access to the net
         @type online: bool
-        @param force_update: force the system to download the tile even if it exists in cache
+        @param force_update: revalidate the tile if it exists in cache but has expired
         @type force_update: bool
         @param mapServ: map server to use
         @type mapServ: str
         @param styleID: map style to use (map, satellite, etc)
         @type styleID: int
+        @param prefetch: the tile is not in view yet, download it when nothing more urgent waits
+        @type prefetch: bool
+
+        @return: QUERY_OFFLINE if the tile was available offline, QUERY_QUEUED or
+                 QUERY_ATTACHED if it will be downloaded, QUERY_DROPPED if it will not
+                 be as it was prefetched over the prefetch_limit or is in flight already
+        @rtype: int
         """
         
         world_tiles = mapUtils.tiles_on_level(coord[2])
@@ -264,18 +538,214 @@ class MapDownloader:
         fn = self.ctx_map.get_file(coord, layer, False, False, mapServ=mapServ)
 
         if fn!=None or (not online):
-            deleted = False
-            if (force_update and online):
-                deleted = fileUtils.delete_old(fn)
-            if not deleted:
-                callback(True, coord, layer, mapServ)
-                return 
-
-        self.taskq.put(
-            DownloadTask(
-                coord, layer, callback, force_update, mapServ, styleID
-            )
+            if not (force_update and online and not self.ctx_map.is_read_only() and
+                    self.ctx_map.is_stale(self.ctx_map.get_tile_meta(coord, layer, mapServ))):
+                if callback:
+                    callback(True, coord, layer, mapServ)
+                return QUERY_OFFLINE
+
+        task = DownloadTask(
+            coord, layer, callback, force_update, mapServ, styleID, prefetch
         )
+        attached = self.attach_task(task)
+        if attached:
+            return attached
+        self.put_task(task)
+        return QUERY_QUEUED
+
+    def init_inflight(self, prefetch_limit=PREFETCH_QUEUE):
+        """ 
+        Initialize the table of tasks queued or being downloaded, and
+        its counters.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param prefetch_limit: most prefetch tasks queued or downloading at a time
+        @type prefetch_limit: int
+        """
+
+        # tasks queued or downloading by DownloadTask.key()
+        self.inflight = {}
+        self.inflight_lock = Lock()
+        self.tasks = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.prefetch_limit = prefetch_limit
+        self.prefetching = 0
+        self.prefetched = 0
+        self.promoted = 0
+        # the current view and the visible tiles it waits for
+        self.view = None
+        self.view_start = None
+        self.view_waiting = set()
+        self.viewports = 0
+        self.viewport_time = 0.0
+        self.viewport_last = 0.0
+
+    def attach_task(self, task):
+        """ 
+        Attach the callbacks of a task to the task already downloading the
+        same tile, if any. A forced update is only attached to another
+        forced update, as the tile may otherwise not be downloaded again.
+        A prefetch task the tile is needed for now gets the priority of the
+        new task. Prefetch tasks beyond the prefetch_limit are dropped.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: new task
+        @type task: DownloadTask
+
+        @return: QUERY_ATTACHED or QUERY_DROPPED if the task must not be queued,
+                 None if it must
+        @rtype: int
+        """
+
+        key = task.key()
+        self.inflight_lock.acquire()
+        try:
+            running = self.inflight.get(key)
+            if running is not None and task.prefetch:
+                return QUERY_DROPPED
+            if running is not None and (running.force_update or not task.force_update):
+                running.callbacks.extend(task.callbacks)
+                self.coalesced += 1
+                if running.prefetch:
+                    running.prefetch = False
+                    self.prefetching -= 1
+                    self.promoted += 1
+                    self.taskq.reprioritize()
+                return QUERY_ATTACHED
+            if task.prefetch:
+                if self.prefetching >= self.prefetch_limit:
+                    return QUERY_DROPPED
+                self.prefetching += 1
+                self.prefetched += 1
+            self.inflight[key] = task
+            self.tasks += 1
+            return None
+        finally:
+            self.inflight_lock.release()
+
+    def finish_task(self, task):
+        """ 
+        Remove a processed task from the table of tasks in flight and
+        trigger its callbacks, including those of attached duplicates.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: processed task
+        @type task: DownloadTask
+        """
+
+        self.inflight_lock.acquire()
+        try:
+            if self.inflight.get(task.key()) is task:
+                del self.inflight[task.key()]
+            if task.prefetch:
+                task.prefetch = False
+                self.prefetching -= 1
+            callbacks = task.callbacks
+            task.callbacks = []
+            if task.key() in self.view_waiting:
+                self.view_waiting.discard(task.key())
+                if not self.view_waiting:
+                    # every visible tile is in, record the time to full viewport
+                    self.viewport_last = time.time() - self.view_start
+                    self.viewport_time += self.viewport_last
+                    self.viewports += 1
+                    self.view_start = None
+        finally:
+            self.inflight_lock.release()
+        for callback in callbacks:
+            callback(False, task.coord, task.layer, task.mapServ)
+
+    def set_view(self, center, size, zoom, layer, mapServ):
+        """ 
+        Tell the MapDownloader what is being looked at. Queued tasks are
+        reordered so the visible tiles closest to the center come first,
+        and tasks for another zoom level, layer or map server are cancelled.
+        Call it after querying the tiles of the view, so the time until all
+        visible tiles are in can be measured.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param center: map center
+        @type center: list
+        @param size: size of the visible map
+        @type size: list
+        @param zoom: zoom level of map
+        @type zoom: int
+        @param layer: map layer
+        @type layer: int
+        @param mapServ: name of mapserver
+        @type mapServ: str
+        """
+
+        view = TileView(center, self.get_region_around_point(center, size, zoom),
+                        zoom, layer, mapServ)
+        cancelled = self.taskq.set_view(view)
+        self.inflight_lock.acquire()
+        try:
+            self.view = view
+            for task in cancelled:
+                if self.inflight.get(task.key()) is task:
+                    del self.inflight[task.key()]
+                if task.prefetch:
+                    self.prefetching -= 1
+            self.cancelled += len(cancelled)
+            self.view_waiting = set([key for key, task in self.inflight.items()
+                                     if view.is_visible(task)])
+            if not self.view_waiting:
+                self.view_start = None
+            elif self.view_start is None:
+                # keep the start time when the view moves while waiting
+                self.view_start = time.time()
+        finally:
+            self.inflight_lock.release()
+
+    def stats(self):
+        """ 
+        Return the counters of the downloader: tasks queued, duplicate tasks
+        attached to a task in flight instead (each a download saved), tasks
+        cancelled by set_view(), and the number of views waited for with the
+        mean and last seconds until all their visible tiles were in, prefetch
+        tasks queued and those needed in view before they were done.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: counters
+        @rtype: dict
+        """
+
+        return {'tasks': self.tasks, 'coalesced': self.coalesced,
+                'cancelled': self.cancelled, 'viewports': self.viewports,
+                'viewport_mean': self.viewport_time / max(1, self.viewports),
+                'viewport_last': self.viewport_last,
+                'prefetched': self.prefetched, 'prefetch_promoted': self.promoted}
+
+    def put_task(self, task):
+        """ 
+        Hand a task to the download threads.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param task: task to perform
+        @type task: DownloadTask
+        """
+
+        self.taskq.put(task)
 
     def query_region(self, xmin, xmax, ymin, ymax, zoom, *args, **kwargs):
         """ 
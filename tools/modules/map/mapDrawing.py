@@ -56,6 +56,13 @@ def add_tile(overlays,mapcontext,x,y,img,tile_coord,region,mapcenter, debug = Fa
 
     for overlay in overlays:
         if overlay.visible:
+            if overlay.tiled:
+                surface = overlay.render_tile(tile_coord)
+                if surface:
+                    mapcontext.set_source_surface(surface,x,y)
+                    mapcontext.rectangle(x,y,TILES_WIDTH,TILES_HEIGHT)
+                    mapcontext.fill()
+                continue
             pos = overlay.gettilecoord(tile_coord,region,mapcenter)
             if pos:
                 mapcontext.set_source_surface(overlay.surface,pos[0]*TILES_WIDTH,pos[1]*TILES_HEIGHT)
@@ -0,0 +1,148 @@
+## This modul exports a region of tiles as one big image
+#
+# Usage:
+#
+# - used by the do_export() method of the tile repositories, which
+#   give a function reading the image data of a tile
+#
+# - the image is written a band of tiles at a time with an incremental
+#   PNG encoder, so only one band of the image is held in memory
+#
+# - the tiles of the next band are read and decoded by a pool of
+#   threads while the current band is encoded
+#
+# - a world file (.pgw) next to the image gives its position in
+#   spherical mercator (EPSG:3857) meters, so GIS tools can place it
+
+
+import os
+import zlib
+import struct
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from mapConst import *
+import mapUtils
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+# half the circumference of the earth in spherical mercator meters
+MERCATOR_HALF = 20037508.342789244
+# one transparent row of a tile, used for missing tiles
+EMPTY_ROW = '\0' * (TILES_WIDTH * 4)
+
+
+## Writes a RGBA PNG image a number of rows at a time
+class PNGWriter:
+
+    def __init__(self, filename, width, height, level=6):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.compressor = zlib.compressobj(level)
+        self.file = open(filename, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        # 8 bits per sample, RGBA, no interlacing
+        self.chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    ## Write one PNG chunk
+    def chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    ## Append rows, each a string of width RGBA pixels
+    def write_rows(self, rows):
+        # every row starts with its filter type, 0 is none
+        data = self.compressor.compress('\0' + '\0'.join(rows))
+        self.rows += len(rows)
+        if data:
+            self.chunk('IDAT', data)
+
+    def close(self):
+        try:
+            self.chunk('IDAT', self.compressor.flush())
+            self.chunk('IEND', '')
+        finally:
+            self.file.close()
+
+
+## Returns the pixels of a tile as a string of RGBA rows, or None
+# data is the image data of the tile
+def decode_tile(data):
+    if not data:
+        return None
+    from PIL import Image
+    im = Image.open(StringIO(data)).convert('RGBA')
+    if im.size != (TILES_WIDTH, TILES_HEIGHT):
+        im = im.resize((TILES_WIDTH, TILES_HEIGHT))
+    # tobytes() replaced tostring() in newer versions of PIL
+    return getattr(im, 'tobytes', im.tostring)()
+
+
+## Write the world file of an exported image
+#  tcoord are the tile coordinates of the upper left tile
+def write_world_file(filename, tcoord):
+    pixel = 2 * MERCATOR_HALF / (mapUtils.tiles_on_level(tcoord[2]) * TILES_WIDTH)
+    # the world file gives the center of the upper left pixel
+    x = -MERCATOR_HALF + (tcoord[0] * TILES_WIDTH + 0.5) * pixel
+    y = MERCATOR_HALF - (tcoord[1] * TILES_HEIGHT + 0.5) * pixel
+    worldname = os.path.splitext(filename)[0] + '.pgw'
+    file = open(worldname, 'w')
+    try:
+        file.write('%.10f\n0.0\n0.0\n%.10f\n%.10f\n%.10f\n' % (pixel, -pixel, x, y))
+    finally:
+        file.close()
+    return worldname
+
+
+## Export tiles to one big map
+#  tcoord are the tile coordinates of the upper left tile, size the size
+#  of the map in pixels, read_tile returns the image data of the tile at
+#  the given tile coordinates or None if it is missing
+def export_map(filename, tcoord, size, read_tile, threads=EXPORT_THREADS):
+    # Convert given size to a tile size factor
+    xFact = int(size[0]/TILES_WIDTH)
+    yFact = int(size[1]/TILES_HEIGHT)
+    world_tiles = mapUtils.tiles_on_level(tcoord[2])
+
+    def load(coord):
+        # the map wraps around horizontally
+        coord = (coord[0] % world_tiles, coord[1], coord[2])
+        if not (0 <= coord[1] < world_tiles):
+            return None
+        try:
+            return decode_tile(read_tile(coord))
+        except Exception, e:
+            print "Tile not exported: %s %s" % (coord, e)
+            return None
+
+    def band(j):
+        return [(i, j, tcoord[2]) for i in range(tcoord[0], tcoord[0] + xFact)]
+
+    writer = PNGWriter(filename, xFact * TILES_WIDTH, yFact * TILES_HEIGHT)
+    pool = ThreadPool(max(1, threads))
+    try:
+        if not (xFact and yFact):
+            raise ValueError, ("%s is smaller than a tile" % (size,),)
+        pending = pool.map_async(load, band(tcoord[1]))
+        for j in range(tcoord[1], tcoord[1] + yFact):
+            tiles = pending.get()
+            if j + 1 < tcoord[1] + yFact:
+                # decode the next band while this one is encoded
+                pending = pool.map_async(load, band(j + 1))
+            stride = TILES_WIDTH * 4
+            writer.write_rows([''.join([tile and tile[r*stride:(r+1)*stride] or EMPTY_ROW
+                                        for tile in tiles])
+                               for r in range(TILES_HEIGHT)])
+    except:
+        pool.terminate()
+        # do not leave a truncated image behind
+        writer.file.close()
+        os.remove(filename)
+        raise
+    pool.close()
+    pool.join()
+    writer.close()
+    write_world_file(filename, tcoord)
+    return filename
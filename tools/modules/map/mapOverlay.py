@@ -25,14 +25,21 @@
 ## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
 
 import gloclib.algorithms as algorithms
+from gloclib import lrucache
 import map.mapUtils as mapUtils
 from mapConst import *
 import cairo
 from math import pi
+from itertools import count
 import pygtk
 import gtk
 from gloclib.CellRendererButton import CellRendererButton
 
+# tiles rendered by overlays in tiled mode, shared by all overlays
+tile_surfaces = lrucache.LRUCache(OVERLAY_TILE_CACHE)
+# identifies the rendering of an overlay in tile_surfaces
+serials = count()
+
 class MapOverlay:
     """ 
     A class representing overlays on a map. As of now supports points, polygons
@@ -45,7 +52,7 @@ class MapOverlay:
 
     overlaytype = TYPE_POINTS
 
-    def __init__(self,name,foundation,dataset,zoomlevel,mapcenter,overlaytype=TYPE_POINTS, color=(1,0,0,0.35), hulls=False):
+    def __init__(self,name,foundation,dataset,zoomlevel,mapcenter,overlaytype=TYPE_POINTS, color=(1,0,0,0.35), hulls=False, tiled=False):
         """ 
         Initialize MapOverlay
 
@@ -57,8 +64,8 @@ class MapOverlay:
         @type name: str
         @param foundation: id of foundation type (see mapConst.py for foundation types)
         @type foundation: int
-        @param dataset: dataset representing the points of the overlay
-        @type dataset: dict or list
+        @param dataset: dataset representing the points of the overlay, rows that are not in a list (eg. from L{GlocDB.stream}) are reduced to L{compact_points} as they are read
+        @type dataset: dict, list, iterator or numpy.ndarray with latitude and longitude columns
         @param zoomlevel: the zoom level of the map
         @type zoomlevel: int
         @param mapcenter: the center position of the map
@@ -69,11 +76,20 @@ class MapOverlay:
         @type color: tupple
         @param hulls: render a convex hull of the dataset instead of the dataset itself
         @type hulls: bool
+        @param tiled: render the overlay a tile at a time when drawn (see L{render_tile}) instead of on one big buffer image
+        @type tiled: bool
         
         @todo: The see mapConst.py should be an actual link to the static variable
         """
 
         self.dataset = dataset
+        if hasattr(self.dataset, 'dtype'):
+            lat = self.dataset['latitude']
+            lon = self.dataset['longitude']
+            # same as skipping rows without latitude or longitude below
+            self.dataset = self.dataset[(lat == lat) & (lon == lon) & (lat != 0) & (lon != 0)]
+        elif not isinstance(self.dataset, list):
+            self.dataset = compact_points(self.dataset)
         if hulls:
             if type(self.dataset[0]).__name__=='DictRow' or type(self.dataset[0]).__name__=='dict':
                 self.dataset = algorithms.hulls([(x['latitude'],x['longitude']) for x in self.dataset])
@@ -82,12 +98,18 @@ class MapOverlay:
         self.color = color
         if self.color[0] > 1 or self.color[1] > 1 or self.color[2] > 1 or self.color[3] > 1:
             self.color = [float(x)/65535 for x in self.color]
-        self.render(zoomlevel,mapcenter)
+        self.points = self.__points__()
+        self.area = [(point[0],point[1]) for point in self.points]
+        self.projections = lrucache.LRUCache(OVERLAY_PROJECTION_ZOOMS)
+        self.indexes = lrucache.LRUCache(OVERLAY_PROJECTION_ZOOMS)
+        self.segment_indexes = lrucache.LRUCache(OVERLAY_PROJECTION_ZOOMS)
+        self.serial = serials.next()
+        self.tiled = tiled
         self.overlaytype = overlaytype
+        self.render(zoomlevel,mapcenter)
         self.name = name
         self.visible = True
         self.foundation = foundation
-        self.area = None
 
     def __calculate_buffer_size__(self,zoomlevel,mapcenter):
         """ 
@@ -111,7 +133,9 @@ class MapOverlay:
 
     def render(self,zoomlevel,mapcenter):
         """ 
-        Renders the overlay on the buffer image.
+        Renders the overlay on the buffer image. In tiled mode only works out
+        which tiles the overlay is drawn on, the tiles themselves are rendered
+        by L{render_tile}.
 
         @author: Brendan Johan Lee
         @contact: brendajl@simula.no
@@ -124,92 +148,472 @@ class MapOverlay:
         """
 
         self.zoomlevel = zoomlevel
-        self.affectedtiles = {}
         self.affectednotrendered = {}
         self.__calculate_buffer_size__(zoomlevel,mapcenter)
+        self.buckets, self.affectedtiles = self.__index__(zoomlevel)
+        polygon = self.overlaytype == TYPE_POLYGON or self.overlaytype == TYPE_FILLEDPOLYGON
+
+        if (polygon or self.overlaytype == TYPE_PATH) and self.affectedtiles:
+            minx = min([tile[0] for tile in self.affectedtiles])
+            maxx = max([tile[0] for tile in self.affectedtiles])
+            miny = min([tile[1] for tile in self.affectedtiles])
+            maxy = max([tile[1] for tile in self.affectedtiles])
+            self.affectedtiles = {}
+            for a in range(minx,maxx+1):
+                for b in range(miny,maxy+1):
+                    self.affectedtiles[(a,b)] = True
+                    if not self.tiled and not self.__inbounds__((a,b)):
+                        self.affectednotrendered[a,b] = True
+
+        if self.tiled:
+            self.surface = None
+            return
+
         self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
         self.context = cairo.Context(self.surface)
 
-        affected = []
-        self.area = []
+        print "color: ", self.color
+        if polygon:
+            # the outline needs every point, also those outside of the buffer
+            indices = xrange(len(self.points))
+        else:
+            # only visit the points and lines in tiles within the buffer, in dataset order
+            indices = self.__nearby__([(tx,ty) for tx in xrange(self.bounds[0]+1,self.bounds[2])
+                                               for ty in xrange(self.bounds[1]+1,self.bounds[3])])
+        self.__draw__(self.context,indices,(self.bounds[0],self.bounds[1]),zoomlevel)
+
+    def render_tile(self,tile_coord):
+        """ 
+        Render the overlay on a single tile, on the zoom level of the last call
+        to L{render}. Rendered tiles are kept in a LRU cache shared by all
+        overlays, so memory use follows the number of tiles on screen rather
+        than the number of overlays. Only the points and lines near the tile
+        are drawn (see L{__segments__}), except for filled polygons whose
+        outline crosses the tile.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param tile_coord: horizontal and vertical coordinate of tile
+        @type tile_coord: list
+
+        @return: tile sized image of the overlay, or None if the overlay is not on the tile
+        @rtype: cairo.ImageSurface
+        """
+
+        tile = (tile_coord[0],tile_coord[1])
+        if tile not in self.affectedtiles:
+            return None
+        key = (self.serial,self.zoomlevel,tile)
+        if key in tile_surfaces:
+            return tile_surfaces[key]
+
+        if self.overlaytype == TYPE_FILLEDPOLYGON:
+            segments, rows = self.__segments__(self.zoomlevel)
+            if tile not in segments:
+                # the tile is either inside or outside of the polygon as a whole
+                if not self.__winding__(tile,rows):
+                    tile_surfaces[key] = None
+                    return None
+                surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, TILES_WIDTH, TILES_HEIGHT)
+                context = cairo.Context(surface)
+                context.set_source_rgba(*self.color)
+                context.rectangle(0,0,TILES_WIDTH,TILES_HEIGHT)
+                context.fill()
+                tile_surfaces[key] = surface
+                return surface
+            # the fill depends on the whole outline, leave the clipping to cairo
+            indices = xrange(len(self.points))
+        else:
+            # points and lines on the neighbour tiles may overlap into this one
+            tiles = [(tile[0]+a,tile[1]+b) for a in (-1,0,1) for b in (-1,0,1)]
+            indices = self.__nearby__(tiles)
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, TILES_WIDTH, TILES_HEIGHT)
+        self.__draw__(cairo.Context(surface),indices,tile,self.zoomlevel)
+        tile_surfaces[key] = surface
+        return surface
+
+    def __nearby__(self,tiles):
+        """
+        Return the indices of the points drawn on some tiles: the points in
+        the tiles and, for paths and polygon outlines, both ends of the lines
+        crossing them.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param tiles: horizontal and vertical tile coordinates
+        @type tiles: list of tupples
+
+        @return: indices of the points, in dataset order
+        @rtype: list of int
+        """
+
+        indices = {}
+        for tile in tiles:
+            for i in self.buckets.get(tile,()):
+                indices[i] = True
+        if self.overlaytype != TYPE_POINTS:
+            segments = self.__segments__(self.zoomlevel)[0]
+            for tile in tiles:
+                for i in segments.get(tile,()):
+                    indices[i-1] = True
+                    indices[i] = True
+        indices = indices.keys()
+        indices.sort()
+        return indices
+
+    def __draw__(self,context,indices,origin,zoomlevel):
+        """ 
+        Draw points of the overlay on a context.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param context: context to draw on
+        @type context: cairo.Context
+        @param indices: indices of the points to draw, in dataset order
+        @type indices: list of int
+        @param origin: tile drawn at the top left corner of the context
+        @type origin: tupple
+        @param zoomlevel: zoom level of map
+        @type zoomlevel: int
+        """
+
+        tiles_x, tiles_y, offsets_x, offsets_y = self.__project__(zoomlevel)
+        polygon = self.overlaytype == TYPE_POLYGON or self.overlaytype == TYPE_FILLEDPOLYGON
 
         self.prevpoint = None
+        # lines only join points that follow each other in the dataset
+        previous = None
+
+        context.set_source_rgba(*self.color)
+        if polygon:
+            context.set_line_width(3)
+
+        for i in indices:
+            point = self.points[i]
+            x = ((tiles_x[i]-origin[0])*TILES_WIDTH)+offsets_x[i]
+            y = ((tiles_y[i]-origin[1])*TILES_HEIGHT)+offsets_y[i]
+
+            if polygon:
+                if previous is not None and previous != i-1:
+                    context.move_to(x,y)
+                else:
+                    context.line_to(x,y)
+            else:
+                if len(point) > 2:
+                    try: 
+                        context.set_source_rgba(*point[2])
+                    except:
+                        pass
+                context.arc(x,y,self.__radius__(zoomlevel),0,2*pi)
+                context.fill()
+                if self.overlaytype == TYPE_PATH and self.prevpoint and previous == i-1:
+                    context.move_to(*self.prevpoint)
+                    context.line_to(x, y)
+                    context.stroke()
+                    context.close_path()
+                self.prevpoint = (x, y)
+            previous = i
 
-        print "color: ", self.color
-        self.context.set_source_rgba(*self.color)
-        if self.overlaytype == TYPE_POLYGON or self.overlaytype == TYPE_FILLEDPOLYGON:
-            self.context.set_line_width(3)
+        if self.overlaytype == TYPE_POLYGON:
+            context.stroke()
+        elif self.overlaytype == TYPE_FILLEDPOLYGON:
+            context.close_path()
+            context.fill()
+
+    def __inbounds__(self,tile):
+        """ 
+        Check if a tile is within the buffer image of the last rendering.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param tile: horizontal and vertical tile coordinate
+        @type tile: tupple
+
+        @return: True if the tile is rendered on the buffer image
+        @rtype: bool
+        """
+
+        return tile[0] > self.bounds[0] and tile[0] < self.bounds[2] and tile[1] > self.bounds[1] and tile[1] < self.bounds[3]
+
+    def __radius__(self,zoomlevel):
+        """ 
+        Return the radius in pixels of the dots drawn for points.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param zoomlevel: zoom level of map
+        @type zoomlevel: int
+
+        @return: radius of dots
+        @rtype: int
+        """
+
+        return 3-zoomlevel if 3 - zoomlevel > 0 else 3
+
+    def __index__(self,zoomlevel):
+        """ 
+        Return a spatial index of the points on a zoom level: the indices of
+        the points bucketed by the tile they are in, and the tiles the points
+        are drawn on (a point close to the edge of a tile also marks its
+        neighbour tiles). Like the projections, indexes are kept for the last
+        few zoom levels used.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param zoomlevel: zoom level of map
+        @type zoomlevel: int
+
+        @return: point indices per tile, tiles affected by the points
+        @rtype: tupple of dicts
+        """
+
+        if zoomlevel in self.indexes:
+            return self.indexes[zoomlevel]
+
+        tiles_x, tiles_y, offsets_x, offsets_y = self.__project__(zoomlevel)
+        buckets = {}
+        affected = {}
+        spill = 15-zoomlevel
+        for i in xrange(len(tiles_x)):
+            tile = (tiles_x[i],tiles_y[i])
+            if tile in buckets:
+                buckets[tile].append(i)
+            else:
+                buckets[tile] = [i]
+            # mark tiles that point overlaps into as "dirty"
+            for a in ((offsets_x[i]-spill)//TILES_WIDTH, 0, (offsets_x[i]+spill)//TILES_WIDTH):
+                for b in ((offsets_y[i]-spill)//TILES_HEIGHT, 0, (offsets_y[i]+spill)//TILES_HEIGHT):
+                    affected[(tile[0]+a,tile[1]+b)] = True
+
+        index = (buckets, affected)
+        self.indexes[zoomlevel] = index
+        return index
+
+    def __segments__(self,zoomlevel):
+        """
+        Return a spatial index of the lines of a path or polygon on a zoom
+        level: the lines bucketed by the tiles they cross, and by the rows of
+        tiles they span. Line i joins point i-1 and point i, line 0 closes a
+        filled polygon. Kept for the last few zoom levels used, like the
+        point index.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param zoomlevel: zoom level of map
+        @type zoomlevel: int
+
+        @return: line numbers per tile, line numbers per row of tiles
+        @rtype: tupple of dicts
+        """
+
+        if zoomlevel in self.segment_indexes:
+            return self.segment_indexes[zoomlevel]
+
+        segments = {}
+        rows = {}
+        first = 1
+        if self.overlaytype == TYPE_FILLEDPOLYGON:
+            first = 0
+        for i in xrange(first,len(self.points)):
+            (x0,y0),(x1,y1) = self.__ends__(i,zoomlevel)
+            for ty in xrange(min(y0,y1)//TILES_HEIGHT,max(y0,y1)//TILES_HEIGHT+1):
+                rows.setdefault(ty,[]).append(i)
+            if x0 > x1:
+                x0,y0,x1,y1 = x1,y1,x0,y0
+            # walk the columns of tiles the line spans, and the tiles it
+            # crosses in each of them
+            for tx in xrange(x0//TILES_WIDTH,x1//TILES_WIDTH+1):
+                if x0 == x1:
+                    ya,yb = y0,y1
+                else:
+                    slope = float(y1-y0)/(x1-x0)
+                    ya = y0+(max(x0,tx*TILES_WIDTH)-x0)*slope
+                    yb = y0+(min(x1,(tx+1)*TILES_WIDTH)-x0)*slope
+                for ty in xrange(int(min(ya,yb)//TILES_HEIGHT),int(max(ya,yb)//TILES_HEIGHT)+1):
+                    segments.setdefault((tx,ty),[]).append(i)
+
+        index = (segments, rows)
+        self.segment_indexes[zoomlevel] = index
+        return index
+
+    def __ends__(self,i,zoomlevel):
+        """
+        Return the ends of line i of the overlay, in pixels from the top left
+        corner of the map.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param i: line number, see L{__segments__}
+        @type i: int
+        @param zoomlevel: zoom level of map
+        @type zoomlevel: int
+
+        @return: horizontal and vertical position of point i-1 and of point i
+        @rtype: tupple of tupples
+        """
+
+        tiles_x, tiles_y, offsets_x, offsets_y = self.__project__(zoomlevel)
+        return tuple([(tiles_x[j]*TILES_WIDTH+offsets_x[j],tiles_y[j]*TILES_HEIGHT+offsets_y[j])
+                      for j in (i-1,i)])
+
+    def __winding__(self,tile,rows):
+        """
+        Return the winding number of the filled polygon around the center of
+        a tile, which is nonzero if the center is filled. Only counts the
+        lines spanning the row of the tile.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param tile: horizontal and vertical tile coordinate
+        @type tile: tupple
+        @param rows: line numbers per row of tiles, see L{__segments__}
+        @type rows: dict
+
+        @return: winding number
+        @rtype: int
+        """
+
+        cx = tile[0]*TILES_WIDTH+TILES_WIDTH/2.0
+        cy = tile[1]*TILES_HEIGHT+TILES_HEIGHT/2.0
+        winding = 0
+        for i in rows.get(tile[1],()):
+            (x0,y0),(x1,y1) = self.__ends__(i,self.zoomlevel)
+            if (y0 <= cy) == (y1 <= cy):
+                continue
+            # lines crossing the row left of the center
+            if x0+(cy-y0)*float(x1-x0)/(y1-y0) < cx:
+                if y1 > y0:
+                    winding += 1
+                else:
+                    winding -= 1
+        return winding
+
+    def hit_test(self,tile_coord,offset,radius=None):
+        """ 
+        Return the points of the overlay drawn at a position on the map, on
+        the zoom level of the last rendering. Uses the spatial index, so only
+        the points in the tiles around the position are checked.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param tile_coord: horizontal and vertical coordinate of tile
+        @type tile_coord: tupple
+        @param offset: horizontal and vertical offset within tile
+        @type offset: tupple
+        @param radius: distance in pixels a point may be from the position, defaults to the radius of the drawn dots
+        @type radius: int
+
+        @return: points hit, in dataset order
+        @rtype: list of tupples
+        """
+
+        if radius is None:
+            radius = self.__radius__(self.zoomlevel)
+        tiles_x, tiles_y, offsets_x, offsets_y = self.__project__(self.zoomlevel)
+        buckets = self.__index__(self.zoomlevel)[0]
+        x = tile_coord[0]*TILES_WIDTH+offset[0]
+        y = tile_coord[1]*TILES_HEIGHT+offset[1]
+        hits = []
+        for a in (-1,0,1):
+            for b in (-1,0,1):
+                for i in buckets.get((tile_coord[0]+a,tile_coord[1]+b),()):
+                    dx = tiles_x[i]*TILES_WIDTH+offsets_x[i]-x
+                    dy = tiles_y[i]*TILES_HEIGHT+offsets_y[i]-y
+                    if dx*dx+dy*dy <= radius*radius:
+                        hits.append(i)
+        hits.sort()
+        return [self.points[i] for i in hits]
+
+    def __project__(self,zoomlevel):
+        """ 
+        Return the tile coordinates and offsets within the tiles of all points
+        on a zoom level. Projections are kept for the last few zoom levels used
+        (see OVERLAY_PROJECTION_ZOOMS), so panning and going back to a zoom
+        level seen before does not project the points again.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
 
+        @param zoomlevel: zoom level of map
+        @type zoomlevel: int
+
+        @return: horizontal tiles, vertical tiles, horizontal offsets, vertical offsets
+        @rtype: tupple of lists
+        """
+
+        if zoomlevel in self.projections:
+            return self.projections[zoomlevel]
+
+        if mapUtils.numpy and self.points:
+            if hasattr(self.dataset, 'dtype') and len(self.dataset) == len(self.points):
+                lat, lon = self.dataset['latitude'], self.dataset['longitude']
+            else:
+                lat = [point[0] for point in self.points]
+                lon = [point[1] for point in self.points]
+            projection = tuple([a.tolist() for a in mapUtils.coord_to_tile_array(lat, lon, zoomlevel)])
+        else:
+            projection = ([],[],[],[])
+            for point in self.points:
+                dp = mapUtils.coord_to_tile((point[0],point[1],zoomlevel))
+                projection[0].append(dp[0][0])
+                projection[1].append(dp[0][1])
+                projection[2].append(dp[1][0])
+                projection[3].append(dp[1][1])
+
+        self.projections[zoomlevel] = projection
+        return projection
+
+    def __points__(self):
+        """ 
+        Return the points of the dataset as (latitude, longitude) tupples, with
+        an optional color as third element. Rows without a position are
+        skipped, and points are only returned up to the first entry of an
+        unsupported type.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: points of the dataset
+        @rtype: list of tupples
+        """
+
+        if hasattr(self.dataset, 'dtype'):
+            return zip(self.dataset['latitude'].tolist(), self.dataset['longitude'].tolist())
+
+        points = []
         for point in self.dataset:
             if type(point).__name__=='DictRow' or type(point).__name__=='dict':
                 if not point['latitude'] or not point['longitude']: 
                     continue
-                dp = mapUtils.coord_to_tile((point['latitude'],point['longitude'],zoomlevel))
-                self.area.append((point['latitude'],point['longitude']))
+                points.append((point['latitude'],point['longitude']))
             elif type(point).__name__=='tuple':
-                dp = mapUtils.coord_to_tile((point[0],point[1],zoomlevel))
-                self.area.append((point[0],point[1]))
+                points.append(point)
             else:
-                return
-
-            x = ((dp[0][0]-self.bounds[0])*TILES_WIDTH)+dp[1][0]
-            y = ((dp[0][1]-self.bounds[1])*TILES_HEIGHT)+dp[1][1]
-
-            if self.overlaytype == TYPE_POLYGON or self.overlaytype == TYPE_FILLEDPOLYGON:
-                self.context.line_to(x,y)
-
-            if dp[0][0] > self.bounds[0] and dp[0][0] < self.bounds[2] and dp[0][1] > self.bounds[1] and dp[0][1] < self.bounds[3]:
-                if not(self.overlaytype == TYPE_POLYGON or self.overlaytype == TYPE_FILLEDPOLYGON):
-                    if len(point) > 2:
-                        try: 
-                            self.context.set_source_rgba(*point[2])
-                        except:
-                            pass
-                    self.context.arc(x,y,3-zoomlevel if 3 - zoomlevel > 0 else 3,0,2*pi)
-                    self.context.fill()
-                    if self.overlaytype == TYPE_PATH and self.prevpoint:
-                        self.context.move_to(*self.prevpoint)
-                        self.context.line_to(x, y)
-                        self.context.stroke()
-                        self.context.close_path()
-                    self.prevpoint = (x, y)
-            else: 
-                self.affectednotrendered[dp[0][0],dp[0][1]] = True
-
-            affected.append((dp[0][0],dp[0][1]))
-            # mark tiles that point overlaps into as "dirty"
-            dx = ((x-(15-zoomlevel))/TILES_WIDTH, x/TILES_WIDTH, (x+(15-zoomlevel))/TILES_WIDTH)
-            dy = ((y-(15-zoomlevel))/TILES_HEIGHT, y/TILES_HEIGHT, (y+(15-zoomlevel))/TILES_HEIGHT)
-            tx = x/TILES_WIDTH;
-            ty = y/TILES_HEIGHT;
-            for a in dx:
-                for b in dy:
-                    if not a==tx or not b==ty:
-                        #TODO: This will not work if the tile happens to be just at the edge of the buffer
-                        affected.append((dp[0][0]+(a-tx),dp[0][1]+(b-ty)))
-
-        
-        if self.overlaytype == TYPE_POLYGON:
-            self.context.stroke()
-        elif self.overlaytype == TYPE_FILLEDPOLYGON:
-            self.context.close_path()
-            self.context.fill()
-        
-        if self.overlaytype == TYPE_POLYGON or self.overlaytype == TYPE_FILLEDPOLYGON or self.overlaytype == TYPE_PATH:
-            minx = sorted(affected, key=lambda x:(x[0]))[0][0]
-            maxx = sorted(affected, key=lambda x:(x[0]))[-1][0]
-            miny = sorted(affected, key=lambda x:(x[1]))[0][1]
-            maxy = sorted(affected, key=lambda x:(x[1]))[-1][1]
-            for a in range(minx,maxx+1):
-                for b in range(miny,maxy+1):
-                    self.affectedtiles[(a,b)] = True
-                    if not(a > self.bounds[0] and a < self.bounds[2] and b > self.bounds[1] and b < self.bounds[3]):
-                        self.affectednotrendered[a,b] = True
-
-        else:
-            for tile in affected:
-                if tile not in self.affectedtiles:
-                    self.affectedtiles[tile] = True
+                break
+        return points
 
     def get_area(self):
         """ 
@@ -248,7 +652,10 @@ class MapOverlay:
         @rtype: tupple
         """
 
-        if (coord[0],coord[1]) in self.affectednotrendered:
+        tile = (coord[0],coord[1])
+        if self.tiled:
+            return None
+        if tile in self.affectednotrendered or (tile in self.buckets and not self.__inbounds__(tile)):
             self.render(self.zoomlevel,mapcenter)
         if (coord[0],coord[1]) not in self.affectedtiles:
             return None
@@ -275,6 +682,32 @@ class MapOverlay:
         """
 
         self.color = (r,g,b,a)
+        self.serial = serials.next()
+
+def compact_points(rows):
+    """ 
+    Reduce database rows to (latitude, longitude) tupples, skipping rows without
+    a position. Used to build overlays from streamed query results without
+    holding on to the full rows.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+
+    @param rows: rows containing at least latitude and longitude
+    @type rows: iterable of DictRow, dict or tupple
+
+    @return: positions of the rows
+    @rtype: list of tupples
+    """
+
+    points = []
+    for row in rows:
+        if type(row).__name__=='tuple':
+            points.append(row)
+        elif row['latitude'] and row['longitude']:
+            points.append((row['latitude'],row['longitude']))
+    return points
 
 def getbounds(points):
     """ 
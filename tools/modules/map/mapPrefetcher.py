@@ -0,0 +1,245 @@
+"""
+ Prefetches the map tiles the user is likely to look at next: those ahead
+ of the view while panning, and those of the zoom levels above and below.
+
+ @author: Brendan Johan Lee
+ @contact: brendajl@simula.no
+ @version: 1.0
+"""
+## GNU General Public Licence (GPL)
+
+## This program is free software; you can redistribute it and / or modify it under
+## the terms of the GNU General Public License as published by the Free Software
+## Foundation; either version 2 of the License,  or (at your option) any later
+## version.
+## This program is distributed in the hope that it will be useful,  but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+## FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+## details.
+## You should have received a copy of the GNU General Public License along with
+## this program; if not,  write to the Free Software Foundation,  Inc.,  59 Temple
+## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
+
+from __future__ import division
+import time
+from collections import deque
+
+from map.mapConst import *
+from map.mapDownloader import QUERY_QUEUED, QUERY_DROPPED
+
+class MapPrefetcher:
+    """
+    Queues prefetch tasks with a MapDownloader. Pan direction and speed are
+    estimated from the map centers of recent motion events, and the view
+    is extrapolated lookahead seconds ahead. The zoom level the user moved
+    to last time decides which neighbouring zoom level is fetched first.
+
+    Prefetching is bounded by a rate in tiles per second and by the
+    prefetch_limit of the downloader, and prefetch tasks have the lowest
+    priority in its queue, so tiles in view are never kept waiting.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, downloader, rate=PREFETCH_RATE, lookahead=PREFETCH_LOOKAHEAD,
+                 window=PREFETCH_WINDOW, remember=PREFETCH_REMEMBER):
+        """
+        Initialize MapPrefetcher
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param downloader: downloader to queue the prefetch tasks with
+        @type downloader: MapDownloader
+        @param rate: prefetch tasks queued per second at most
+        @type rate: float
+        @param lookahead: seconds of panning to prefetch tiles for
+        @type lookahead: float
+        @param window: seconds of motion the pan speed is estimated from
+        @type window: float
+        @param remember: tiles remembered as prefetched, the oldest are forgotten
+        @type remember: int
+        """
+
+        self.downloader = downloader
+        self.rate = rate
+        self.lookahead = lookahead
+        self.window = window
+        self.remember = remember
+        # time and map center in pixels of recent motion events
+        self.samples = deque()
+        self.zoom = None
+        self.layer = None
+        self.mapServ = None
+        # zooming in lowers the zoom level, assume that is next
+        self.zoom_direction = -1
+        # tiles already prefetched or offline for this zoom level, layer and
+        # map server, and the order they were added in
+        self.requested = set()
+        self.requested_order = deque()
+        self.tokens = rate
+        self.refilled = time.time()
+
+    def moved(self, center, size, zoom, layer, mapServ, styleID=1):
+        """
+        Tell the prefetcher the view has changed, and prefetch for it.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param center: map center
+        @type center: list
+        @param size: size of the visible map
+        @type size: list
+        @param zoom: zoom level of map
+        @type zoom: int
+        @param layer: map layer
+        @type layer: int
+        @param mapServ: name of mapserver
+        @type mapServ: str
+        @param styleID: map style to use
+        @type styleID: int
+
+        @return: number of prefetch tasks queued
+        @rtype: int
+        """
+
+        now = time.time()
+        if (zoom, layer, mapServ) != (self.zoom, self.layer, self.mapServ):
+            if self.zoom is not None and zoom != self.zoom:
+                self.zoom_direction = zoom > self.zoom and 1 or -1
+            self.zoom = zoom
+            self.layer = layer
+            self.mapServ = mapServ
+            self.samples.clear()
+            self.requested.clear()
+            self.requested_order.clear()
+        self.samples.append((now, center[0][0]*TILES_WIDTH + center[1][0],
+                             center[0][1]*TILES_HEIGHT + center[1][1]))
+        while now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        queued = 0
+        for coord in self.candidates(center, size, zoom):
+            if self.tokens < 1 or self.downloader.prefetching >= self.downloader.prefetch_limit:
+                break
+            if coord in self.requested:
+                continue
+            result = self.downloader.query_tile(coord, layer, None, mapServ=mapServ,
+                                                styleID=styleID, prefetch=True)
+            if result == QUERY_DROPPED:
+                # over the limit or in flight, worth trying again later
+                continue
+            self.__remember__(coord)
+            if result == QUERY_QUEUED:
+                self.tokens -= 1
+                queued += 1
+        return queued
+
+    def __remember__(self, coord):
+        """
+        Remember a tile as prefetched or offline, forgetting the oldest
+        tiles beyond remember.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param coord: tile coordinates
+        @type coord: tupple
+        """
+
+        self.requested.add(coord)
+        self.requested_order.append(coord)
+        while len(self.requested_order) > self.remember:
+            self.requested.discard(self.requested_order.popleft())
+
+    def velocity(self):
+        """
+        Return the pan velocity estimated from recent motion events.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: horizontal and vertical pixels per second
+        @rtype: tupple
+        """
+
+        if len(self.samples) < 2:
+            return (0, 0)
+        t0, x0, y0 = self.samples[0]
+        t1, x1, y1 = self.samples[-1]
+        if t1 <= t0:
+            return (0, 0)
+        return ((x1 - x0) / (t1 - t0), (y1 - y0) / (t1 - t0))
+
+    def candidates(self, center, size, zoom):
+        """
+        Return the tiles worth prefetching, most useful first: the tiles the
+        view is panning into, then those of the likely next zoom level, then
+        those of the other neighbouring zoom level.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param center: map center
+        @type center: list
+        @param size: size of the visible map
+        @type size: list
+        @param zoom: zoom level of map
+        @type zoom: int
+
+        @return: tile coordinates
+        @rtype: list
+        """
+
+        region = self.downloader.get_region_around_point(center, size, zoom)
+        candidates = []
+
+        vx, vy = self.velocity()
+        # at most one view ahead, a fling should not fetch half the world
+        dx = max(-size[0], min(size[0], vx * self.lookahead))
+        dy = max(-size[1], min(size[1], vy * self.lookahead))
+        if int(dx) or int(dy):
+            ahead = (center[0], (center[1][0] + dx, center[1][1] + dy))
+            candidates.extend([coord for coord in self.__tiles__(ahead, size, zoom)
+                               if not (region[0] <= coord[0] <= region[1] and
+                                       region[2] <= coord[1] <= region[3])])
+
+        for next_zoom in (zoom + self.zoom_direction, zoom - self.zoom_direction):
+            if not (MAP_MIN_ZOOM_LEVEL <= next_zoom <= MAP_MAX_ZOOM_LEVEL):
+                continue
+            scale = 2 ** (zoom - next_zoom)
+            x = int((center[0][0]*TILES_WIDTH + center[1][0]) * scale)
+            y = int((center[0][1]*TILES_HEIGHT + center[1][1]) * scale)
+            scaled = ((x // TILES_WIDTH, y // TILES_HEIGHT), (x % TILES_WIDTH, y % TILES_HEIGHT))
+            candidates.extend(self.__tiles__(scaled, size, next_zoom))
+        return candidates
+
+    def __tiles__(self, center, size, zoom):
+        """
+        Return the tiles of the view around a center, nearest first.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: tile coordinates
+        @rtype: list
+        """
+
+        xmin, xmax, ymin, ymax = self.downloader.get_region_around_point(center, size, zoom)
+        cx = center[0][0] + center[1][0] / TILES_WIDTH
+        cy = center[0][1] + center[1][1] / TILES_HEIGHT
+        tiles = [((x + 0.5 - cx)**2 + (y + 0.5 - cy)**2, (x, y, zoom))
+                 for x in xrange(xmin, xmax + 1) for y in xrange(ymin, ymax + 1)]
+        tiles.sort()
+        return [coord for distance, coord in tiles]
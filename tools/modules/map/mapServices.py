@@ -4,9 +4,12 @@
 import os
 import gtk
 import sys
+import time
 from gloclib import fileUtils
 import tilesRepoFS
-from gloclib import openanything
+import tilesRepoSQLite
+import tilesRepoArchive
+from gloclib import httppool
 
 from mapServers import googleMaps
 from mapServers import openStreetMaps
@@ -18,7 +21,7 @@ from mapServers import googleMapMaker
 from mapServers import virtualEarth
 
 from mapConst import *
-from threading import Timer
+from threading import Timer, Lock
 from gobject import TYPE_STRING
 
 ## All the interaction with the map services.
@@ -36,15 +39,29 @@ class MapServ:
         #fileUtils.write_file('location', self.locationpath, self.locations)
         return None
 
-    def __init__(self, configpath=None):
+    def __init__(self, configpath=None, cache_budgets=PIXBUF_CACHE_BUDGETS,
+                    repository=REPOSITORY_FILES, archive=None, max_age=TILE_MAX_AGE):
         configpath = os.path.expanduser(configpath or DEFAULT_PATH)
         self.mt_counter=0
+        self.max_age = max_age
+        # revalidated tiles the servers answered 304 Not Modified for,
+        # counted by the download threads under lock
+        self.not_modified = 0
+        self.lock = Lock()
         self.configpath = fileUtils.check_dir(configpath)
         self.locationpath = os.path.join(self.configpath, 'locations')
         self.locations = {}
+        # kept connections to the tile servers, shared by the download threads
+        self.http = httppool.HTTPPool()
 
         #implementation of the method is set in maps.py:__init__()
-        self.tile_repository = tilesRepoFS.TilesRepositoryFS(self)
+        if repository == REPOSITORY_SQLITE:
+            self.tile_repository = tilesRepoSQLite.TilesRepositorySQLite(self, cache_budgets)
+        elif repository == REPOSITORY_ARCHIVE:
+            self.tile_repository = tilesRepoArchive.TilesRepositoryArchive(
+                self, cache_budgets, archive or os.path.join(self.configpath, ARCHIVE_NAME))
+        else:
+            self.tile_repository = tilesRepoFS.TilesRepositoryFS(self, cache_budgets)
 
         if (os.path.exists(self.locationpath)):
             self.read_locations()
@@ -53,9 +70,20 @@ class MapServ:
 
     def finish(self):
         self.tile_repository.finish()
+        self.http.closeall()
         if self.exThread:
             self.exThread.cancel()
 
+    ## Returns the statistics of the connections to the tile servers
+    def http_stats(self):
+        stats = self.http.stats()
+        self.lock.acquire()
+        try:
+            stats['not_modified'] = self.not_modified
+        finally:
+            self.lock.release()
+        return stats
+
     def get_locations(self):
         return self.locations
 
@@ -98,18 +126,61 @@ class MapServ:
         else:
             return googleMaps.get_url(self.mt_counter, coord, layer)
 
-    def get_tile_from_coord(self, coord, layer, mapServ, styleID):
+    ## Download a tile into the tile_repository
+    #  meta is the metadata of the stored copy of the tile, see
+    #  get_tile_meta(), with it the request is conditional
+    def download_tile(self, coord, layer, mapServ, styleID, meta=None):
         href = self.get_url_from_coord(coord, layer, mapServ, styleID)
         if href:
+            print 'downloading:', href
+            validators = meta or {}
+            oa = self.http.fetch(href, validators.get('etag'), validators.get('lastmodified'))
+            self.store_response(coord, layer, mapServ, oa['status'], oa['data'],
+                                oa['etag'], oa['lastmodified'], meta)
+
+    ## Store the response to the download of a tile in the tile_repository
+    #  A 304 Not Modified to a conditional request only marks the stored
+    #  copy as fetched now
+    def store_response(self, coord, layer, mapServ, status, data,
+                        etag, lastmodified, meta=None):
+        fresh = {'etag': etag, 'lastmodified': lastmodified, 'fetched': time.time()}
+        if status == 304 and meta is not None:
+            # the server need not repeat the validators of the stored copy
+            fresh['etag'] = etag or meta.get('etag')
+            fresh['lastmodified'] = lastmodified or meta.get('lastmodified')
+            self.tile_repository.touch_tile(coord, layer, mapServ, fresh)
+            self.lock.acquire()
             try:
-                print 'downloading:', href
-                oa = openanything.fetch(href)
-                if oa['status']==200:
-                    return oa['data']
-                else:
-                    raise RuntimeError, ("HTTP Reponse is: " + str(oa['status']),)
-            except:
-                raise
+                self.not_modified += 1
+            finally:
+                self.lock.release()
+        elif status == 200:
+            self.tile_repository.put_tile(coord, layer, mapServ, data, fresh)
+        else:
+            raise RuntimeError, ("HTTP Reponse is: " + str(status),)
+
+    ## Returns the ETag, Last-Modified and fetch time of a stored tile
+    #  as a dict of etag, lastmodified and fetched, or None
+    def get_tile_meta(self, coord, layer, mapServ):
+        return self.tile_repository.get_meta(coord, layer, mapServ)
+
+    ## Iterates over the tiles in the tile_repository as
+    #  (mapServ, layer, coord, size, used)
+    def stored_tiles(self):
+        return self.tile_repository.tiles()
+
+    ## Remove a tile from the tile_repository
+    def remove_tile(self, coord, layer, mapServ):
+        self.tile_repository.remove_tile(coord, layer, mapServ)
+
+    ## Returns true if a stored tile with this metadata should be
+    #  revalidated by a forced update
+    def is_stale(self, meta):
+        return meta is None or time.time() - meta['fetched'] > self.max_age
+
+    ## Returns true if downloaded tiles can not be stored
+    def is_read_only(self):
+        return self.tile_repository.read_only
 
     def get_file(self, coord, layer, online, force_update,
                                 mapServ='Google', styleID =1):
@@ -119,12 +190,13 @@ class MapServ:
 
     ## Call the do_export in the tile_repository
     # Export tiles to one big map
-    def do_export(self, tcoord, layer, online, mapServ, styleID, size):
+    def do_export(self, tcoord, layer, online, mapServ, styleID, size,
+                  filename=EXPORT_NAME, threads=EXPORT_THREADS):
         def exportThread():
             self.tile_repository.do_export(
-                tcoord, layer, online, mapServ, styleID, size
+                tcoord, layer, online, mapServ, styleID, size, filename, threads
             )
-            print "Export completed!"
+            print "Export completed: %s" % filename
         self.exThread = Timer(0, exportThread)
         self.exThread.start()
 
@@ -132,6 +204,16 @@ class MapServ:
     def load_pixbuf(self, coord, layer, force_update, mapServ):
         return self.tile_repository.load_pixbuf(coord, layer, force_update, mapServ)
 
+    ## Returns the decoded tile if it is in memory, without touching the disk
+    def cached_pixbuf(self, coord, layer, mapServ):
+        return self.tile_repository.tile_cache.peek(
+                    self.tile_repository.coord_to_path(coord, layer, mapServ), layer
+                )
+
+    ## Returns the counters of the decoded tile cache, see PixbufCache.stats()
+    def cache_stats(self):
+        return self.tile_repository.tile_cache.stats()
+
 
     def completion_model(self, strAppend=''):
         store = gtk.ListStore(TYPE_STRING)
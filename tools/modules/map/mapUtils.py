@@ -1,9 +1,14 @@
 ## @package src.mapUtils
 # A group of map utilities
 
+import os
 import math
 from mapConst import *
 from time import gmtime, strftime
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def tiles_on_level(zoom_level):
     return 1<<(MAP_MAX_ZOOM_LEVEL-int(zoom_level))
@@ -53,6 +58,131 @@ def km_per_pixel(coord):
     world_tiles = tiles_on_level(coord[2])
     return 2*math.pi*R_EARTH/world_tiles/TILES_WIDTH * math.cos(coord[0]*math.pi/180.0)
 
+## Array version of coord_to_tile
+# Converts arrays of latitudes and longitudes on one zoom level to arrays
+# of tile x, tile y, x offset in tile and y offset in tile.
+# Does the same operations in the same order as coord_to_tile,
+# so the results are identical.
+def coord_to_tile_array(lat, lon, zoom_level):
+    world_tiles = tiles_on_level(zoom_level)
+    x = world_tiles / 360.0 * (numpy.asarray(lon, numpy.float64) + 180.0)
+    tiles_pre_radian = world_tiles / (2 * math.pi)
+    e = numpy.sin(numpy.asarray(lat, numpy.float64) * (1/180.*math.pi))
+    y = world_tiles//2 + 0.5*numpy.log((1+e)/(1-e)) * (-tiles_pre_radian)
+    xint = numpy.trunc(x)
+    yint = numpy.trunc(y)
+    return numpy.mod(xint.astype(numpy.int64), world_tiles), \
+           numpy.mod(yint.astype(numpy.int64), world_tiles), \
+           ((x - xint) * TILES_WIDTH).astype(numpy.int64), \
+           ((y - yint) * TILES_HEIGHT).astype(numpy.int64)
+
+## Array version of tile_to_coord
+# Converts arrays of tile x, tile y, x offset and y offset on one zoom level
+# to arrays of latitudes and longitudes
+def tile_to_coord_array(tile_x, tile_y, offset_x, offset_y, zoom):
+    world_tiles = tiles_on_level(zoom)
+    x = ( numpy.asarray(tile_x) + 1.0*numpy.asarray(offset_x)/TILES_WIDTH ) / (world_tiles/2.) - 1 # -1...1
+    y = ( numpy.asarray(tile_y) + 1.0*numpy.asarray(offset_y)/TILES_HEIGHT) / (world_tiles/2.) - 1 # -1...1
+    lon = x * 180.0
+    y = numpy.exp(-y*2*math.pi)
+    e = (y-1)/(y+1)
+    lat = 180.0/math.pi * numpy.arcsin(e)
+    return lat, lon
+
+## Array version of km_per_pixel
+def km_per_pixel_array(lat, zoom):
+    world_tiles = tiles_on_level(zoom)
+    return 2*math.pi*R_EARTH/world_tiles/TILES_WIDTH * numpy.cos(numpy.asarray(lat, numpy.float64)*math.pi/180.0)
+
+## Return the absolute path to a tile without touching the disk
+#  tile_coord = (tile_X, tile_Y, zoom_level)
+#  smaple of the Naming convention:
+#  \.googlemaps\tiles\15\0\1\0\1.png
+#  We only have 2 levels for one axis
+#  at most 1024 files in one dir
+def tile_path(configpath, tile_coord, layer, mapServ):
+    return os.path.join(configpath, mapServ, LAYER_DIRS[layer],
+                        '%d' % tile_coord[2],
+                        '%d' % (tile_coord[0] / 1024),
+                        '%d' % (tile_coord[0] % 1024),
+                        '%d' % (tile_coord[1] / 1024),
+                        '%d.png' % (tile_coord[1] % 1024))
+
+## Iterates over the tile files of a map service and layer as
+#  (tile_coord, filename), the reverse of tile_path()
+def walk_tiles(configpath, mapServ, layer):
+    root = os.path.join(configpath, mapServ, LAYER_DIRS[layer])
+    for dirpath, dirnames, filenames in os.walk(root):
+        # zoom/x/1024/x%1024/y/1024/y%1024.png
+        parts = dirpath[len(root):].strip(os.sep).split(os.sep)
+        if len(parts) != 4:
+            continue
+        for name in filenames:
+            if not name.endswith('.png'):
+                continue
+            try:
+                zoom, x1, x2, y1 = [int(part) for part in parts]
+                y2 = int(name[:-4])
+            except ValueError:
+                continue
+            yield (x1*1024 + x2, y1*1024 + y2, zoom), os.path.join(dirpath, name)
+
+## Return the path to the metadata file of a tile file
+def tile_meta_path(filename):
+    return filename + '.meta'
+
+## Returns the metadata of a tile file as a dict of etag, lastmodified
+#  and fetched, or None if the tile is not stored
+#  The ETag and Last-Modified are kept in a .meta file next to the tile,
+#  the time it was fetched is the modification time of the tile
+def read_tile_meta(filename):
+    try:
+        meta = {'etag': None, 'lastmodified': None,
+                'fetched': os.path.getmtime(filename)}
+    except OSError:
+        return None
+    try:
+        file = open(tile_meta_path(filename))
+    except IOError:
+        # the server sent neither header
+        return meta
+    try:
+        for line in file:
+            name, sep, value = line.rstrip('\n').partition(' ')
+            if name in meta and name != 'fetched':
+                meta[name] = value
+    finally:
+        file.close()
+    return meta
+
+## Write the metadata file of a tile file, or remove it if the
+#  server sent neither header. The fetch time is left to the caller
+def write_tile_meta(filename, meta):
+    metaname = tile_meta_path(filename)
+    lines = ['%s %s\n' % (name, meta[name]) for name in ('etag', 'lastmodified')
+             if meta.get(name)]
+    if not lines:
+        try:
+            os.remove(metaname)
+        except OSError:
+            pass
+        return
+    tmpname = '%s.%d.tmp' % (metaname, id(meta))
+    file = open(tmpname, 'w')
+    try:
+        try:
+            file.writelines(lines)
+        finally:
+            file.close()
+        os.rename(tmpname, metaname)
+    except:
+        # eg. the disk is full, do not leave the partial file behind
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+
 ## Convert tuple-like string to real tuples
 # eg: '((1, 2), (2, 3))' -> ((1, 2), (2, 3))
 def str_to_tuple(strCenter):
@@ -133,3 +263,44 @@ def zoom_to_area(area, (width, height)):
 
     return (tile_to_coord(tile,start),tile)
     
+
+if __name__ == "__main__":
+    # Benchmark the array projections against the scalar ones
+    import sys, time, random
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    zoom = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    lat = [random.uniform(-85, 85) for i in xrange(count)]
+    lon = [random.uniform(-180, 180) for i in xrange(count)]
+    start = time.time()
+    scalar = [coord_to_tile((lat[i], lon[i], zoom)) for i in xrange(count)]
+    scalartime = time.time() - start
+    alat = numpy.array(lat)
+    alon = numpy.array(lon)
+    start = time.time()
+    tx, ty, ox, oy = coord_to_tile_array(alat, alon, zoom)
+    arraytime = time.time() - start
+    mismatches = len([1 for i in xrange(count)
+                      if scalar[i] != ((tx[i], ty[i]), (ox[i], oy[i]))])
+    print "coord_to_tile %i points: scalar %.3fs, array %.3fs, %i mismatches" % \
+          (count, scalartime, arraytime, mismatches)
+
+    start = time.time()
+    scalar = [tile_to_coord(t, zoom) for t in scalar]
+    scalartime = time.time() - start
+    start = time.time()
+    clat, clon = tile_to_coord_array(tx, ty, ox, oy, zoom)
+    arraytime = time.time() - start
+    mismatches = len([1 for i in xrange(count)
+                      if scalar[i][:2] != (clat[i], clon[i])])
+    print "tile_to_coord %i points: scalar %.3fs, array %.3fs, %i mismatches" % \
+          (count, scalartime, arraytime, mismatches)
+
+    start = time.time()
+    scalar = [km_per_pixel((lat[i], lon[i], zoom)) for i in xrange(count)]
+    scalartime = time.time() - start
+    start = time.time()
+    km = km_per_pixel_array(alat, zoom)
+    arraytime = time.time() - start
+    mismatches = len([1 for i in xrange(count) if scalar[i] != km[i]])
+    print "km_per_pixel  %i points: scalar %.3fs, array %.3fs, %i mismatches" % \
+          (count, scalartime, arraytime, mismatches)
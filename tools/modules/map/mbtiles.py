@@ -0,0 +1,234 @@
+## This modul provides access to MBTiles (SQLite) tile files
+#
+# Usage:
+#
+# - one MBTiles file per map service and layer, named
+#   <mapServ>_<layer dir>.mbtiles in the configuration directory,
+#   see mbtiles_path()
+#
+# - MBTiles counts zoom levels from the whole world and rows from the
+#   south (TMS), see tms_coord()
+#
+# - tiles are inserted in batches, tiles waiting to be inserted are
+#   served from memory. A timer inserts them flush_seconds after the
+#   first of them was put, so other processes see them soon after a burst
+#
+# - the ETag and Last-Modified of the response and the time a tile was
+#   fetched are kept in the extra table tile_meta, see get_meta()
+#
+# - the files are in WAL mode, so every thread reads through a connection
+#   of its own while tiles are being inserted
+#
+# - does not depend on gtk, so tools without a display can use it
+
+
+import os
+import time
+import sqlite3
+import threading
+
+from mapConst import *
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS metadata (name text, value text)",
+    "CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer,"
+        " tile_row integer, tile_data blob)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles"
+        " (zoom_level, tile_column, tile_row)",
+    "CREATE TABLE IF NOT EXISTS tile_meta (zoom_level integer, tile_column integer,"
+        " tile_row integer, etag text, last_modified text, fetched real)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS tile_meta_index ON tile_meta"
+        " (zoom_level, tile_column, tile_row)"]
+
+
+## Return the MBTiles (zoom_level, tile_column, tile_row) of a tile
+#  tile_coord = (tile_X, tile_Y, zoom_level)
+def tms_coord(tile_coord):
+    zoom = MAP_MAX_ZOOM_LEVEL - tile_coord[2]
+    return (zoom, tile_coord[0], (1 << zoom) - 1 - tile_coord[1])
+
+## Return the (tile_X, tile_Y, zoom_level) of a MBTiles tile
+def tile_coord(zoom, column, row):
+    return (column, (1 << zoom) - 1 - row, MAP_MAX_ZOOM_LEVEL - zoom)
+
+## Return the path to the MBTiles file of a map service and layer
+def mbtiles_path(configpath, layer, mapServ):
+    return os.path.join(configpath, '%s_%s.mbtiles' % (mapServ, LAYER_DIRS[layer]))
+
+
+## One MBTiles file, shared by all threads
+class MBTiles:
+
+    ## flush_seconds None leaves tiles waiting until the batch is full
+    def __init__(self, filename, name='', batch=SQLITE_BATCH_SIZE,
+                    flush_seconds=SQLITE_FLUSH_SECONDS):
+        self.filename = filename
+        self.batch = batch
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # tiles and metadata waiting to be inserted, by tms_coord
+        self.pending = {}
+        self.pending_meta = {}
+        self.pending_since = None
+        # inserts the waiting tiles once they have waited flush_seconds
+        self.timer = None
+
+        self.writer = sqlite3.connect(filename, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        for sql in SCHEMA:
+            self.writer.execute(sql)
+        if not self.writer.execute("SELECT 1 FROM metadata").fetchone():
+            self.writer.executemany("INSERT INTO metadata VALUES (?,?)",
+                [('name', name), ('type', 'baselayer'), ('version', '1.1'),
+                 ('description', '%s tiles cached by %s' % (name, NAME)),
+                 ('format', 'png')])
+        self.writer.commit()
+
+    ## Returns the connection of the calling thread
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename)
+            self.local.conn = conn
+        return conn
+
+    ## Returns True if the tile is in the file
+    def has(self, tms):
+        if tms in self.pending:
+            return True
+        return self.reader().execute(
+            "SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            tms).fetchone() is not None
+
+    ## Returns the image data of a tile, or None
+    def get(self, tms):
+        data = self.pending.get(tms)
+        if data is not None:
+            return data
+        row = self.reader().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            tms).fetchone()
+        if row:
+            return str(row[0])
+        return None
+
+    ## Returns the metadata of a tile as a dict of etag, lastmodified
+    #  and fetched, or None if the file has none for it
+    def get_meta(self, tms):
+        meta = self.pending_meta.get(tms)
+        if meta is not None:
+            return meta
+        row = self.reader().execute(
+            "SELECT etag, last_modified, fetched FROM tile_meta"
+            " WHERE zoom_level=? AND tile_column=? AND tile_row=?", tms).fetchone()
+        if row:
+            return {'etag': row[0], 'lastmodified': row[1], 'fetched': row[2]}
+        return None
+
+    ## Adds or replaces a tile and its metadata, both are inserted with
+    #  the next batch. Without data only the metadata is replaced
+    def put(self, tms, data, meta=None):
+        self.lock.acquire()
+        try:
+            if not (self.pending or self.pending_meta):
+                self.pending_since = time.time()
+                if self.flush_seconds is not None and self.timer is None:
+                    self.timer = threading.Timer(self.flush_seconds, self.__timeout__)
+                    self.timer.setDaemon(True)
+                    self.timer.start()
+            if data is not None:
+                self.pending[tms] = data
+            if meta is not None:
+                self.pending_meta[tms] = meta
+            if (max(len(self.pending), len(self.pending_meta)) >= self.batch or
+                    (self.flush_seconds is not None and
+                     time.time() - self.pending_since >= self.flush_seconds)):
+                self.__flush__()
+        finally:
+            self.lock.release()
+
+    ## Removes a tile
+    def delete(self, tms):
+        self.lock.acquire()
+        try:
+            self.pending.pop(tms, None)
+            self.pending_meta.pop(tms, None)
+            self.writer.execute(
+                "DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", tms)
+            self.writer.execute(
+                "DELETE FROM tile_meta WHERE zoom_level=? AND tile_column=? AND tile_row=?", tms)
+            self.writer.commit()
+        finally:
+            self.lock.release()
+
+    ## Inserts the tiles waiting to be inserted
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.__flush__()
+        finally:
+            self.lock.release()
+
+    ## Iterates over (tms_coord, data) of all tiles in the file
+    def tiles(self):
+        self.flush()
+        conn = sqlite3.connect(self.filename)
+        try:
+            for row in conn.execute(
+                    "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"):
+                yield (row[0], row[1], row[2]), str(row[3])
+        finally:
+            conn.close()
+
+    ## Iterates over (tms_coord, size, fetched) of all tiles in the file,
+    #  fetched is None for tiles without metadata
+    def sizes(self):
+        self.flush()
+        conn = sqlite3.connect(self.filename)
+        try:
+            for row in conn.execute(
+                    "SELECT t.zoom_level, t.tile_column, t.tile_row, length(t.tile_data), m.fetched"
+                    " FROM tiles t LEFT JOIN tile_meta m"
+                    " USING (zoom_level, tile_column, tile_row)"):
+                yield (row[0], row[1], row[2]), row[3], row[4]
+        finally:
+            conn.close()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.__flush__()
+        finally:
+            self.lock.release()
+        self.writer.close()
+
+    ## Called by the timer, inserts the tiles that have waited long enough
+    def __timeout__(self):
+        self.lock.acquire()
+        try:
+            # a timer cancelled too late finds the file closed
+            if self.timer is None:
+                return
+            self.timer = None
+            self.__flush__()
+        finally:
+            self.lock.release()
+
+    def __flush__(self):
+        if not (self.pending or self.pending_meta):
+            return
+        self.writer.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?)",
+            [(tms[0], tms[1], tms[2], sqlite3.Binary(data))
+                for tms, data in self.pending.items()])
+        self.writer.executemany("INSERT OR REPLACE INTO tile_meta VALUES (?,?,?,?,?,?)",
+            [(tms[0], tms[1], tms[2], meta.get('etag'), meta.get('lastmodified'), meta['fetched'])
+                for tms, meta in self.pending_meta.items()])
+        self.writer.commit()
+        # readers may still look in the old dicts, so make new ones
+        self.pending = {}
+        self.pending_meta = {}
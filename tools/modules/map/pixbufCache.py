@@ -0,0 +1,119 @@
+## This modul provides the cache of decoded tiles
+#
+# Usage:
+#
+# - used by the tile repositories to keep decoded tiles in memory
+# - the size of the cache is a budget in bytes of pixel data per layer,
+#   see MapConf for the [cache] section setting the budgets
+# - stats() returns counters that help sizing the budgets
+
+
+import time
+import threading
+import gtk
+
+from gloclib import lrucache
+from mapConst import *
+
+
+## Return the number of bytes of pixel data held by a pixbuf
+def pixbuf_bytes(pixbuf):
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class PixbufCache:
+
+    ## budgets is the maximum number of bytes to keep per layer
+    def __init__(self, budgets=PIXBUF_CACHE_BUDGETS):
+        self.caches = [lrucache.ThreadSafeLRUCache(max(budget, 1), pixbuf_bytes)
+                            for budget in budgets]
+        # the counters are updated by the decoder threads too
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.decodes = 0
+        self.decode_time = 0.0
+
+    ## Returns the cached pixbuf of a tile file, or None
+    def get(self, filename, layer):
+        pixbuf = self.caches[layer].get(filename)
+        if pixbuf is None:
+            self.__count__(misses=1)
+        else:
+            self.__count__(hits=1)
+        return pixbuf
+
+    ## Returns the cached pixbuf of a tile, or None
+    # Unlike get() a miss is not counted, the caller loads the tile later
+    def peek(self, filename, layer):
+        pixbuf = self.caches[layer].get(filename)
+        if pixbuf is not None:
+            self.__count__(hits=1)
+        return pixbuf
+
+    ## Decodes a tile file and caches the pixbuf
+    # Raises the exception of gtk when the file can not be decoded
+    def load(self, filename, layer):
+        start = time.time()
+        pixbuf = gtk.gdk.pixbuf_new_from_file(filename)
+        self.__count__(decodes=1, decode_time=time.time() - start)
+        return self.__keep__(filename, layer, pixbuf)
+
+    ## Decodes the image data of a tile and caches the pixbuf under key
+    # Used by repositories that do not keep tiles in files of their own
+    def load_data(self, key, data, layer):
+        start = time.time()
+        loader = gtk.gdk.PixbufLoader()
+        try:
+            loader.write(data)
+        finally:
+            loader.close()
+        pixbuf = loader.get_pixbuf()
+        self.__count__(decodes=1, decode_time=time.time() - start)
+        return self.__keep__(key, layer, pixbuf)
+
+    ## Adds to the counters, holding the lock
+    def __count__(self, hits=0, misses=0, decodes=0, decode_time=0.0):
+        self.lock.acquire()
+        try:
+            self.hits += hits
+            self.misses += misses
+            self.decodes += decodes
+            self.decode_time += decode_time
+        finally:
+            self.lock.release()
+
+    def __keep__(self, key, layer, pixbuf):
+        # a budget of 0 turns caching of the layer off
+        if pixbuf_bytes(pixbuf) <= self.caches[layer].size:
+            self.caches[layer][key] = pixbuf
+        return pixbuf
+
+    ## Forgets the pixbuf of a tile file, eg. when the file is replaced
+    def discard(self, filename, layer):
+        if filename in self.caches[layer]:
+            try:
+                del self.caches[layer][filename]
+            except lrucache.CacheKeyError:
+                pass
+
+    ## Returns the counters of the cache
+    # hits and misses are lookups, evictions are pixbufs dropped to stay
+    # within budget, bytes is the pixel data currently held and
+    # decode_time the seconds spent decoding files
+    def stats(self):
+        self.lock.acquire()
+        try:
+            hits, misses = self.hits, self.misses
+            decodes, decode_time = self.decodes, self.decode_time
+        finally:
+            self.lock.release()
+        return {'hits': hits,
+                'misses': misses,
+                'evictions': sum([cache.evictions for cache in self.caches]),
+                'bytes': sum([cache.used for cache in self.caches]),
+                'tiles': sum([len(cache) for cache in self.caches]),
+                'decodes': decodes,
+                'decode_time': decode_time,
+                'layers': [(LAYER_NAMES[i], self.caches[i].used, self.caches[i].size)
+                                for i in range(len(self.caches))]}
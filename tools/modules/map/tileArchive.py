@@ -0,0 +1,131 @@
+## This modul provides read-only packed tile archives
+#
+# Usage:
+#
+# - an archive is one file holding the tiles of a region, for machines
+#   that are not meant to download tiles themselves
+#
+# - layout of the file, all numbers big endian:
+#     header:  magic, number of map services, number of tiles
+#     the names of the map services, each preceded by its length
+#     index:   one ENTRY per tile, sorted by
+#              (map service, layer, zoom, x, y), giving the offset
+#              and length of the image data of the tile
+#     the image data of the tiles
+#
+# - TileArchive opens the file with mmap and binary searches the index,
+#   so reading a tile needs no system calls
+#
+# - write_archive() builds an archive, see the pack command of tilestore
+#
+# - does not depend on gtk, so tools without a display can use it
+
+
+import os
+import mmap
+import struct
+
+from mapConst import *
+
+MAGIC = 'GLOCPAK1'
+HEADER = '>8sII'
+NAME = '>H'
+# map service, layer, zoom, x, y, offset, length
+ENTRY = '>HBbIIQI'
+ENTRY_SIZE = struct.calcsize(ENTRY)
+
+
+## Write an archive
+# tiles is an iterable of (mapServ, layer, tile_coord, filename), the
+# image data of each tile is read from filename
+def write_archive(archivename, tiles):
+    services = []
+    entries = []
+    for mapServ, layer, coord, filename in tiles:
+        if mapServ not in services:
+            services.append(mapServ)
+        entries.append(((services.index(mapServ), layer, coord[2], coord[0], coord[1]),
+                        filename, os.path.getsize(filename)))
+    entries.sort()
+
+    names = ''.join([struct.pack(NAME, len(name)) + name for name in services])
+    offset = struct.calcsize(HEADER) + len(names) + len(entries) * ENTRY_SIZE
+    archive = open(archivename, 'wb')
+    try:
+        archive.write(struct.pack(HEADER, MAGIC, len(services), len(entries)))
+        archive.write(names)
+        for key, filename, length in entries:
+            archive.write(struct.pack(ENTRY, *(key + (offset, length))))
+            offset += length
+        for key, filename, length in entries:
+            file = open(filename, 'rb')
+            try:
+                data = file.read()
+            finally:
+                file.close()
+            # the index is already written, so the file must not change
+            if len(data) != length:
+                raise IOError, ("%s changed while packing" % filename,)
+            archive.write(data)
+    finally:
+        archive.close()
+    return len(entries)
+
+
+## A read-only archive of tiles, see write_archive()
+class TileArchive:
+
+    def __init__(self, filename):
+        self.filename = filename
+        file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        magic, nservices, self.count = struct.unpack_from(HEADER, self.map, 0)
+        if magic != MAGIC:
+            self.map.close()
+            raise IOError, ("%s is not a tile archive" % filename,)
+        pos = struct.calcsize(HEADER)
+        # map service ids by name
+        self.services = {}
+        for i in xrange(nservices):
+            length, = struct.unpack_from(NAME, self.map, pos)
+            pos += struct.calcsize(NAME)
+            self.services[self.map[pos:pos+length]] = i
+            pos += length
+        self.index = pos
+
+    ## Returns the offset and length of a tile, or None
+    def find(self, mapServ, layer, tile_coord):
+        service = self.services.get(mapServ)
+        if service is None:
+            return None
+        key = (service, layer, tile_coord[2], tile_coord[0], tile_coord[1])
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from(ENTRY, self.map, self.index + mid*ENTRY_SIZE)[:5] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            entry = struct.unpack_from(ENTRY, self.map, self.index + lo*ENTRY_SIZE)
+            if entry[:5] == key:
+                return entry[5:]
+        return None
+
+    ## Returns True if the tile is in the archive
+    def has(self, mapServ, layer, tile_coord):
+        return self.find(mapServ, layer, tile_coord) is not None
+
+    ## Returns the image data of a tile, or None
+    def get(self, mapServ, layer, tile_coord):
+        found = self.find(mapServ, layer, tile_coord)
+        if found is None:
+            return None
+        return self.map[found[0]:found[0]+found[1]]
+
+    def close(self):
+        self.map.close()
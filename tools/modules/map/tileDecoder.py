@@ -0,0 +1,189 @@
+"""
+ Decodes received map tiles in worker threads, so the GTK main loop only
+ draws them.
+
+ @author: Brendan Johan Lee
+ @contact: brendajl@simula.no
+ @version: 1.0
+"""
+## GNU General Public Licence (GPL)
+
+## This program is free software; you can redistribute it and / or modify it under
+## the terms of the GNU General Public License as published by the Free Software
+## Foundation; either version 2 of the License,  or (at your option) any later
+## version.
+## This program is distributed in the hope that it will be useful,  but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+## FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+## details.
+## You should have received a copy of the GNU General Public License along with
+## this program; if not,  write to the Free Software Foundation,  Inc.,  59 Temple
+## Place,  Suite 330,  Boston,  MA  02111 - 1307  USA
+
+import time
+from threading import Thread, Lock
+from Queue import Queue
+from traceback import print_exc
+
+from gloclib.gtkThread import do_gui_operation
+from map.mapConst import *
+
+class TileDecoder:
+    """
+    Stage between the MapDownloader and the GUI. Tiles the downloader
+    reports are decoded into pixbufs by worker threads, which keep them
+    in the decoded tile cache of the tile repository, and the pixbufs are
+    then handed to the GUI thread. Tiles already decoded are handed over
+    at once.
+
+    Also measures the time the GUI thread spends per tile.
+
+    @author: Brendan Johan Lee
+    @contact: brendajl@simula.no
+    @version: 1.0
+    """
+
+    def __init__(self, ctx_map, threads=DECODE_THREADS):
+        """
+        Initialize TileDecoder and start its worker threads.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param ctx_map: mapserver to load the tiles from
+        @type ctx_map: MapServ
+        @param threads: number of worker threads decoding tiles
+        @type threads: int
+        """
+
+        self.ctx_map = ctx_map
+        self.queue = Queue()
+        self.lock = Lock()
+        self.decoded = 0
+        self.decode_time = 0.0
+        # tiles handed to the GUI, and the seconds the GUI thread spent on them
+        self.delivered = 0
+        self.main_time = 0.0
+        self.main_max = 0.0
+        self.workers = []
+        for i in range(max(1, threads)):
+            worker = Thread(target=self.__work__, name='TileDecoder-%i' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def callback(self, function):
+        """
+        Return a callback for MapDownloader.query_tile() which has the tile
+        decoded, and then calls function(coord, layer, mapServ, pixbuf) in
+        the GUI thread.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @param function: called with the decoded tile
+        @type function: function
+
+        @return: callback
+        @rtype: function
+        """
+
+        def cb(inGuiThread, coord, layer, mapServ):
+            if inGuiThread:
+                pixbuf = self.ctx_map.cached_pixbuf(coord, layer, mapServ)
+                if pixbuf is not None:
+                    self.__deliver__(function, coord, layer, mapServ, pixbuf)
+                    return
+            self.queue.put((function, coord, layer, mapServ))
+        return cb
+
+    def stop(self):
+        """
+        Stop the worker threads once the tiles queued are decoded.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def stats(self):
+        """
+        Return the counters of the decoder: tiles decoded and the seconds
+        spent on it by the workers, tiles waiting to be decoded, and tiles
+        handed to the GUI with the mean and longest time the GUI thread
+        spent on one.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: statistics
+        @rtype: dict
+        """
+
+        return {'decoded': self.decoded,
+                'decode_time': self.decode_time,
+                'queued': self.queue.qsize(),
+                'delivered': self.delivered,
+                'main_time': self.main_time,
+                'main_mean': self.main_time / max(self.delivered, 1),
+                'main_max': self.main_max}
+
+    def __work__(self):
+        """
+        Worker thread main loop, decodes queued tiles.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+        """
+
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            function, coord, layer, mapServ = job
+            start = time.time()
+            try:
+                pixbuf = self.ctx_map.load_pixbuf(coord, layer, False, mapServ)
+            except:
+                print_exc() # but don't die
+                continue
+            elapsed = time.time() - start
+            self.lock.acquire()
+            try:
+                self.decoded += 1
+                self.decode_time += elapsed
+            finally:
+                self.lock.release()
+            do_gui_operation(self.__deliver__, function, coord, layer, mapServ, pixbuf)
+
+    def __deliver__(self, function, coord, layer, mapServ, pixbuf):
+        """
+        Hand a decoded tile to the GUI, in the GUI thread.
+
+        @author: Brendan Johan Lee
+        @contact: brendajl@simula.no
+        @version: 1.0
+
+        @return: False, so the idle handler is not called again
+        @rtype: bool
+        """
+
+        start = time.time()
+        try:
+            function(coord, layer, mapServ, pixbuf)
+        finally:
+            elapsed = time.time() - start
+            self.delivered += 1
+            self.main_time += elapsed
+            self.main_max = max(self.main_max, elapsed)
+        return False
@@ -0,0 +1,106 @@
+## This modul provides a read-only tile repository kept in a tile archive
+#
+# Usage:
+#
+# - same interface as TilesRepositoryFS, MapServ() uses it when the
+#   repository option in the [init] section of the configuration is
+#   archive, the archive option gives the file
+#
+# - tiles are never downloaded, tiles not in the archive are missing
+#
+# - the archive is mapped into memory, see tileArchive.py
+#
+# - module is finalized from MapServ.finish() method
+
+
+import mapPixbuf
+from pixbufCache import PixbufCache
+from tileArchive import TileArchive
+from mapExport import export_map
+
+from mapConst import *
+
+
+class TilesRepositoryArchive:
+
+    # tiles are never downloaded into an archive
+    read_only = True
+
+    def __init__(self, MapServ_inst, cache_budgets=PIXBUF_CACHE_BUDGETS, archive=None):
+        self.tile_cache = PixbufCache(cache_budgets)
+        self.mapServ_inst = MapServ_inst
+        self.configpath = self.mapServ_inst.configpath
+        self.archive = TileArchive(archive)
+
+        self.missingPixbuf = mapPixbuf.missing()
+
+    def finish(self):
+        self.archive.close()
+
+    ## Returns the PixBuf of the tile
+    # Decodes straight from the mapped archive, uses a cache to
+    # avoid decoding again
+    def load_pixbuf(self, coord, layer, force_update, mapServ):
+        filename = self.coord_to_path(coord, layer, mapServ)
+        pixbuf = self.tile_cache.get(filename, layer)
+        if pixbuf is None:
+            data = self.archive.get(mapServ, layer, coord)
+            if data is None:
+                return self.missingPixbuf
+            try:
+                pixbuf = self.tile_cache.load_data(filename, data, layer)
+            except Exception:
+                pixbuf = self.missingPixbuf
+                print "Tile corrupted: %s" % filename
+        return pixbuf
+
+    ## Returns true if the tile is in the archive
+    def get_png_file(self, coord, layer, filename,
+                        online, force_update, mapServ, styleID):
+        return self.archive.has(mapServ, layer, coord)
+
+    ## The archive keeps no metadata, its tiles are never revalidated
+    def get_meta(self, coord, layer, mapServ):
+        return None
+
+    ## The archive is read-only, downloaded tiles are dropped
+    def put_tile(self, coord, layer, mapServ, data, meta=None):
+        pass
+
+    def touch_tile(self, coord, layer, mapServ, meta):
+        pass
+
+    def remove_tile(self, coord, layer, mapServ):
+        pass
+
+    ## The archive is not maintained, see CacheMaintainer
+    def tiles(self):
+        return iter([])
+
+    ## Return the name of a tile, the archive followed by the tile
+    def coord_to_path(self, tile_coord, layer, mapServ):
+        return '%s#%s/%d/%d/%d/%d' % (self.archive.filename, mapServ, layer,
+                                      tile_coord[2], tile_coord[0], tile_coord[1])
+
+    ## Get the tile for the given location
+    # Validates the given tile coordinates and,
+    # returns the name of the tile if it is in the archive
+    def get_file(self, tcoord, layer, online, force_update, mapServ, styleID):
+        if (MAP_MIN_ZOOM_LEVEL <= tcoord[2] <= MAP_MAX_ZOOM_LEVEL):
+            world_tiles = 2 ** (MAP_MAX_ZOOM_LEVEL - tcoord[2])
+            if (tcoord[0] > world_tiles) or (tcoord[1] > world_tiles):
+                return None
+            filename = self.coord_to_path(tcoord, layer, mapServ)
+            if self.get_png_file(tcoord, layer, filename, online,
+                                    force_update, mapServ, styleID):
+                return filename
+        return None
+
+    ## Export tiles to one big map
+    #  tcoord are the tile coordinates of the upper left tile,
+    #  see mapExport.export_map()
+    def do_export(self, tcoord, layer, online, mapServ, styleID, size,
+                  filename=EXPORT_NAME, threads=EXPORT_THREADS):
+        def read_tile(coord):
+            return self.archive.get(mapServ, layer, coord)
+        return export_map(filename, tcoord, size, read_tile, threads)
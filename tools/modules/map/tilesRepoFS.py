@@ -3,33 +3,41 @@
 # Usage:
 #
 # - constructor requires MapServ instance, because method
-#  'get_tile_from_coord' is provided in the MapServ
+#  'download_tile' is provided in the MapServ
 #
 # - this module is not used directly. It is used via MapServ() methods:
 #     - get_file()
 #     - load_pixbuf()
 # - module is finalized from MapServ.finish() method
+#
+# - the ETag and Last-Modified of a tile are kept in a .meta file next to
+#   it, the time it was fetched is the modification time of the tile
 
 
 import os
 import sys
+import errno
 import gtk
 
-from gloclib import  lrucache
 import mapPixbuf
+from pixbufCache import PixbufCache
 from gloclib import fileUtils
 
-from threading import Lock
 from mapConst import *
+from mapUtils import tile_path, walk_tiles, tile_meta_path, read_tile_meta, write_tile_meta
+from mapExport import export_map
 
 
 class TilesRepositoryFS:
 
-    def __init__(self, MapServ_inst):
-        self.tile_cache = lrucache.LRUCache(1000)
+    read_only = False
+
+    def __init__(self, MapServ_inst, cache_budgets=PIXBUF_CACHE_BUDGETS):
+        self.tile_cache = PixbufCache(cache_budgets)
         self.mapServ_inst = MapServ_inst
-        self.lock = Lock()
         self.configpath = self.mapServ_inst.configpath
+        # directories known to exist, so writing a tile does not stat them
+        self.dirs = set()
 
         self.missingPixbuf = mapPixbuf.missing()
 
@@ -40,17 +48,20 @@ class TilesRepositoryFS:
     # Uses a cache to optimise HDD read access
     def load_pixbuf(self, coord, layer, force_update, mapServ):
         filename = self.coord_to_path(coord, layer, mapServ)
-        if not force_update and (filename in self.tile_cache):
-            pixbuf = self.tile_cache[filename]
-        else:
+        pixbuf = None
+        if not force_update:
+            pixbuf = self.tile_cache.get(filename, layer)
+        if pixbuf is None:
+            # missing tiles are not cached, they all share missingPixbuf
             if os.path.isfile(filename):
                 try:
-                    pixbuf = gtk.gdk.pixbuf_new_from_file(filename)
-                    self.tile_cache[filename] = pixbuf
+                    pixbuf = self.tile_cache.load(filename, layer)
                 except Exception:
                     pixbuf = self.missingPixbuf
                     print "File corrupted: %s" % filename
+                    self.tile_cache.discard(filename, layer)
                     fileUtils.del_file(filename)
+                    fileUtils.del_file(self.meta_path(filename))
             else:
                 pixbuf = self.missingPixbuf
         return pixbuf
@@ -58,48 +69,122 @@ class TilesRepositoryFS:
 
     ## Get the png file for the given location
     # Returns true if the file is successfully retrieved
+    # A forced update revalidates the tile if it is stale, see MapServ.is_stale()
     def get_png_file(self, coord, layer, filename,
                         online, force_update, mapServ, styleID):
-        # remove tile only when online
-        if (force_update and online):
-            fileUtils.delete_old(filename)
-
-        if os.path.isfile(filename):
-            return True
-        if not online:
+        cached = os.path.isfile(filename)
+        meta = None
+        if cached:
+            if not (force_update and online):
+                return True
+            meta = self.get_meta(coord, layer, mapServ)
+            if not self.mapServ_inst.is_stale(meta):
+                return True
+        elif not online:
             return False
 
         try:
-            data = self.mapServ_inst.get_tile_from_coord(
-                        coord, layer, mapServ, styleID
-                    )
-            file = open( filename, 'wb' )
-            file.write( data )
-            file.close()
+            self.mapServ_inst.download_tile(coord, layer, mapServ, styleID, meta)
             return True
         except KeyboardInterrupt:
             raise
         except:
             print '\tdownload failed -', sys.exc_info()[0]
-        return False
+        # a stale tile is better than none
+        return cached
 
     ## Return the absolute path to a tile
-    #  tile_coord = (tile_X, tile_Y, zoom_level)
-    #  smaple of the Naming convention:
-    #  \.googlemaps\tiles\15\0\1\0\1.png
-    #  We only have 2 levels for one axis
-    #  at most 1024 files in one dir
+    # Only builds the path, directories are created by store_tile()
     def coord_to_path(self, tile_coord, layer, mapServ):
-        self.lock.acquire()
-        path = os.path.join(self.configpath, mapServ)
-        path = fileUtils.check_dir(path)
-        path = fileUtils.check_dir(path, '%s' % LAYER_DIRS[layer])
-        path = fileUtils.check_dir(path, '%d' % tile_coord[2])
-        path = fileUtils.check_dir(path, "%d" % (tile_coord[0] / 1024))
-        path = fileUtils.check_dir(path, "%d" % (tile_coord[0] % 1024))
-        path = fileUtils.check_dir(path, "%d" % (tile_coord[1] / 1024))
-        self.lock.release()
-        return os.path.join(path, "%d.png" % (tile_coord[1] % 1024))
+        return tile_path(self.configpath, tile_coord, layer, mapServ)
+
+    ## Create a directory and its parents unless it is known to exist
+    def make_dirs(self, path):
+        if path in self.dirs:
+            return
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            # another thread may have created it in the mean time
+            if e.errno != errno.EEXIST:
+                raise
+        self.dirs.add(path)
+
+    ## Write the data of a tile to its file
+    # The data is written to a temporary file first, so readers
+    # never see a partially written tile
+    def store_tile(self, filename, data):
+        dirname = os.path.dirname(filename)
+        self.make_dirs(dirname)
+        tmpname = '%s.%d.tmp' % (filename, id(data))
+        try:
+            file = open(tmpname, 'wb')
+        except IOError, e:
+            # the directory was removed behind our back, create it again
+            if e.errno != errno.ENOENT:
+                raise
+            self.dirs.discard(dirname)
+            self.make_dirs(dirname)
+            file = open(tmpname, 'wb')
+        try:
+            try:
+                file.write(data)
+            finally:
+                file.close()
+            os.rename(tmpname, filename)
+        except:
+            # eg. the disk is full, do not leave the partial tile behind
+            fileUtils.del_file(tmpname)
+            raise
+
+    ## Return the path to the metadata file of a tile
+    def meta_path(self, filename):
+        return tile_meta_path(filename)
+
+    ## Returns the metadata of a tile as a dict of etag, lastmodified
+    #  and fetched, or None if the tile is not stored
+    def get_meta(self, coord, layer, mapServ):
+        return read_tile_meta(self.coord_to_path(coord, layer, mapServ))
+
+    ## Write the metadata file of a tile, see mapUtils.write_tile_meta()
+    def store_meta(self, filename, meta):
+        write_tile_meta(filename, meta)
+
+    ## Store the downloaded data of a tile, and its metadata if given
+    def put_tile(self, coord, layer, mapServ, data, meta=None):
+        filename = self.coord_to_path(coord, layer, mapServ)
+        self.store_tile(filename, data)
+        # do not keep showing the tile it replaces
+        self.tile_cache.discard(filename, layer)
+        if meta is not None:
+            self.store_meta(filename, meta)
+
+    ## Mark a stored tile as fetched again, the server answered
+    #  it has not changed
+    def touch_tile(self, coord, layer, mapServ, meta):
+        filename = self.coord_to_path(coord, layer, mapServ)
+        os.utime(filename, (meta['fetched'], meta['fetched']))
+        self.store_meta(filename, meta)
+
+    ## Remove a stored tile and its metadata
+    def remove_tile(self, coord, layer, mapServ):
+        filename = self.coord_to_path(coord, layer, mapServ)
+        self.tile_cache.discard(filename, layer)
+        fileUtils.del_file(filename)
+        fileUtils.del_file(self.meta_path(filename))
+
+    ## Iterates over the stored tiles as (mapServ, layer, coord, size, used),
+    #  used is the last time the tile was read or written
+    def tiles(self):
+        for mapServ in MAP_SERVERS:
+            for layer in range(len(LAYER_NAMES)):
+                for coord, filename in walk_tiles(self.configpath, mapServ, layer):
+                    try:
+                        st = os.stat(filename)
+                    except OSError:
+                        # the tile was removed while we walk
+                        continue
+                    yield mapServ, layer, coord, st.st_size, max(st.st_atime, st.st_mtime)
 
     ## Get the image file for the given location
     # Validates the given tile coordinates and,
@@ -119,24 +204,16 @@ class TilesRepositoryFS:
 
 
     ## Export tiles to one big map
-    #  tcoord are the tile coordinates of the upper left tile
-    def do_export(self, tcoord, layer, online, mapServ, styleID, size):
-        from PIL import Image
-        # Convert given size to a tile size factor
-        xFact = int(size[0]/TILES_WIDTH)
-        yFact = int(size[1]/TILES_HEIGHT)
-        # Initialise the image
-        result = Image.new("RGBA", (xFact* TILES_WIDTH, yFact* TILES_HEIGHT))
-        x = 0
-        for i in range(tcoord[0], tcoord[0] + xFact):
-            y = 0
-            for j in range(tcoord[1], tcoord[1] + yFact):
-                filename = self.get_file(
-                    (i,j,tcoord[2]), layer, online, False, mapServ, styleID
-                )
-                if filename:
-                    im = Image.open(filename)
-                    result.paste(im, (x* TILES_WIDTH, y* TILES_HEIGHT))
-                y += 1
-            x += 1
-        result.save("map.png")
+    #  tcoord are the tile coordinates of the upper left tile,
+    #  see mapExport.export_map()
+    def do_export(self, tcoord, layer, online, mapServ, styleID, size,
+                  filename=EXPORT_NAME, threads=EXPORT_THREADS):
+        def read_tile(coord):
+            tilename = self.get_file(coord, layer, online, False, mapServ, styleID)
+            if tilename:
+                file = open(tilename, 'rb')
+                try:
+                    return file.read()
+                finally:
+                    file.close()
+        return export_map(filename, tcoord, size, read_tile, threads)
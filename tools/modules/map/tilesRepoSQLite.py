@@ -0,0 +1,171 @@
+## This modul provides a tile repository kept in MBTiles (SQLite) files
+#
+# Usage:
+#
+# - same interface as TilesRepositoryFS, MapServ() uses it when the
+#   repository option in the [init] section of the configuration is sqlite
+#
+# - one MBTiles file per map service and layer, see mbtiles.py
+#
+# - module is finalized from MapServ.finish() method, which inserts the
+#   tiles still waiting
+
+
+import os
+import sys
+import threading
+
+import mapPixbuf
+from pixbufCache import PixbufCache
+from mbtiles import MBTiles, tms_coord, tile_coord, mbtiles_path
+from mapExport import export_map
+
+from mapConst import *
+
+
+class TilesRepositorySQLite:
+
+    read_only = False
+
+    def __init__(self, MapServ_inst, cache_budgets=PIXBUF_CACHE_BUDGETS):
+        self.tile_cache = PixbufCache(cache_budgets)
+        self.mapServ_inst = MapServ_inst
+        self.configpath = self.mapServ_inst.configpath
+        self.lock = threading.Lock()
+        # MBTiles by (layer, mapServ)
+        self.stores = {}
+
+        self.missingPixbuf = mapPixbuf.missing()
+
+    def finish(self):
+        for store in self.stores.values():
+            store.close()
+
+    ## Returns the MBTiles of a layer, opening it if needed
+    def store(self, layer, mapServ):
+        store = self.stores.get((layer, mapServ))
+        if store is None:
+            self.lock.acquire()
+            try:
+                store = self.stores.get((layer, mapServ))
+                if store is None:
+                    store = MBTiles(mbtiles_path(self.configpath, layer, mapServ),
+                                    '%s %s' % (mapServ, LAYER_NAMES[layer]))
+                    self.stores[(layer, mapServ)] = store
+            finally:
+                self.lock.release()
+        return store
+
+    ## Returns the PixBuf of the tile
+    # Uses a cache to optimise database access
+    def load_pixbuf(self, coord, layer, force_update, mapServ):
+        filename = self.coord_to_path(coord, layer, mapServ)
+        pixbuf = None
+        if not force_update:
+            pixbuf = self.tile_cache.get(filename, layer)
+        if pixbuf is None:
+            store = self.store(layer, mapServ)
+            data = store.get(tms_coord(coord))
+            if data is None:
+                return self.missingPixbuf
+            try:
+                pixbuf = self.tile_cache.load_data(filename, data, layer)
+            except Exception:
+                pixbuf = self.missingPixbuf
+                print "Tile corrupted: %s" % filename
+                self.tile_cache.discard(filename, layer)
+                store.delete(tms_coord(coord))
+        return pixbuf
+
+    ## Get the tile for the given location into the database
+    # Returns true if the tile is successfully retrieved
+    # A forced update revalidates the tile if it is stale, see MapServ.is_stale()
+    def get_png_file(self, coord, layer, filename,
+                        online, force_update, mapServ, styleID):
+        store = self.store(layer, mapServ)
+        tms = tms_coord(coord)
+        cached = store.has(tms)
+        meta = None
+        if cached:
+            if not (force_update and online):
+                return True
+            # tiles stored without metadata are downloaded again
+            meta = store.get_meta(tms)
+            if not self.mapServ_inst.is_stale(meta):
+                return True
+        elif not online:
+            return False
+
+        try:
+            self.mapServ_inst.download_tile(coord, layer, mapServ, styleID, meta)
+            return True
+        except KeyboardInterrupt:
+            raise
+        except:
+            print '\tdownload failed -', sys.exc_info()[0]
+        # a stale tile is better than none
+        return cached
+
+    ## Returns the metadata of a tile, see MBTiles.get_meta()
+    def get_meta(self, coord, layer, mapServ):
+        return self.store(layer, mapServ).get_meta(tms_coord(coord))
+
+    ## Store the downloaded data of a tile, and its metadata if given
+    def put_tile(self, coord, layer, mapServ, data, meta=None):
+        self.store(layer, mapServ).put(tms_coord(coord), data, meta)
+        # do not keep showing the tile it replaces
+        self.tile_cache.discard(self.coord_to_path(coord, layer, mapServ), layer)
+
+    ## Mark a stored tile as fetched again, the server answered
+    #  it has not changed
+    def touch_tile(self, coord, layer, mapServ, meta):
+        self.store(layer, mapServ).put(tms_coord(coord), None, meta)
+
+    ## Remove a stored tile and its metadata
+    def remove_tile(self, coord, layer, mapServ):
+        self.tile_cache.discard(self.coord_to_path(coord, layer, mapServ), layer)
+        self.store(layer, mapServ).delete(tms_coord(coord))
+
+    ## Iterates over the stored tiles as (mapServ, layer, coord, size, used)
+    #  SQLite keeps no access times, used is the time the tile was fetched,
+    #  or the time the file was last written for tiles without metadata
+    def tiles(self):
+        for mapServ in MAP_SERVERS:
+            for layer in range(len(LAYER_NAMES)):
+                filename = mbtiles_path(self.configpath, layer, mapServ)
+                if not os.path.isfile(filename):
+                    continue
+                modified = os.path.getmtime(filename)
+                for tms, size, fetched in self.store(layer, mapServ).sizes():
+                    yield (mapServ, layer, tile_coord(*tms), size, fetched or modified)
+
+    ## Return the name of a tile, the MBTiles file followed by the
+    # MBTiles coordinates of the tile
+    def coord_to_path(self, tile_coord, layer, mapServ):
+        return '%s#%d/%d/%d' % ((mbtiles_path(self.configpath, layer, mapServ),)
+                                    + tms_coord(tile_coord))
+
+    ## Get the tile for the given location
+    # Validates the given tile coordinates and,
+    # returns the name of the tile if successfully retrieved
+    def get_file(self, tcoord, layer, online, force_update, mapServ, styleID):
+        if (MAP_MIN_ZOOM_LEVEL <= tcoord[2] <= MAP_MAX_ZOOM_LEVEL):
+            world_tiles = 2 ** (MAP_MAX_ZOOM_LEVEL - tcoord[2])
+            if (tcoord[0] > world_tiles) or (tcoord[1] > world_tiles):
+                return None
+            filename = self.coord_to_path(tcoord, layer, mapServ)
+            if self.get_png_file(tcoord, layer, filename, online,
+                                    force_update, mapServ, styleID):
+                return filename
+        return None
+
+    ## Export tiles to one big map
+    #  tcoord are the tile coordinates of the upper left tile,
+    #  see mapExport.export_map()
+    def do_export(self, tcoord, layer, online, mapServ, styleID, size,
+                  filename=EXPORT_NAME, threads=EXPORT_THREADS):
+        store = self.store(layer, mapServ)
+        def read_tile(coord):
+            if self.get_file(coord, layer, online, False, mapServ, styleID):
+                return store.get(tms_coord(coord))
+        return export_map(filename, tcoord, size, read_tile, threads)
@@ -14,7 +14,7 @@ setup(name = 'opengsmloc tools',
       author = 'Brendan Johan Lee',
       author_email = 'brendan@vanntett.net',
       url = 'http://opengsmloc.org',
-      scripts = ['glocalizer'],
+      scripts = ['glocalizer', 'tilestore', 'tileseed'],
       package_dir = {'': 'modules'},
       packages = ['map', 'mapServers', 'gloclib'],
       data_files = [('gladefiles', ['glade/glocalizer.glade'])])